@@ -0,0 +1,448 @@
+# aioserver.py
+"""asyncioで接続を扱うサーバ。
+
+main.runのサーバは接続ごとにスレッドを割り当てるため、待機中の持続的接続やServer-Sent Events
+のストリームもそれぞれスレッドを1つ占有する。こちらは接続の読み書きをイベントループで行い、
+DBを使う処理だけを決まった数のスレッド (実行器) で動かす。ルーティングと各APIの処理は
+MemoHandlerをそのまま使う。
+
+    python aioserver.py
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import resource
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+import database
+import main
+import metrics
+
+PORT = main.PORT
+WORKERS = 1 # 2以上ならその数のプロセスがそれぞれイベントループを動かす (main.runと同じプリフォーク)
+
+DB_THREADS = database.POOL_SIZE # DBを使う処理を動かすスレッド数。スレッドごとに接続を1つ持つ
+MAX_PENDING = 256 # 実行器で待っている・実行中のリクエストの上限。超えた分はすぐに503を返す
+MAX_CONNECTIONS = 10000 # 同時に開いておく接続の上限。超えた接続はすぐに閉じる
+LISTEN_BACKLOG = 1024
+
+IDLE_TIMEOUT = main.MemoHandler.timeout # 次のリクエスト (ヘッダとボディ) を受け取り終えるまでの上限 (秒)
+REQUEST_TIMEOUT = 30.0 # 実行器での待ちを含め、応答を書き始めるまでの上限 (秒)。超えたら504を返す
+WRITE_TIMEOUT = 30.0 # クライアントが応答を受け取らずに送信が滞ってよい上限 (秒)
+
+MAX_HEADER_BYTES = 64 * 1024
+BODY_BUFFER_SIZE = 1024 * 1024 # これ以下のボディはイベントループで読み終えてから実行器に渡す
+FLUSH_SIZE = main.STREAM_CHUNK_SIZE # 実行器のスレッドは応答がこの大きさたまるごとに送り出す
+
+def is_db_free(command, path):
+    """DBを使わず、イベントループでそのまま処理できるリクエストかを返します。"""
+    if command == 'OPTIONS':
+        return True
+    return command == 'GET' and (path == '/' or path.startswith('/static/') or path == '/api/metrics')
+
+class DBJob:
+    """実行器で動かす処理1つ。待ち時間と実行時間を計測し、タイムアウトしたら実行中のSQL文を中断させる。"""
+
+    def __init__(self, func, route):
+        self.func = func
+        self.route = route
+        self.queued_at = time.perf_counter()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._cancelled = False
+
+    def __call__(self):
+        started = time.perf_counter()
+        with self._lock:
+            if self._cancelled:
+                return None # 待っている間にタイムアウトした
+            if isinstance(database.pool, database.ThreadLocalPool):
+                self._conn = database.pool.acquire() # ハンドラがこのスレッドで使う接続
+        labels = (('route', self.route),)
+        metrics.registry.observe('memo_db_executor_wait_seconds', labels, started - self.queued_at)
+        try:
+            return self.func()
+        finally:
+            with self._lock:
+                self._conn = None
+            metrics.registry.observe('memo_db_executor_run_seconds', labels, time.perf_counter() - started)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
+
+class ResponseBuffer:
+    """ハンドラのwfileの代わり。書き込みをため、実行器のスレッドからはFLUSH_SIZEごとに送り出します。"""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._chunks = []
+        self._size = 0
+        self.closed = False
+        self.started = connection.loop.create_future() # 応答を送り始めたら完了する
+
+    def write(self, data):
+        if self.closed:
+            raise BrokenPipeError('response is closed')
+        self._chunks.append(bytes(data))
+        self._size += len(data)
+        if self._size >= FLUSH_SIZE:
+            self.flush()
+        return len(data)
+
+    def take(self):
+        """ためた分を取り出します。"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        return data
+
+    def flush(self):
+        # イベントループで処理しているときは、処理の後にまとめて送る
+        if self._connection.on_loop() or not self._chunks:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._send(self.take()), self._connection.loop)
+        try:
+            future.result()
+        except Exception:
+            self.closed = True
+            raise BrokenPipeError('client is not reading the response')
+
+    async def _send(self, data):
+        if not self.started.done():
+            self.started.set_result(None)
+        await self._connection.send(data)
+
+class BodyReader:
+    """大きなリクエストボディを、実行器のスレッドからイベントループ経由で少しずつ読みます。"""
+
+    def __init__(self, connection, length):
+        self._connection = connection
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b''
+        future = asyncio.run_coroutine_threadsafe(self._connection.read_body(size), self._connection.loop)
+        try:
+            data = future.result()
+        except Exception:
+            raise ConnectionResetError('request body was not received')
+        self.remaining -= len(data)
+        return data
+
+class AsyncMemoHandler(main.MemoHandler):
+    """イベントループから使うMemoHandler。ソケットの代わりにConnectionを読み書きします。"""
+
+    _queued_at = None
+
+    def __init__(self, connection, head):
+        # BaseHTTPRequestHandler.__init__はソケットからリクエストを読むので呼ばない
+        self.server = connection.server
+        self.client_address = connection.peer
+        self.rfile = io.BytesIO(head)
+        self.wfile = ResponseBuffer(connection)
+        self.raw_requestline = self.rfile.readline(65537)
+        self.close_connection = True
+
+    @contextlib.contextmanager
+    def _measure(self):
+        with super()._measure():
+            if self._queued_at is not None:
+                # 実行器で待った時間もリクエストの処理時間に含める
+                self._timer.phases['queue_wait'] += self._timer.start - self._queued_at
+                self._timer.start = self._queued_at
+            yield
+
+class Connection:
+    """クライアントとの接続1つ。持続的接続ではリクエストを順に処理します。"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.loop = server.loop
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername') or ('', 0)
+
+    def on_loop(self):
+        return threading.get_ident() == self.server.loop_thread
+
+    async def send(self, data):
+        if data:
+            self.writer.write(data)
+            await asyncio.wait_for(self.writer.drain(), WRITE_TIMEOUT)
+
+    async def read_body(self, size):
+        try:
+            return await asyncio.wait_for(self.reader.readexactly(size), IDLE_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def serve(self):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+                except asyncio.LimitOverrunError:
+                    await self.send(self._error_reply(None, 431, 'Request header too large'))
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break # 切断されたか、次のリクエストが来なかった
+                if not await self.handle_request(head):
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass # 応答を受け取らないクライアント
+        finally:
+            self.writer.close()
+            with contextlib.suppress(Exception):
+                await self.writer.wait_closed()
+
+    async def handle_request(self, head):
+        """リクエストを1つ処理します。接続を続けてよければTrueを返します。"""
+        handler = AsyncMemoHandler(self, head)
+        if not handler.parse_request(): # 不正なリクエストにはsend_errorで応答済み
+            await self.send(handler.wfile.take())
+            return False
+        await self.send(handler.wfile.take()) # Expect: 100-continue への応答
+
+        try:
+            length = int(handler.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            await self.send(self._error_reply(handler, 400, 'Invalid Content-Length'))
+            return False
+        streamed = length > BODY_BUFFER_SIZE
+        if streamed:
+            handler.rfile = BodyReader(self, length)
+        elif length:
+            body = await self.read_body(length)
+            if len(body) < length:
+                return False
+            handler.rfile = io.BytesIO(body)
+
+        method = getattr(handler, 'do_' + handler.command, None)
+        path = urllib.parse.urlparse(handler.path).path
+        if method is None:
+            handler.send_error(501, f'Unsupported method ({handler.command!r})')
+        elif handler.command == 'GET' and path == '/api/events':
+            await self.server.change_feed.serve(self, handler)
+            return False
+        elif is_db_free(handler.command, path) and not streamed:
+            method()
+        elif self.server.pending >= MAX_PENDING:
+            # 実行器が詰まっているときは待たせずに断り、クライアントに再試行させる
+            metrics.registry.inc('memo_http_rejected_total', (('reason', 'overloaded'),))
+            await self.send(self._error_reply(handler, 503, 'Server is busy', {'Retry-After': '1'}))
+            return not streamed
+        elif not await self._run_in_executor(handler, method, head):
+            return False
+        await self.send(handler.wfile.take())
+        return not handler.close_connection and (not streamed or handler.rfile.remaining == 0)
+
+    async def _run_in_executor(self, handler, method, head):
+        job = DBJob(method, main.route_label(urllib.parse.urlparse(handler.path).path))
+        handler._queued_at = job.queued_at
+        done = self.server.submit(job)
+        finished, _ = await asyncio.wait({done, handler.wfile.started}, timeout=REQUEST_TIMEOUT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        if not finished:
+            # 応答を書き始める前に時間切れになった。実行中のSQL文は中断させる
+            job.cancel()
+            handler.wfile.closed = True
+            done.add_done_callback(lambda f: f.cancelled() or f.exception())
+            metrics.registry.inc('memo_http_rejected_total', (('reason', 'timeout'),))
+            await self.send(self._error_reply(handler, 504, 'Request timed out'))
+            return False
+        try:
+            await done # 応答を送り始めていれば、送り終えるまで待つ
+        except (BrokenPipeError, ConnectionError):
+            return False
+        except Exception:
+            print(f'Exception occurred during processing of request from {self.peer}', file=sys.stderr)
+            traceback.print_exc()
+            return False
+        return True
+
+    def _error_reply(self, request, status, message, headers=None):
+        """requestへのエラー応答を組み立てます。処理中のハンドラとは別のインスタンスで書く。"""
+        reply = AsyncMemoHandler(self, b'')
+        if request is None:
+            reply.command, reply.path, reply.request_version, reply.requestline = 'GET', '', 'HTTP/1.1', ''
+            reply.headers = {}
+        else:
+            reply.command, reply.path = request.command, request.path
+            reply.request_version, reply.requestline, reply.headers = (
+                request.request_version, request.requestline, request.headers)
+        with reply._measure():
+            reply._send_response(status, {'error': message}, headers=headers)
+        return reply.wfile.take()
+
+class ChangeFeed:
+    """/api/events のストリームを、接続ごとのスレッドなしで送ります。
+
+    最新のseqは全接続で共有し、世代番号が変わったとき (と、ハートビートの間隔) にだけDBから読む。
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._changed = asyncio.Event()
+        self.seq = None
+        self.generation = None # seqを読む前の世代番号
+        self.subscribers = 0
+
+    async def run(self):
+        generation = None
+        last_poll = 0.0
+        while True:
+            await asyncio.sleep(main.EVENTS_POLL_INTERVAL)
+            if not self.subscribers:
+                generation = self.seq = self.generation = None # 購読者がいない間は読まない
+                continue
+            now = time.monotonic()
+            if main.current_generation() == generation and now - last_poll < main.EVENTS_HEARTBEAT:
+                continue
+            generation = main.current_generation()
+            last_poll = now
+            try:
+                seq = await self._server.submit(DBJob(self._latest_seq, '/api/events'))
+            except Exception:
+                traceback.print_exc()
+                continue
+            self.seq = seq
+            self.generation = generation
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    @staticmethod
+    def _latest_seq():
+        with database.connection() as conn:
+            return main.latest_change_seq(conn.cursor())
+
+    async def serve(self, connection, handler):
+        timer = metrics.RequestTimer()
+        try:
+            last_sent = int(handler.headers.get('Last-Event-ID') or -1)
+        except ValueError:
+            last_sent = -1
+        handler.send_response(200)
+        handler._send_cors_headers()
+        handler.send_header('Content-type', 'text/event-stream')
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+        handler.wfile.write(f'retry: {main.EVENTS_RETRY_MS}\n\n'.encode('utf-8'))
+        # 接続より前に読んだseqは古いかもしれないので、接続後に読んだものだけを送る
+        joined = main.current_generation()
+        self.subscribers += 1
+        try:
+            await connection.send(handler.wfile.take())
+            last_write = time.monotonic()
+            while True:
+                changed = self._changed
+                if self.generation is not None and self.generation >= joined and self.seq != last_sent:
+                    last_sent = self.seq
+                    await connection.send(f'id: {last_sent}\nevent: change\ndata: {{"seq": {last_sent}}}\n\n'.encode('utf-8'))
+                    last_write = time.monotonic()
+                    continue
+                wait = main.EVENTS_HEARTBEAT - (time.monotonic() - last_write)
+                if wait <= 0:
+                    await connection.send(b': ping\n\n')
+                    last_write = time.monotonic()
+                    continue
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(changed.wait(), wait)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass # クライアントが切断した
+        finally:
+            self.subscribers -= 1
+            metrics.finish_request(timer, 'GET', '/api/events', 200)
+
+class AsyncMemoServer:
+    """イベントループで接続を受け付け、DBを使う処理をスレッド数の決まった実行器に渡すサーバ。"""
+
+    def __init__(self, db_threads=DB_THREADS):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix='memo-db')
+        self.pending = 0
+        self.connections = 0
+        self.loop = None
+        self.loop_thread = None
+        self.change_feed = None
+
+    def submit(self, job):
+        """jobを実行器に渡し、結果を待つasyncioのFutureを返します。"""
+        self.pending += 1
+        metrics.registry.set('memo_db_executor_pending', (), self.pending)
+        future = self.executor.submit(job)
+        future.add_done_callback(lambda _: self.loop.call_soon_threadsafe(self._job_done))
+        return asyncio.wrap_future(future)
+
+    def _job_done(self):
+        self.pending -= 1
+        metrics.registry.set('memo_db_executor_pending', (), self.pending)
+
+    async def _handle(self, reader, writer):
+        if self.connections >= MAX_CONNECTIONS:
+            metrics.registry.inc('memo_http_rejected_total', (('reason', 'connections'),))
+            writer.close()
+            return
+        self.connections += 1
+        metrics.registry.set('memo_http_open_connections', (), self.connections)
+        try:
+            await Connection(self, reader, writer).serve()
+        finally:
+            self.connections -= 1
+            metrics.registry.set('memo_http_open_connections', (), self.connections)
+
+    async def serve(self, sock):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.change_feed = ChangeFeed(self)
+        feed = asyncio.create_task(self.change_feed.run())
+        server = await asyncio.start_server(self._handle, sock=sock, limit=MAX_HEADER_BYTES)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            feed.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+def raise_file_limit(wanted):
+    """開けるファイル数の上限 (ソフトリミット) を、ハードリミットの範囲でwantedまで上げます。"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    if soft != resource.RLIM_INFINITY and soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+def run(port=PORT, workers=WORKERS, db_threads=DB_THREADS):
+    main.prepare_server()
+    # 準備に使った接続は閉じ、以降は実行器のスレッドごとの接続を使う
+    database.pool.close_all()
+    database.pool = database.ThreadLocalPool(db_threads)
+    raise_file_limit(MAX_CONNECTIONS + db_threads + 64)
+    sock = socket.create_server(('', port), backlog=LISTEN_BACKLOG)
+
+    def serve():
+        asyncio.run(AsyncMemoServer(db_threads).serve(sock))
+
+    try:
+        if workers <= 1:
+            main.trash_purger.start()
+            print(f"Serving HTTP on port {port} (asyncio, {db_threads} database threads)...")
+            serve()
+        else:
+            main.serve_workers(serve, port, workers)
+    finally:
+        sock.close()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,5 @@
+"""ベンチマーク用のツール。
+
+- benchmark.corpus: 乱数シードから同じ内容のmemo.dbを作るコーパス生成器
+- benchmark.load: 起動中のサーバーに実際の操作に近いリクエストを送り、エンドポイントごとの性能をJSONで出す負荷ドライバ
+"""
@@ -0,0 +1,217 @@
+"""ベンチマーク用のmemo.dbを生成します。
+
+同じ引数 (シードを含む) からは常に同じ内容のDBができるので、コミット間で結果を比べられる。
+
+    python -m benchmark.corpus --notes 100000 --output bench.db
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+# リポジトリ直下のモジュール (database.py) を読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+# 既定の規模と分布
+DEFAULT_NOTES = 10000
+DEFAULT_TAGS = 2000
+DEFAULT_TAGS_PER_NOTE = 2.0      # 1メモあたりのタグ数の平均 (ポアソン分布)
+DEFAULT_TAG_SKEW = 1.1           # タグの使われ方の偏り (Zipf分布の指数)
+DEFAULT_FAVORITE_TAGS = 10       # よく使われる順にお気に入りにするタグ数
+DEFAULT_CONTENT_MEDIAN = 600     # 本文の長さ (文字数) の中央値
+DEFAULT_CONTENT_SIGMA = 1.0      # 本文の長さの対数正規分布のばらつき
+DEFAULT_CONTENT_MAX = 200000     # 本文の長さの上限
+DEFAULT_JAPANESE_RATIO = 0.7     # 日本語で書かれたメモの割合
+DEFAULT_TRASHED_FRACTION = 0.05  # ゴミ箱に入っているメモの割合
+DEFAULT_SEED = 42
+
+# 作成日時の起点 (実行時刻に依存させない)
+BASE_TIME = datetime(2024, 1, 1)
+TIME_SPAN_DAYS = 730
+INSERT_BATCH_SIZE = 5000
+
+JAPANESE_WORDS = [
+    '会議', '議事録', '予定', '買い物', 'リスト', '旅行', '計画', '読書', 'メモ', '日記',
+    '仕事', '開発', '設計', '実装', 'テスト', 'レビュー', '障害', '対応', '調査', '報告',
+    '東京', '大阪', '京都', '天気', '料理', 'レシピ', '健康', '運動', '家計簿', '勉強',
+    'データベース', '検索', '性能', '改善', 'サーバー', 'ブラウザ', '画面', '機能', '要望', '課題',
+    'プロジェクト', 'スケジュール', '締め切り', '確認', '共有', '資料', '発表', '準備', '連絡', '相談',
+    'ことば', 'ひらがな', 'カタカナ', '漢字', '映画', '音楽', '写真', '散歩', '週末', '来週',
+]
+JAPANESE_PARTICLES = ['は', 'が', 'を', 'に', 'で', 'と', 'の', 'から', 'まで', 'も']
+JAPANESE_ENDINGS = ['する。', 'した。', 'です。', 'でした。', 'を確認する。', 'について考える。', 'が必要。', 'を進める。']
+
+ENGLISH_WORDS = [
+    'meeting', 'notes', 'plan', 'todo', 'shopping', 'list', 'travel', 'reading', 'journal', 'idea',
+    'work', 'design', 'build', 'test', 'review', 'incident', 'research', 'report', 'draft', 'release',
+    'python', 'sqlite', 'search', 'index', 'query', 'server', 'browser', 'cache', 'latency', 'memory',
+    'project', 'deadline', 'schedule', 'budget', 'health', 'recipe', 'music', 'movie', 'photo', 'weekend',
+    'the', 'a', 'and', 'of', 'to', 'for', 'with', 'on', 'in', 'is',
+]
+
+def lognormal_length(rng, median, sigma, maximum):
+    """中央値medianの対数正規分布から本文の長さを選びます。"""
+    return max(1, min(maximum, int(rng.lognormvariate(math.log(median), sigma))))
+
+def poisson(rng, mean):
+    """平均meanのポアソン分布から整数を選びます (Knuthの方法)。"""
+    limit = math.exp(-mean)
+    k = 0
+    p = rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+def japanese_sentence(rng):
+    parts = []
+    for _ in range(rng.randint(1, 3)):
+        parts.append(rng.choice(JAPANESE_WORDS))
+        parts.append(rng.choice(JAPANESE_PARTICLES))
+    parts.append(rng.choice(JAPANESE_WORDS))
+    parts.append(rng.choice(JAPANESE_ENDINGS))
+    return ''.join(parts)
+
+def english_sentence(rng):
+    words = [rng.choice(ENGLISH_WORDS) for _ in range(rng.randint(4, 12))]
+    return ' '.join(words).capitalize() + '.'
+
+def make_text(rng, length, japanese):
+    """おおよそlength文字の本文を、段落に分けて作ります。"""
+    sentence = japanese_sentence if japanese else english_sentence
+    separator = '' if japanese else ' '
+    paragraphs = []
+    size = 0
+    while size < length:
+        paragraph = separator.join(sentence(rng) for _ in range(rng.randint(2, 6)))
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return '\n\n'.join(paragraphs)[:length]
+
+def make_tag_names(rng, count):
+    """重複しないタグ名をcount個作ります。先頭ほどよく使われるタグになります。"""
+    words = JAPANESE_WORDS + [w for w in ENGLISH_WORDS if len(w) > 3]
+    names = list(dict.fromkeys(words))
+    rng.shuffle(names)
+    seen = set(names)
+    while len(names) < count:
+        name = f"{rng.choice(words)}-{rng.choice(words)}"
+        if rng.random() < 0.3:
+            name += str(rng.randint(1, 999))
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names[:count]
+
+def generate(path, notes=DEFAULT_NOTES, tags=DEFAULT_TAGS, tags_per_note=DEFAULT_TAGS_PER_NOTE,
+             tag_skew=DEFAULT_TAG_SKEW, favorite_tags=DEFAULT_FAVORITE_TAGS,
+             content_median=DEFAULT_CONTENT_MEDIAN, content_sigma=DEFAULT_CONTENT_SIGMA,
+             content_max=DEFAULT_CONTENT_MAX, japanese_ratio=DEFAULT_JAPANESE_RATIO,
+             trashed_fraction=DEFAULT_TRASHED_FRACTION, seed=DEFAULT_SEED):
+    """pathに新しいDBを作り、合成したメモとタグを書き込みます。生成結果の概要を返します。"""
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+    rng = random.Random(seed)
+
+    database.DATABASE_NAME = path
+    database.init_db()
+    conn = database.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    # 1件ずつトリガーで索引を更新するより、最後にまとめて作り直す方が速い
+    database.suspend_index_triggers(cursor)
+
+    tag_names = make_tag_names(rng, tags)
+    cursor.executemany("INSERT INTO tags (id, name, is_favorite) VALUES (?, ?, ?)",
+                       [(i + 1, name, 1 if i < favorite_tags else 0) for i, name in enumerate(tag_names)])
+    # Zipf分布の累積重み (id 1 が最もよく使われる)
+    cum_weights = list(itertools.accumulate(1 / (rank ** tag_skew) for rank in range(1, tags + 1)))
+
+    total_chars = 0
+    tag_links = 0
+    trashed = 0
+    note_rows = []
+    body_rows = []
+    link_rows = []
+
+    def flush():
+        cursor.executemany("""
+            INSERT INTO notes (id, title, content, preview, created_at, updated_at, is_trashed)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, note_rows)
+        cursor.executemany("INSERT INTO note_bodies (note_id, size, body) VALUES (?, ?, ?)", body_rows)
+        cursor.executemany("INSERT OR IGNORE INTO note_tags (note_id, tag_id) VALUES (?, ?)", link_rows)
+        note_rows.clear()
+        body_rows.clear()
+        link_rows.clear()
+
+    for note_id in range(1, notes + 1):
+        japanese = rng.random() < japanese_ratio
+        title = make_text(rng, rng.randint(5, 30), japanese).replace('\n', ' ')
+        content = make_text(rng, lognormal_length(rng, content_median, content_sigma, content_max), japanese)
+        created = BASE_TIME + timedelta(seconds=rng.uniform(0, TIME_SPAN_DAYS * 86400))
+        updated = created + timedelta(seconds=rng.expovariate(1 / 86400))
+        is_trashed = 1 if rng.random() < trashed_fraction else 0
+        # 長い本文はサーバーと同じくnote_bodiesに圧縮して置く
+        stored, preview, body = database.split_body(content)
+        note_rows.append((note_id, title, stored, preview, created.isoformat(), updated.isoformat(), is_trashed))
+        if body is not None:
+            body_rows.append((note_id, *body))
+        if tags:
+            chosen = set(rng.choices(range(1, tags + 1), cum_weights=cum_weights, k=poisson(rng, tags_per_note)))
+            link_rows.extend((note_id, tag_id) for tag_id in sorted(chosen))
+            tag_links += len(chosen)
+        total_chars += len(content)
+        trashed += is_trashed
+        if len(note_rows) >= INSERT_BATCH_SIZE:
+            flush()
+    flush()
+
+    database.resume_index_triggers(cursor)
+    conn.commit()
+    # 空のDBで集めた統計ではクエリプランが実データと変わるので取り直す
+    cursor.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    return {
+        'path': path,
+        'seed': seed,
+        'notes': notes,
+        'trashed_notes': trashed,
+        'tags': tags,
+        'tag_links': tag_links,
+        'content_chars': total_chars,
+        'file_bytes': os.path.getsize(path),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a deterministic memo.db for benchmarks.')
+    parser.add_argument('--output', default='bench.db', help='path of the database to create')
+    parser.add_argument('--notes', type=int, default=DEFAULT_NOTES)
+    parser.add_argument('--tags', type=int, default=DEFAULT_TAGS)
+    parser.add_argument('--tags-per-note', type=float, default=DEFAULT_TAGS_PER_NOTE)
+    parser.add_argument('--tag-skew', type=float, default=DEFAULT_TAG_SKEW)
+    parser.add_argument('--favorite-tags', type=int, default=DEFAULT_FAVORITE_TAGS)
+    parser.add_argument('--content-median', type=int, default=DEFAULT_CONTENT_MEDIAN)
+    parser.add_argument('--content-sigma', type=float, default=DEFAULT_CONTENT_SIGMA)
+    parser.add_argument('--content-max', type=int, default=DEFAULT_CONTENT_MAX)
+    parser.add_argument('--japanese-ratio', type=float, default=DEFAULT_JAPANESE_RATIO)
+    parser.add_argument('--trashed-fraction', type=float, default=DEFAULT_TRASHED_FRACTION)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    args = parser.parse_args(argv)
+    summary = generate(
+        args.output, notes=args.notes, tags=args.tags, tags_per_note=args.tags_per_note,
+        tag_skew=args.tag_skew, favorite_tags=args.favorite_tags,
+        content_median=args.content_median, content_sigma=args.content_sigma,
+        content_max=args.content_max, japanese_ratio=args.japanese_ratio,
+        trashed_fraction=args.trashed_fraction, seed=args.seed)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
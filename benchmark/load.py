@@ -0,0 +1,367 @@
+"""起動中のメモアプリに、実際の操作に近いリクエストを送ってエンドポイントごとの性能を測ります。
+
+一覧・深いページ・ブール検索・タグ一覧・自動保存・タグの追加と削除などを重み付きで混ぜて送り、
+スループットと p50/p95/p99 のレイテンシをJSONで出力する。
+
+    python -m benchmark.corpus --notes 100000 --output bench.db
+    python -m benchmark.load --db bench.db --serve --duration 30 --concurrency 8 --output result.json
+
+書き込み (自動保存・タグ操作) も行うため、コミット間で比べるときは毎回生成し直したDBを使うこと。
+DBファイルをコピーして使う場合は、古い -wal/-shm ファイルが残っていないことを確かめる。
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+from benchmark.corpus import ENGLISH_WORDS, JAPANESE_WORDS
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_URL = 'http://127.0.0.1:8000'
+DEFAULT_DURATION = 30.0
+DEFAULT_CONCURRENCY = 8
+DEFAULT_SEED = 1
+PAGE_SIZE = 20
+SAMPLE_NOTES = 5000  # 自動保存・タグ操作の対象にするメモの数
+POPULAR_TAGS = 200   # 検索・補完に使うタグの数 (memo_countの多い順)
+BENCH_TAGS = [f'bench-{i}' for i in range(10)]  # 追加してすぐ削除するタグ
+
+# 操作の種類と重み。1つの操作が複数のリクエストを送ることもある
+DEFAULT_MIX = {
+    'list_page': 30,
+    'deep_page': 5,
+    'search': 15,
+    'tag_sidebar': 10,
+    'tag_suggest': 5,
+    'autosave': 25,
+    'tag_add_remove': 10,
+}
+
+class Recorder:
+    """エンドポイントごとのレイテンシとステータスコードを集計します。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}  # エンドポイント名 -> 秒のリスト
+        self.statuses = {}   # エンドポイント名 -> {ステータス: 件数}
+        self.errors = {}     # エンドポイント名 -> 通信エラーの件数
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def record_error(self, endpoint):
+        with self._lock:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def percentile(sorted_values, fraction):
+    """昇順に並んだ値の百分位数を最近順位法で返します。"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(len(sorted_values) * fraction))
+    return sorted_values[rank - 1]
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def summarize(recorder, elapsed):
+    """集計結果を、エンドポイントごとのスループットとレイテンシ (ミリ秒) にまとめます。"""
+    endpoints = {}
+    total = 0
+    for endpoint in sorted(set(recorder.latencies) | set(recorder.errors)):
+        values = sorted(recorder.latencies.get(endpoint, []))
+        total += len(values)
+        endpoints[endpoint] = {
+            'count': len(values),
+            'errors': recorder.errors.get(endpoint, 0),
+            'throughput_rps': round(len(values) / elapsed, 2) if elapsed else None,
+            'mean_ms': to_ms(sum(values) / len(values)) if values else None,
+            'p50_ms': to_ms(percentile(values, 0.50)),
+            'p95_ms': to_ms(percentile(values, 0.95)),
+            'p99_ms': to_ms(percentile(values, 0.99)),
+            'max_ms': to_ms(values[-1]) if values else None,
+            'status': {str(code): n for code, n in sorted(recorder.statuses.get(endpoint, {}).items())},
+        }
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else None,
+        'endpoints': endpoints,
+    }
+
+def load_sample(db_path, seed):
+    """負荷の対象にするメモid・タグ名・ページ数をDBから読み取ります。"""
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        active = conn.execute("SELECT COUNT(*) FROM notes WHERE is_trashed = 0").fetchone()[0]
+        note_ids = [row[0] for row in conn.execute("SELECT id FROM notes WHERE is_trashed = 0 ORDER BY id")]
+        tags = [row[0] for row in conn.execute(
+            "SELECT name FROM tags ORDER BY memo_count DESC, name LIMIT ?", (POPULAR_TAGS,))]
+    finally:
+        conn.close()
+    rng = random.Random(seed)
+    if len(note_ids) > SAMPLE_NOTES:
+        note_ids = rng.sample(note_ids, SAMPLE_NOTES)
+    return {
+        'note_ids': note_ids,
+        'tags': tags,
+        'pages': max(1, math.ceil(active / PAGE_SIZE)),
+    }
+
+def random_query(rng, tags):
+    """検索欄に入力されそうなブール式を作ります (2文字以下の語はLIKE検索になる)。"""
+    def term():
+        if tags and rng.random() < 0.2:
+            return '@tags:' + rng.choice(tags)
+        return rng.choice(JAPANESE_WORDS if rng.random() < 0.7 else ENGLISH_WORDS)
+    form = rng.randrange(6)
+    if form == 0:
+        return term()
+    if form == 1:
+        return f'{term()} AND {term()}'
+    if form == 2:
+        return f'{term()} OR {term()}'
+    if form == 3:
+        return f'{term()} AND NOT {term()}'
+    if form == 4:
+        return f'({term()} OR {term()}) AND {term()}'
+    return f'{term()} {term()} -{term()}'
+
+class Worker(threading.Thread):
+    """1つの持続的接続で、期限まで操作を送り続けるクライアント。"""
+
+    def __init__(self, url, sample, mix, recorder, seed, deadline, max_operations):
+        super().__init__(daemon=True)
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.sample = sample
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.recorder = recorder
+        self.rng = random.Random(seed)
+        self.deadline = deadline
+        self.max_operations = max_operations
+        self.conn = None
+        self.editing = None  # 自動保存中のメモ [id, version, UTF-16での本文の長さ]
+
+    def request(self, endpoint, method, path, body=None, headers=None):
+        """リクエストを1つ送って計測し、(ステータス, ヘッダ, JSON) を返します。"""
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                # サーバーがアイドル接続を閉じていた場合は1回だけ接続し直す
+                if attempt == 0:
+                    continue
+                self.recorder.record_error(endpoint)
+                return None, None, None
+            self.recorder.record(endpoint, time.perf_counter() - start, response.status)
+            if response.will_close:
+                self.conn.close()
+                self.conn = None
+            try:
+                payload = json.loads(data) if data else None
+            except ValueError:
+                payload = None
+            return response.status, response, payload
+
+    def run(self):
+        count = 0
+        while time.perf_counter() < self.deadline and (not self.max_operations or count < self.max_operations):
+            operation = self.rng.choices(self.operations, weights=self.weights)[0]
+            getattr(self, 'op_' + operation)()
+            count += 1
+        if self.conn is not None:
+            self.conn.close()
+
+    # --- 操作 ---
+    def op_list_page(self):
+        page = self.rng.randint(1, min(3, self.sample['pages']))
+        self.request('list_page', 'GET', f'/api/notes?page={page}&limit={PAGE_SIZE}')
+
+    def op_deep_page(self):
+        pages = self.sample['pages']
+        page = self.rng.randint(max(1, pages // 2), pages)
+        self.request('deep_page', 'GET', f'/api/notes?page={page}&limit={PAGE_SIZE}')
+
+    def op_search(self):
+        query = urllib.parse.quote(random_query(self.rng, self.sample['tags']))
+        self.request('search', 'GET', f'/api/search/notes?query={query}&page=1&limit={PAGE_SIZE}')
+
+    def op_tag_sidebar(self):
+        self.request('tag_favorites', 'GET', '/api/tags/favorites')
+        self.request('tag_others', 'GET', f'/api/tags/others?page=1&limit={PAGE_SIZE}')
+
+    def op_tag_suggest(self):
+        tags = self.sample['tags']
+        if not tags:
+            return
+        # 入力途中の文字列として、タグ名の先頭や途中の1〜3文字を使う
+        name = self.rng.choice(tags)
+        start = self.rng.randrange(len(name))
+        q = urllib.parse.quote(name[start:start + self.rng.randint(1, 3)])
+        self.request('tag_suggest', 'GET', f'/api/tags/suggest?q={q}&limit=5')
+
+    def open_note(self):
+        note_id = self.rng.choice(self.sample['note_ids'])
+        status, response, note = self.request('note_get', 'GET', f'/api/notes/{note_id}')
+        if status != 200 or not note:
+            self.editing = None
+            return
+        length = len(note['content'].encode('utf-16-le')) // 2
+        self.editing = [note_id, note.get('version'), length]
+
+    def op_autosave(self):
+        # 同じメモを何回か続けて編集してから、別のメモを開く
+        if self.editing is None or self.rng.random() < 0.2:
+            self.open_note()
+            if self.editing is None:
+                return
+        note_id, version, length = self.editing
+        text = ' ' + ''.join(self.rng.choice(JAPANESE_WORDS) for _ in range(self.rng.randint(1, 4)))
+        if version is None:
+            # 差分保存に対応していないサーバーには全文を送れないので、タイトルだけを保存する
+            body, headers = {'title': text.strip()}, {}
+        else:
+            body, headers = {'delta': [[length, length, text]]}, {'If-Match': f'"v{version}"'}
+        status, response, ack = self.request('autosave', 'PUT', f'/api/notes/{note_id}', body, headers)
+        if status == 200 and ack and version is not None:
+            self.editing = [note_id, ack.get('version'), length + len(text.encode('utf-16-le')) // 2]
+        else:
+            self.editing = None  # 他のワーカーと競合した (412) ときなどは開き直す
+
+    def op_tag_add_remove(self):
+        note_id = self.rng.choice(self.sample['note_ids'])
+        tag = self.rng.choice(BENCH_TAGS)
+        self.request('tag_add', 'POST', f'/api/notes/{note_id}/tags', {'tag_name': tag})
+        self.request('tag_remove', 'DELETE', f'/api/notes/{note_id}/tags/{urllib.parse.quote(tag)}')
+
+def wait_for_server(url, timeout=30.0):
+    parsed = urllib.parse.urlparse(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=1)
+            conn.request('GET', '/api/tags/favorites')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server at {url} did not start within {timeout} seconds')
+
+def start_server(db_path, port, workers, module='main'):
+    """db_pathを使うサーバーを別プロセスで起動します。moduleはrunを呼ぶモジュール (main か aioserver)。"""
+    code = (
+        f'import signal, database, {module}\n'
+        f'database.DATABASE_NAME = {os.path.abspath(db_path)!r}\n'
+        # SIGTERMをKeyboardInterruptにして、DBの接続を閉じてから終了させる (-wal/-shmを残さない)
+        'signal.signal(signal.SIGTERM, signal.default_int_handler)\n'
+        'try:\n'
+        f'    {module}.run(port={port}, workers={workers})\n'
+        'except KeyboardInterrupt:\n'
+        '    database.pool.close_all()\n'
+    )
+    return subprocess.Popen([sys.executable, '-c', code], cwd=REPO_ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def run_benchmark(url, sample, mix=None, duration=DEFAULT_DURATION, concurrency=DEFAULT_CONCURRENCY,
+                  seed=DEFAULT_SEED, max_operations=0):
+    """負荷をかけて集計結果を返します。max_operationsはワーカーごとの操作数の上限 (0は無制限)。"""
+    mix = mix or DEFAULT_MIX
+    recorder = Recorder()
+    start = time.perf_counter()
+    deadline = start + duration
+    workers = [Worker(url, sample, mix, recorder, seed * 1000 + i, deadline, max_operations)
+               for i in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return summarize(recorder, time.perf_counter() - start)
+
+def parse_mix(text):
+    """'list_page=30,search=10' の形式で操作の重みを読み取ります。"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown operation: {name}')
+        mix[name] = float(weight)
+    return mix
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a realistic request mix against the memo server.')
+    parser.add_argument('--url', default=DEFAULT_URL, help='base URL of a running server')
+    parser.add_argument('--db', default='memo.db', help='database the server uses (read to pick note ids and tags)')
+    parser.add_argument('--serve', action='store_true', help='start a server on --db for the duration of the run')
+    parser.add_argument('--server-workers', type=int, default=1, help='worker processes for --serve')
+    parser.add_argument('--server-asyncio', action='store_true', help='use the asyncio server (aioserver) for --serve')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='seconds to run')
+    parser.add_argument('--operations', type=int, default=0, help='stop each client after this many operations')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--mix', type=parse_mix, help='operation weights, e.g. list_page=30,search=10')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    sample = load_sample(args.db, args.seed)
+    server = None
+    if args.serve:
+        server = start_server(args.db, urllib.parse.urlparse(args.url).port or 80, args.server_workers,
+                              'aioserver' if args.server_asyncio else 'main')
+    try:
+        wait_for_server(args.url)
+        result = run_benchmark(args.url, sample, args.mix, args.duration, args.concurrency,
+                               args.seed, args.operations)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    report = {
+        'config': {
+            'url': args.url,
+            'db': args.db,
+            'duration_s': args.duration,
+            'operations': args.operations,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'mix': args.mix or DEFAULT_MIX,
+            'server_workers': args.server_workers if args.serve else None,
+            'server': ('aioserver' if args.server_asyncio else 'main') if args.serve else None,
+        },
+        **result,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,308 @@
 # database.py
+import contextlib
+import os
+import queue
 import sqlite3
+import sys
+import threading
+import time
+import zlib
 from datetime import datetime
 
+import metrics
+
 DATABASE_NAME = 'memo.db'
 
+# 全文検索インデックス(FTS5)のトークナイザ
+# 'trigram' は単語区切りのない日本語でも部分一致で検索できる (3文字未満の語はLIKE検索になる)
+# 'unicode61' は単語単位のインデックスで、語は前方一致で検索される
+FTS_TOKENIZER = 'trigram'
+
+# Trueならtags.memo_countにゴミ箱内のメモを数えない
+TAG_COUNT_EXCLUDES_TRASHED = False
+
+# 変更履歴 (changes) に残す件数。これより古い位置からの差分を求めたクライアントには全件の取り直しを求める
+CHANGE_LOG_KEEP = 100000
+CHANGE_LOG_PRUNE_EVERY = 1000 # この件数ごとに古い履歴を削除する
+
+# 'incremental' ならメモの削除で空いたページをPRAGMA incremental_vacuumで少しずつファイルから返す
+# ('none' は空きページを再利用するだけ、'full' はコミットのたびに縮める)。既存のDBは起動時に一度VACUUMして切り替える
+AUTO_VACUUM = 'incremental'
+AUTO_VACUUM_MODES = {'none': 0, 'full': 1, 'incremental': 2}
+
+# UTF-8でこのバイト数以上の本文はzlibで圧縮してnote_bodiesテーブルに置き、notesの行を小さく保つ (Noneなら圧縮しない)。
+# 設定を変えると、起動時に既存の本文を圧縮・展開し直す
+BODY_COMPRESS_MIN_BYTES = 2048
+BODY_COMPRESS_LEVEL = 6
+NOTE_PREVIEW_LENGTH = 120 # 圧縮した本文の先頭をnotes.previewに残す文字数 (一覧のsnippetに使う)
+
+# コネクションプールの設定
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000 # 書き込みロック待ちの上限
+
+# SQL文の計測
+SQL_METRICS = True
+SLOW_QUERY_MS = None # この時間(ミリ秒)以上かかったSQL文を実行計画付きで標準エラーに出す (Noneなら出さない)
+PROGRESS_STEPS = 1000 # 進捗ハンドラを呼ぶ間隔 (VM命令数)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """SQL文ごとに、実行と行の取得にかかった時間と行数を計測するカーソル。
+
+    1つの文の計測は、次の実行・行の読み切り・close・破棄のいずれかで確定する。
+    """
+    _sql = None
+
+    def _begin(self, sql, parameters, elapsed, steps_before):
+        self._sql = sql
+        self._parameters = parameters
+        self._elapsed = elapsed
+        self._steps_before = steps_before
+        # SELECTなどのrowcountは-1なので、取得した行を数える
+        self._rows = max(self.rowcount, 0)
+
+    def _finish(self):
+        sql = self._sql
+        if sql is None:
+            return
+        self._sql = None
+        conn = self.connection
+        steps = (conn.vm_steps - self._steps_before) * PROGRESS_STEPS
+        slow = SLOW_QUERY_MS is not None and self._elapsed * 1000 >= SLOW_QUERY_MS
+        metrics.record_sql(metrics.statement_verb(sql), self._elapsed, self._rows, steps, slow)
+        if slow:
+            log_slow_query(conn, sql, self._parameters, self._elapsed, self._rows, steps)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        steps_before = self.connection.vm_steps
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._begin(sql, parameters, time.perf_counter() - start, steps_before)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        steps_before = self.connection.vm_steps
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._begin(sql, None, time.perf_counter() - start, steps_before)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        if self._sql is not None:
+            self._elapsed += time.perf_counter() - start
+            if row is None:
+                self._finish()
+            else:
+                self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self._sql is not None:
+            self._elapsed += time.perf_counter() - start
+            self._rows += len(rows)
+            if not rows:
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self._sql is not None:
+            self._elapsed += time.perf_counter() - start
+            self._rows += len(rows)
+            self._finish()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            if self._sql is not None:
+                self._elapsed += time.perf_counter() - start
+                self._finish()
+            raise
+        if self._sql is not None:
+            self._elapsed += time.perf_counter() - start
+            self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """InstrumentedCursorを使い、コミットにかかった時間も計測する接続。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vm_steps = 0
+        # 進捗ハンドラでVM命令数を数える (Noneを返すので処理は中断されない)
+        self.set_progress_handler(self._count_vm_steps, PROGRESS_STEPS)
+
+    def _count_vm_steps(self):
+        self.vm_steps += 1
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute() などはcursor()を経由せずにカーソルを作るため、ここでも差し替える
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            metrics.record_commit(time.perf_counter() - start)
+
+EXPLAINABLE_VERBS = {'SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE'}
+
+def log_slow_query(conn, sql, parameters, elapsed, rows, vm_steps):
+    """遅いSQL文を、EXPLAIN QUERY PLANの結果と一緒に標準エラーへ出します。"""
+    lines = [f"[slow query] {elapsed * 1000:.1f} ms, rows={rows}, vm_steps~{vm_steps}", "  " + " ".join(sql.split())]
+    if parameters is not None and metrics.statement_verb(sql) in EXPLAINABLE_VERBS:
+        try:
+            # 計測用でないカーソルを使い、この文自体は計測しない
+            plan = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            lines.append(f"  (EXPLAIN QUERY PLAN failed: {e})")
+        else:
+            lines.append("  QUERY PLAN")
+            lines.extend(f"    {row[0]}|{row[1]}|{row[3]}" for row in plan)
+    print("\n".join(lines), file=sys.stderr)
+
 def get_db_connection():
     """データベース接続を取得します。"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    # プールした接続はスレッド間で受け渡すため、check_same_threadを無効にする
+    factory = InstrumentedConnection if SQL_METRICS else sqlite3.Connection
+    conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False, factory=factory)
     conn.row_factory = sqlite3.Row # カラム名でアクセスできるようにする
+    # WALモードでは読み取りが書き込みをブロックしない
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    # 圧縮した本文を展開する関数 (全文検索インデックスのトリガーとnote_textsビューからも使う)
+    conn.create_function('inflate_body', 1, inflate_body, deterministic=True)
     return conn
 
+class ConnectionPool:
+    """設定済みのデータベース接続を使い回すためのプール。"""
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """接続を取り出します。上限まで作成済みなら空きが出るまで待ちます。"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return get_db_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, conn):
+        """接続をプールに戻します。未完了のトランザクションは破棄します。"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        """空いている接続をすべて閉じます。"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+class ThreadLocalPool(ConnectionPool):
+    """スレッドごとに専用の接続を1つ持たせるプール。スレッド数が決まっている実行器で使います。
+
+    接続の数はスレッドの数と同じになり、取り出しで待つことがない。sizeは目安として保持するだけ。
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        super().__init__(size)
+        self._local = threading.local()
+        self._conns = []
+
+    def acquire(self):
+        """呼び出したスレッドの接続を返します (初回に作成)。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = get_db_connection()
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+
+    def close_all(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+pool = ConnectionPool()
+
+def _reset_pool_after_fork():
+    # SQLiteの接続はfork先のプロセスに引き継げないため、子プロセスでは新しいプールを使う
+    global pool
+    pool = type(pool)(pool.size)
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+def connection():
+    """プールから接続を借りるコンテキストマネージャを返します。"""
+    return pool.connection()
+
 def init_db():
     """データベースを初期化し、テーブルを作成します。"""
+    prepare_new_database()
     conn = get_db_connection()
     cursor = conn.cursor()
 
@@ -46,9 +337,585 @@ def init_db():
         PRIMARY KEY (note_id, tag_id)
     )
     ''')
+
     conn.commit()
+
+    applied = migrate(conn)
+    for version, description in applied:
+        print(f"Applied migration {version}: {description}")
+
+    # 以下は設定値に依存するため、起動のたびに確認する
+    cursor.execute("BEGIN IMMEDIATE")
+    sync_fts_tokenizer(cursor)
+    sync_tag_count_mode(cursor)
+    sync_change_log_retention(cursor)
+    compressed, expanded = sync_body_storage(cursor)
+    conn.commit()
+    if compressed or expanded:
+        print(f"Note bodies: compressed {compressed}, expanded {expanded}")
+    if sync_auto_vacuum(conn):
+        print(f"Rebuilt database file with auto_vacuum={AUTO_VACUUM}")
     conn.close()
     print("Database initialized.")
 
+# --- 長い本文の圧縮保存 (note_bodies) ---
+# 圧縮した本文はnote_bodiesに置き、notes.contentは空にする。メモの本文は
+# notes.contentが空でなければnotes.content、空ならnote_bodiesを展開したもの (どちらもなければ空)。
+# notesとnote_bodiesを1つの文で片方ずつ書き換えれば、トリガーはもう片方の現在の値から本文を求められる。
+# 書き込みはsplit_body()で分けた値をnotesに書いてから、store_body()でnote_bodiesを書く。
+
+def note_text_sql(alias):
+    """aliasのメモ (n, old, newなど) の本文を返すSQL式です。"""
+    return (f"CASE WHEN {alias}.content <> '' THEN {alias}.content ELSE COALESCE("
+            f"(SELECT inflate_body(b.body) FROM note_bodies b WHERE b.note_id = {alias}.id), '') END")
+
+def inflate_body(body):
+    return zlib.decompress(body).decode('utf-8')
+
+def split_body(content):
+    """本文を (notes.contentに置く値, notes.previewに置く値, store_body()に渡す値) に分けます。"""
+    if BODY_COMPRESS_MIN_BYTES is not None and isinstance(content, str):
+        raw = content.encode('utf-8')
+        if len(raw) >= BODY_COMPRESS_MIN_BYTES:
+            return '', content[:NOTE_PREVIEW_LENGTH], (len(raw), zlib.compress(raw, BODY_COMPRESS_LEVEL))
+    return content, None, None
+
+def store_body(cursor, note_id, body):
+    """split_body()で分けた本文をnote_bodiesに書き込みます (Noneなら圧縮した本文を削除)。notesを書いた後に呼ぶ。"""
+    if body is None:
+        cursor.execute("DELETE FROM note_bodies WHERE note_id = ?", (note_id,))
+    else:
+        cursor.execute('''
+            INSERT INTO note_bodies (note_id, size, body) VALUES (?, ?, ?)
+            ON CONFLICT (note_id) DO UPDATE SET size = excluded.size, body = excluded.body
+        ''', (note_id, *body))
+
+def create_note_bodies(cursor):
+    # メモの削除ではnotes_fts_deleteトリガーが本文をインデックスから消してから行を削除する
+    # (外部キーのCASCADEではトリガーとの順序が決まらないため使わない)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS note_bodies (
+        note_id INTEGER PRIMARY KEY,
+        size INTEGER NOT NULL,
+        body BLOB NOT NULL
+    )
+    ''')
+    # 全文検索インデックスを作り直すときに読むメモの本文
+    cursor.execute(f"CREATE VIEW IF NOT EXISTS note_texts AS SELECT n.id, n.title, {note_text_sql('n')} AS content FROM notes n")
+
+FTS_TRIGGERS = ('notes_fts_insert', 'notes_fts_delete', 'notes_fts_update',
+                'note_bodies_fts_insert', 'note_bodies_fts_update', 'note_bodies_fts_delete')
+
+def create_fts(cursor):
+    """メモの全文検索インデックス(notes_fts)と同期用トリガーを作成します。"""
+    create_note_bodies(cursor)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+    if cursor.fetchone() is None:
+        # 本文はnote_textsビューを参照する外部コンテンツ型のFTS5テーブル
+        cursor.execute(f'''
+        CREATE VIRTUAL TABLE notes_fts USING fts5(
+            title, content,
+            content = 'note_texts', content_rowid = 'id',
+            tokenize = '{FTS_TOKENIZER}'
+        )
+        ''')
+        # 既存のメモをインデックスに取り込む
+        cursor.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+
+    # notesの変更をnotes_ftsに反映するトリガー
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts (rowid, title, content) VALUES (new.id, new.title, {note_text_sql('new')});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, {note_text_sql('old')});
+        DELETE FROM note_bodies WHERE note_id = old.id;
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content ON notes
+    WHEN new.title IS NOT old.title OR new.content IS NOT old.content BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, {note_text_sql('old')});
+        INSERT INTO notes_fts (rowid, title, content) VALUES (new.id, new.title, {note_text_sql('new')});
+    END
+    ''')
+    # note_bodiesの変更は、notes.contentが空 (圧縮した本文が使われる) のときだけ本文を変える
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS note_bodies_fts_insert AFTER INSERT ON note_bodies
+    WHEN (SELECT content FROM notes WHERE id = new.note_id) = '' BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, title, content)
+        SELECT 'delete', id, title, '' FROM notes WHERE id = new.note_id;
+        INSERT INTO notes_fts (rowid, title, content)
+        SELECT id, title, inflate_body(new.body) FROM notes WHERE id = new.note_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS note_bodies_fts_update AFTER UPDATE OF body ON note_bodies
+    WHEN (SELECT content FROM notes WHERE id = new.note_id) = '' BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, title, content)
+        SELECT 'delete', id, title, inflate_body(old.body) FROM notes WHERE id = new.note_id;
+        INSERT INTO notes_fts (rowid, title, content)
+        SELECT id, title, inflate_body(new.body) FROM notes WHERE id = new.note_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS note_bodies_fts_delete AFTER DELETE ON note_bodies
+    WHEN (SELECT content FROM notes WHERE id = old.note_id) = '' BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, title, content)
+        SELECT 'delete', id, title, inflate_body(old.body) FROM notes WHERE id = old.note_id;
+        INSERT INTO notes_fts (rowid, title, content)
+        SELECT id, title, '' FROM notes WHERE id = old.note_id;
+    END
+    ''')
+
+def sync_body_storage(cursor):
+    """BODY_COMPRESS_MIN_BYTESに合わせて既存の本文を圧縮・展開し、(圧縮した件数, 展開した件数) を返します。
+
+    置き場所を変えるだけでメモの本文は変わらないので、全文検索インデックス・バージョン・変更履歴の
+    トリガーは止めておく。
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_bodies'")
+    if cursor.fetchone() is None:
+        return 0, 0 # マイグレーション適用前
+    threshold = BODY_COMPRESS_MIN_BYTES
+    if threshold is None:
+        cursor.execute("SELECT note_id FROM note_bodies")
+    else:
+        cursor.execute("SELECT note_id FROM note_bodies WHERE size < ?", (threshold,))
+    expand_ids = [row[0] for row in cursor.fetchall()]
+    compress_ids = []
+    if threshold is not None:
+        cursor.execute("SELECT id FROM notes WHERE length(CAST(content AS BLOB)) >= ?", (threshold,))
+        compress_ids = [row[0] for row in cursor.fetchall()]
+    if not expand_ids and not compress_ids:
+        return 0, 0
+
+    for name in ('notes_fts_update', 'notes_version', 'changes_note_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    for note_id in expand_ids:
+        cursor.execute(f"UPDATE notes SET content = {note_text_sql('notes')}, preview = NULL WHERE id = ?", (note_id,))
+        cursor.execute("DELETE FROM note_bodies WHERE note_id = ?", (note_id,))
+    for note_id in compress_ids:
+        cursor.execute("SELECT content FROM notes WHERE id = ?", (note_id,))
+        content, preview, body = split_body(cursor.fetchone()[0])
+        # 本文が変わらないよう、notes.contentを空にする前に圧縮した本文を置く
+        store_body(cursor, note_id, body)
+        cursor.execute("UPDATE notes SET content = ?, preview = ? WHERE id = ?", (content, preview, note_id))
+    create_fts(cursor)
+    create_note_version_trigger(cursor)
+    create_change_triggers(cursor)
+    return len(compress_ids), len(expand_ids)
+
+def sync_fts_tokenizer(cursor):
+    """FTS_TOKENIZERの設定が変わっていれば全文検索インデックスを作り直します。"""
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+    row = cursor.fetchone()
+    if row and f"tokenize = '{FTS_TOKENIZER}'" not in row['sql']:
+        cursor.execute("DROP TABLE notes_fts")
+        create_fts(cursor)
+
+# --- タグごとのメモ数 (tags.memo_count) ---
+# note_tagsとnotesのトリガーで増減させ、一覧表示のたびに集計しないようにする
+
+def create_tag_count_triggers(cursor):
+    """TAG_COUNT_EXCLUDES_TRASHEDに応じたmemo_count更新用のトリガーを作成します。"""
+    if not TAG_COUNT_EXCLUDES_TRASHED:
+        # メモ削除時はON DELETE CASCADEでnote_tagsが消えるため、note_tagsのトリガーだけで足りる
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS tag_count_insert AFTER INSERT ON note_tags BEGIN
+            UPDATE tags SET memo_count = memo_count + 1 WHERE id = new.tag_id;
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS tag_count_delete AFTER DELETE ON note_tags BEGIN
+            UPDATE tags SET memo_count = memo_count - 1 WHERE id = old.tag_id;
+        END
+        ''')
+        return
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS tag_count_insert AFTER INSERT ON note_tags
+    WHEN (SELECT is_trashed FROM notes WHERE id = new.note_id) = 0 BEGIN
+        UPDATE tags SET memo_count = memo_count + 1 WHERE id = new.tag_id;
+    END
+    ''')
+    # CASCADEでnote_tagsが消えるときには親のメモは既に削除済みなので、ここでは数えない
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS tag_count_delete AFTER DELETE ON note_tags
+    WHEN (SELECT is_trashed FROM notes WHERE id = old.note_id) = 0 BEGIN
+        UPDATE tags SET memo_count = memo_count - 1 WHERE id = old.tag_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS tag_count_note_delete BEFORE DELETE ON notes
+    WHEN old.is_trashed = 0 BEGIN
+        UPDATE tags SET memo_count = memo_count - 1
+        WHERE id IN (SELECT tag_id FROM note_tags WHERE note_id = old.id);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS tag_count_trash AFTER UPDATE OF is_trashed ON notes
+    WHEN old.is_trashed != new.is_trashed BEGIN
+        UPDATE tags SET memo_count = memo_count + (CASE WHEN new.is_trashed THEN -1 ELSE 1 END)
+        WHERE id IN (SELECT tag_id FROM note_tags WHERE note_id = new.id);
+    END
+    ''')
+
+def drop_tag_count_triggers(cursor):
+    for name in ('tag_count_insert', 'tag_count_delete', 'tag_count_note_delete', 'tag_count_trash'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def recount_tags(cursor):
+    """tags.memo_countをnote_tagsから数え直します。"""
+    trashed_filter = "AND n.is_trashed = 0" if TAG_COUNT_EXCLUDES_TRASHED else ""
+    cursor.execute(f'''
+    UPDATE tags SET memo_count = (
+        SELECT COUNT(*) FROM note_tags nt
+        JOIN notes n ON n.id = nt.note_id {trashed_filter}
+        WHERE nt.tag_id = tags.id
+    )
+    ''')
+
+def sync_tag_count_mode(cursor):
+    """TAG_COUNT_EXCLUDES_TRASHEDの設定が変わっていればトリガーを作り直して数え直します。"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'tag_count_insert'")
+    if cursor.fetchone() is None:
+        return # マイグレーション適用前
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'tag_count_trash'")
+    if (cursor.fetchone() is not None) != TAG_COUNT_EXCLUDES_TRASHED:
+        drop_tag_count_triggers(cursor)
+        create_tag_count_triggers(cursor)
+        recount_tags(cursor)
+
+# --- メモ数の集計 (counters) ---
+# 一覧の総件数 (ゴミ箱外・ゴミ箱内) をトリガーで増減させ、ページごとにCOUNTしないようにする
+NOTE_COUNTERS = {0: 'notes_active', 1: 'notes_trashed'} # is_trashed -> countersの名前
+
+def create_note_count_triggers(cursor):
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS note_count_insert AFTER INSERT ON notes BEGIN
+        UPDATE counters SET value = value + 1
+        WHERE name = CASE WHEN new.is_trashed THEN 'notes_trashed' ELSE 'notes_active' END;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS note_count_delete AFTER DELETE ON notes BEGIN
+        UPDATE counters SET value = value - 1
+        WHERE name = CASE WHEN old.is_trashed THEN 'notes_trashed' ELSE 'notes_active' END;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS note_count_trash AFTER UPDATE OF is_trashed ON notes
+    WHEN old.is_trashed != new.is_trashed BEGIN
+        UPDATE counters SET value = value - 1
+        WHERE name = CASE WHEN old.is_trashed THEN 'notes_trashed' ELSE 'notes_active' END;
+        UPDATE counters SET value = value + 1
+        WHERE name = CASE WHEN new.is_trashed THEN 'notes_trashed' ELSE 'notes_active' END;
+    END
+    ''')
+
+def drop_note_count_triggers(cursor):
+    for name in ('note_count_insert', 'note_count_delete', 'note_count_trash'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def recount_notes(cursor):
+    """countersのメモ数をnotesから数え直します。"""
+    cursor.execute('''
+    INSERT OR REPLACE INTO counters (name, value)
+    SELECT 'notes_active', COUNT(*) FROM notes WHERE is_trashed = 0
+    UNION ALL
+    SELECT 'notes_trashed', COUNT(*) FROM notes WHERE is_trashed != 0
+    ''')
+
+# --- 変更履歴 (changes) ---
+# notes・tags・note_tagsの変更をトリガーで記録し、連番 (seq) 以降の差分をクライアントに返せるようにする。
+# kindは 'note' (メモ本体かそのタグが変わった)、'tag'、'reset' (一括取り込みなどで差分を追えない)。
+CHANGE_TRIGGERS = {
+    'changes_note_insert': "AFTER INSERT ON notes BEGIN INSERT INTO changes (kind, item_id) VALUES ('note', new.id);",
+    # バージョンとハッシュだけの更新 (notes_versionトリガー) は記録しない
+    'changes_note_update': '''AFTER UPDATE OF title, content, updated_at, is_trashed ON notes BEGIN
+        INSERT INTO changes (kind, item_id) VALUES ('note', new.id);''',
+    'changes_note_delete': "AFTER DELETE ON notes BEGIN INSERT INTO changes (kind, item_id) VALUES ('note', old.id);",
+    'changes_note_tag_insert': "AFTER INSERT ON note_tags BEGIN INSERT INTO changes (kind, item_id) VALUES ('note', new.note_id);",
+    'changes_note_tag_delete': "AFTER DELETE ON note_tags BEGIN INSERT INTO changes (kind, item_id) VALUES ('note', old.note_id);",
+    'changes_tag_insert': "AFTER INSERT ON tags BEGIN INSERT INTO changes (kind, item_id) VALUES ('tag', new.id);",
+    'changes_tag_update': "AFTER UPDATE ON tags BEGIN INSERT INTO changes (kind, item_id) VALUES ('tag', new.id);",
+    'changes_tag_delete': "AFTER DELETE ON tags BEGIN INSERT INTO changes (kind, item_id) VALUES ('tag', old.id);",
+}
+
+def create_change_triggers(cursor):
+    for name, body in CHANGE_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body} END")
+    # 履歴はCHANGE_LOG_KEEP件だけ残す
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS changes_prune AFTER INSERT ON changes
+    WHEN new.seq % {CHANGE_LOG_PRUNE_EVERY} = 0 BEGIN
+        DELETE FROM changes WHERE seq <= new.seq - {CHANGE_LOG_KEEP};
+    END
+    ''')
+
+def drop_change_triggers(cursor):
+    for name in list(CHANGE_TRIGGERS) + ['changes_prune']:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def record_change_reset(cursor):
+    """差分では追えない変更があったことを記録します。以前の位置から同期するクライアントは全件を取り直す。"""
+    cursor.execute("INSERT INTO changes (kind, item_id) VALUES ('reset', 0)")
+
+def sync_change_log_retention(cursor):
+    """CHANGE_LOG_KEEPなどの設定が変わっていれば履歴削除用のトリガーを作り直します。"""
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'changes_prune'")
+    row = cursor.fetchone()
+    if row is None:
+        return # マイグレーション適用前
+    if f"% {CHANGE_LOG_PRUNE_EVERY} = 0" not in row['sql'] or f"new.seq - {CHANGE_LOG_KEEP};" not in row['sql']:
+        cursor.execute("DROP TRIGGER changes_prune")
+        create_change_triggers(cursor)
+
+# --- ゴミ箱に入れた日時 (notes.trashed_at) と完全削除の状態 (trash_purge) ---
+# 日時はアプリのdatetime.now().isoformat()と文字列で比較できる形式にする
+NOW_SQL = "strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')"
+
+def create_trashed_at_triggers(cursor):
+    """is_trashedの変更に合わせてtrashed_atを記録・消去するトリガーを作成します。"""
+    # trashed_atだけの更新では他のトリガー (UPDATE OF title, content, ...) は動かない
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS notes_trashed_at AFTER UPDATE OF is_trashed ON notes
+    WHEN old.is_trashed != new.is_trashed BEGIN
+        UPDATE notes SET trashed_at = CASE WHEN new.is_trashed THEN {NOW_SQL} END WHERE id = new.id;
+    END
+    ''')
+    # ゴミ箱に入ったまま取り込まれたメモ
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS notes_trashed_at_insert AFTER INSERT ON notes
+    WHEN new.is_trashed AND new.trashed_at IS NULL BEGIN
+        UPDATE notes SET trashed_at = {NOW_SQL} WHERE id = new.id;
+    END
+    ''')
+
+def prepare_new_database():
+    """まだ空のDBファイルなら、WALに切り替える前にauto_vacuumを設定します。
+
+    auto_vacuumの設定は書き込みロックを取るため、接続ごとには行わない。
+    既存のDBではsync_auto_vacuum()が切り替える。
+    """
+    conn = sqlite3.connect(DATABASE_NAME)
+    try:
+        if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+            conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM}")
+            conn.execute("PRAGMA journal_mode = WAL") # ここでファイルのヘッダーが書かれ、設定が残る
+    finally:
+        conn.close()
+
+def sync_auto_vacuum(conn):
+    """DBのauto_vacuumがAUTO_VACUUMと違えば、VACUUMでファイルを作り直して切り替えます。
+
+    トランザクションの外で呼ぶ。切り替えた場合はTrueを返す。
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_MODES[AUTO_VACUUM]:
+        return False
+    conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM}")
+    conn.execute("VACUUM")
+    return True
+
+# --- 一括取り込み用のトリガー停止 ---
+# 大量のINSERTでは行ごとのトリガーより、最後にまとめて作り直すほうが速い。
+# 停止から再開までは1つのトランザクション内で行い、他の接続からトリガーのない状態が見えないようにする。
+# 変更履歴は1行ずつ残さず、再開時に 'reset' を1件だけ記録する。
+
+def suspend_index_triggers(cursor):
+    """全文検索インデックス・tags.memo_count・counters・changesを更新するトリガーを削除します。"""
+    for name in FTS_TRIGGERS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    drop_tag_count_triggers(cursor)
+    drop_note_count_triggers(cursor)
+    drop_change_triggers(cursor)
+
+def resume_index_triggers(cursor):
+    """トリガーを作り直し、全文検索インデックス・tags.memo_count・countersを再構築します。"""
+    create_fts(cursor)
+    cursor.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+    create_tag_count_triggers(cursor)
+    recount_tags(cursor)
+    create_note_count_triggers(cursor)
+    recount_notes(cursor)
+    create_change_triggers(cursor)
+    record_change_reset(cursor)
+
+# --- スキーママイグレーション ---
+# 適用済みのバージョンは PRAGMA user_version に記録する。
+# 各ステップは既存のDBに同じオブジェクトがあっても失敗しないよう冪等に書く。
+
+def _create_indexes(cursor):
+    # 一覧・ページング・タグ集計で使うインデックス
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_trashed_updated ON notes (is_trashed, updated_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_tags_tag ON note_tags (tag_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_favorite_name ON tags (is_favorite, name)")
+
+def _analyze(cursor):
+    # クエリプランナがインデックスを選べるよう統計情報を集める
+    cursor.execute("ANALYZE")
+
+def _add_tag_memo_count(cursor):
+    cursor.execute("PRAGMA table_info(tags)")
+    if 'memo_count' not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE tags ADD COLUMN memo_count INTEGER NOT NULL DEFAULT 0")
+    drop_tag_count_triggers(cursor)
+    create_tag_count_triggers(cursor)
+    recount_tags(cursor)
+    # 「その他のタグ」一覧 (memo_count降順、名前昇順) をインデックスだけで返せるようにする
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_favorite_count ON tags (is_favorite, memo_count DESC, name)")
+
+def _create_fts_vocab(cursor):
+    # 検索条件の絞り込み効果を見積もるための語彙統計 (語ごとの出現メモ数)
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts_vocab USING fts5vocab(notes_fts, 'row')")
+
+def _add_note_version(cursor):
+    # 条件付き保存 (If-Match) 用のバージョンと、無変更の保存を省くための本文ハッシュ
+    cursor.execute("PRAGMA table_info(notes)")
+    columns = [row['name'] for row in cursor.fetchall()]
+    if 'version' not in columns:
+        cursor.execute("ALTER TABLE notes ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    if 'content_hash' not in columns:
+        cursor.execute("ALTER TABLE notes ADD COLUMN content_hash TEXT")
+    create_note_version_trigger(cursor)
+
+def create_note_version_trigger(cursor):
+    # タイトル・本文が書き換わるたびにバージョンを上げる。
+    # ハッシュを一緒に更新しなかった書き込み (一括操作など) ではハッシュを未計算 (NULL) に戻す。
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_version AFTER UPDATE OF title, content ON notes BEGIN
+            UPDATE notes SET
+                version = old.version + 1,
+                content_hash = CASE
+                    WHEN new.content IS NOT old.content AND new.content_hash IS old.content_hash THEN NULL
+                    ELSE new.content_hash
+                END
+            WHERE id = new.id;
+        END
+    """)
+
+def _create_counters(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    drop_note_count_triggers(cursor)
+    create_note_count_triggers(cursor)
+    recount_notes(cursor)
+
+def _create_changes(cursor):
+    # AUTOINCREMENTにして、古い履歴を削除してもseqが再利用されないようにする
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        item_id INTEGER NOT NULL
+    )
+    ''')
+    create_change_triggers(cursor)
+
+def _add_trash_purge(cursor):
+    cursor.execute("PRAGMA table_info(notes)")
+    if 'trashed_at' not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE notes ADD COLUMN trashed_at TEXT")
+    # 既にゴミ箱にあるメモは捨てた日時が分からないので、移行した日時から保存期間を数える
+    cursor.execute(f"UPDATE notes SET trashed_at = {NOW_SQL} WHERE is_trashed = 1 AND trashed_at IS NULL")
+    create_trashed_at_triggers(cursor)
+    # 期限切れ・削除対象のメモを古い順に少しずつ取り出すための部分インデックス
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_trash_purge ON notes (trashed_at) WHERE is_trashed = 1")
+    # 1行だけのテーブル。requested_atは「ゴミ箱を空にする」を受け付けた日時 (完了したらNULL)。
+    # その時点でゴミ箱にあったメモ (trashed_at <= requested_at) を削除する
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS trash_purge (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        requested_at TEXT,
+        requested_total INTEGER NOT NULL DEFAULT 0,
+        purged_total INTEGER NOT NULL DEFAULT 0,
+        vacuumed_pages INTEGER NOT NULL DEFAULT 0,
+        last_purge_at TEXT
+    )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO trash_purge (id) VALUES (1)")
+
+def _add_note_bodies(cursor):
+    cursor.execute("PRAGMA table_info(notes)")
+    if 'preview' not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE notes ADD COLUMN preview TEXT")
+    # 全文検索インデックスの参照先をnotesからnote_textsビューに替えて作り直す
+    # (本文の圧縮は、この後の起動時の確認 sync_body_storage() で行う)
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+    row = cursor.fetchone()
+    if row is not None and "content = 'note_texts'" not in row['sql']:
+        for name in FTS_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute("DROP TABLE notes_fts")
+    create_fts(cursor)
+
+MIGRATIONS = [
+    (1, 'create list/tag indexes', _create_indexes),
+    (2, 'analyze', _analyze),
+    (3, 'create notes_fts full-text index', create_fts),
+    (4, 'add tags.memo_count maintained by triggers', _add_tag_memo_count),
+    (5, 'create notes_fts_vocab statistics table', _create_fts_vocab),
+    (6, 'add notes.version and notes.content_hash', _add_note_version),
+    (7, 'create counters table for note totals', _create_counters),
+    (8, 'create changes table maintained by triggers', _create_changes),
+    (9, 'add notes.trashed_at and trash_purge state', _add_trash_purge),
+    (10, 'add note_bodies for compressed bodies and notes.preview', _add_note_bodies),
+]
+
+def get_schema_version(conn):
+    """DBに適用済みのスキーマバージョンを返します。"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def pending_migrations(conn):
+    """未適用のマイグレーションを (バージョン, 説明) のリストで返します。"""
+    current = get_schema_version(conn)
+    return [(version, description) for version, description, _ in MIGRATIONS if version > current]
+
+def migrate(conn, dry_run=False):
+    """未適用のマイグレーションを順に、1つずつトランザクション内で適用します。
+
+    適用した (dry_runの場合は適用予定の) マイグレーションのリストを返します。
+    """
+    if dry_run:
+        return pending_migrations(conn)
+
+    applied = []
+    cursor = conn.cursor()
+    for version, description, step in MIGRATIONS:
+        # 複数プロセスが同時に起動しても二重に適用しないよう、ロックを取ってから確認する
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            step(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((version, description))
+    return applied
+
 if __name__ == '__main__':
-    init_db() # スクリプトとして直接実行された場合にDBを初期化
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description='メモDBの初期化とマイグレーション')
+    parser.add_argument('--dry-run', action='store_true', help='適用せずに未適用のマイグレーションを表示する')
+    args = parser.parse_args()
+
+    if args.dry_run:
+        conn = get_db_connection()
+        print(f"Schema version: {get_schema_version(conn)} (latest: {MIGRATIONS[-1][0]})")
+        for version, description in migrate(conn, dry_run=True):
+            print(f"Pending migration {version}: {description}")
+        conn.close()
+    else:
+        init_db() # スクリプトとして直接実行された場合にDBを初期化
@@ -1,175 +1,2445 @@
 # main.py
+import base64
+import bisect
+import collections
+import contextlib
+import gzip
+import hashlib
+import heapq
 import http.server
 import socketserver
 import json
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timedelta
 import math
+import multiprocessing
+import os
+import queue
+import signal
 import sqlite3
 import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 import database
+import metrics
 
 PORT = 8000
 DB_NAME = database.DATABASE_NAME
 
 # --- クエリ文字列をパースしてASTに変換する簡易パーサ ---
+# 長いクエリの貼り付けや深い入れ子で処理が重くならないよう上限を設ける
+MAX_QUERY_LENGTH = 2000
+MAX_QUERY_TOKENS = 256
+MAX_QUERY_DEPTH = 32
+
 def tokenize(query):
+    """クエリ文字列をトークンのリストに分割します。文字列は1回だけ走査します。"""
     tokens = []
-    token = ''
+    parts = [] # 現在のトークンを構成する部分文字列
     in_quotes = False
     i = 0
-    while i < len(query):
+    length = len(query)
+    while i < length:
         char = query[i]
         if char == '"':
             in_quotes = not in_quotes
             if not in_quotes:
-                tokens.append(token.strip())
-                token = ''
+                tokens.append(''.join(parts).strip())
+                parts = []
             i += 1
-            continue
-        if in_quotes:
-            token += char
+        elif in_quotes:
+            # 閉じ引用符までをまとめて取り込む
+            end = query.find('"', i)
+            if end < 0:
+                end = length
+            parts.append(query[i:end])
+            i = end
         elif char in '()':
-            if token:
-                tokens.append(token.strip())
-                token = ''
+            if parts:
+                tokens.append(''.join(parts).strip())
+                parts = []
             tokens.append(char)
+            i += 1
         elif char.isspace():
-            if token:
-                tokens.append(token.strip())
-                token = ''
+            if parts:
+                tokens.append(''.join(parts).strip())
+                parts = []
+            i += 1
         else:
-            token += char
-        i += 1
-    if token:
-        tokens.append(token.strip())
+            # 区切り文字 (空白、括弧、引用符) の手前までをまとめて取り込む
+            end = i + 1
+            while end < length and query[end] not in '()"' and not query[end].isspace():
+                end += 1
+            parts.append(query[i:end])
+            i = end
+    if parts:
+        tokens.append(''.join(parts).strip())
     return tokens
 
 def parse_expression(tokens):
-    def parse_operand():
-        token = tokens.pop(0)
+    """トークン列を再帰下降でASTに変換します。tokensは変更せず位置だけを進めます。"""
+    pos = 0
+
+    def next_token():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError("Unexpected end of query")
+        token = tokens[pos]
+        pos += 1
+        return token
+
+    def next_token_if(expected):
+        nonlocal pos
+        if pos < len(tokens) and tokens[pos] == expected:
+            pos += 1
+            return expected
+        return None
+
+    def peek_keyword():
+        return tokens[pos].upper() if pos < len(tokens) else None
+
+    def parse_operand(depth):
+        if depth > MAX_QUERY_DEPTH:
+            raise ValueError("Query is nested too deeply")
+        token = next_token()
         if token == '(':
-            expr = parse_expression(tokens)
-            if not tokens or tokens.pop(0) != ')':
+            expr = parse_or(depth + 1)
+            if next_token_if(')') is None:
                 raise ValueError("Mismatched parenthesis")
             return expr
         elif token.upper() == 'NOT' or token == '-':
-            return ('NOT', parse_operand())
+            return ('NOT', parse_operand(depth + 1))
         else:
             return token
 
-    def parse_and():
-        left = parse_operand()
-        while tokens and tokens[0].upper() == 'AND':
-            tokens.pop(0)
-            right = parse_operand()
+    def parse_and(depth):
+        nonlocal pos
+        left = parse_operand(depth)
+        while peek_keyword() == 'AND':
+            pos += 1
+            right = parse_operand(depth)
             left = ('AND', left, right)
         return left
 
-    def parse_or():
-        left = parse_and()
-        while tokens and tokens[0].upper() == 'OR':
-            tokens.pop(0)
-            right = parse_and()
+    def parse_or(depth):
+        nonlocal pos
+        left = parse_and(depth)
+        while peek_keyword() == 'OR':
+            pos += 1
+            right = parse_and(depth)
             left = ('OR', left, right)
         return left
 
-    return parse_or()
+    return parse_or(0)
 
 def parse_query(query):
+    if len(query) > MAX_QUERY_LENGTH:
+        raise ValueError(f"Query is too long (max {MAX_QUERY_LENGTH} characters)")
     tokens = tokenize(query)
     if not tokens:
         return None
+    if len(tokens) > MAX_QUERY_TOKENS:
+        raise ValueError(f"Query has too many terms (max {MAX_QUERY_TOKENS} tokens)")
     return parse_expression(tokens)
 
+# --- 検索ASTの最適化 ---
+# parse_queryの結果を、build_sqlの前に次の順で変形する
+#  1. NOTを葉まで押し下げ (ド・モルガン)、AND/ORの連鎖を多項ノードに平坦化して重複を除く
+#  2. 同じAND/ORの直下にある複数の@tags:を1回のnote_tags検索 ('TAGS'ノード) にまとめる
+#  3. ANDの子は安く絞り込みの強い順に、ORの子は安く一致しやすい順に並べる
+# 'TAGS'ノードは ('TAGS', 'ALL' または 'ANY', (タグ名, ...)) の形をとる
+
+# 1行あたりの評価コストの目安 (タグ検索を1とした相対値)
+TAG_COST = 1
+FTS_COST = 2
+LIKE_COST = 20
+
+def is_tag_operand(node):
+    return isinstance(node, str) and node.startswith('@tags:')
+
+def normalize_ast(ast, negate=False):
+    """NOTを葉まで押し下げ、AND/ORを平坦化した多項のASTを返します。"""
+    if isinstance(ast, str):
+        return ('NOT', ast) if negate else ast
+    op = ast[0]
+    if op == 'NOT':
+        return normalize_ast(ast[1], not negate)
+    if op not in ('AND', 'OR'):
+        raise ValueError("Invalid AST node")
+    if negate:
+        op = 'OR' if op == 'AND' else 'AND'
+    children = []
+    for child in ast[1:]:
+        child = normalize_ast(child, negate)
+        if isinstance(child, tuple) and child[0] == op:
+            children.extend(child[1:])
+        else:
+            children.append(child)
+    children = list(dict.fromkeys(children)) # 重複した条件を除く (順序は保つ)
+    if len(children) == 1:
+        return children[0]
+    return (op, *children)
+
+def collapse_tags(ast):
+    """AND/ORの直下にある複数の@tags:をTAGSノードにまとめます。"""
+    if isinstance(ast, str) or ast[0] not in ('AND', 'OR'):
+        return ast
+    op = ast[0]
+    children = [collapse_tags(child) for child in ast[1:]]
+    tag_names = [child[len('@tags:'):] for child in children if is_tag_operand(child)]
+    if len(tag_names) >= 2:
+        mode = 'ALL' if op == 'AND' else 'ANY'
+        tags_node = ('TAGS', mode, tuple(dict.fromkeys(tag_names)))
+        children = [tags_node] + [child for child in children if not is_tag_operand(child)]
+    if len(children) == 1:
+        return children[0]
+    return (op, *children)
+
+class SelectivityEstimator:
+    """条件に一致するメモの割合を、タグのメモ数と全文検索インデックスの語彙統計から見積もります。"""
+    DEFAULT_FRACTION = 0.2
+    MAX_TRIGRAMS = 8 # 1語あたりに調べるトライグラムの上限
+
+    def __init__(self, cursor=None):
+        self.cursor = cursor
+        self._total_notes = None
+
+    def total_notes(self):
+        if self._total_notes is None:
+            # COUNT(*)は全件走査になるため、AUTOINCREMENTのIDの最大値で代用する
+            self.cursor.execute("SELECT MAX(id) FROM notes")
+            self._total_notes = self.cursor.fetchone()[0] or 0
+        return self._total_notes
+
+    def _fraction(self, count):
+        total = self.total_notes()
+        return min(1.0, count / total) if total else self.DEFAULT_FRACTION
+
+    def tag_fraction(self, name):
+        if self.cursor is None:
+            return self.DEFAULT_FRACTION
+        self.cursor.execute("SELECT memo_count FROM tags WHERE name = ?", (name,))
+        row = self.cursor.fetchone()
+        return self._fraction(row[0] if row else 0)
+
+    def term_fraction(self, term):
+        if self.cursor is None:
+            return self.DEFAULT_FRACTION
+        term = term.lower()
+        try:
+            if database.FTS_TOKENIZER == 'trigram':
+                # 語を含むメモの数は、語に含まれるどのトライグラムの出現メモ数よりも少ない
+                trigrams = list(dict.fromkeys(term[i:i + 3] for i in range(len(term) - 2)))
+                count = None
+                for trigram in trigrams[:self.MAX_TRIGRAMS]:
+                    self.cursor.execute("SELECT doc FROM notes_fts_vocab WHERE term = ?", (trigram,))
+                    row = self.cursor.fetchone()
+                    doc = row[0] if row else 0
+                    count = doc if count is None else min(count, doc)
+                    if count == 0:
+                        break
+            else:
+                # 前方一致なので、その語で始まる語彙の出現メモ数を合計する
+                prefix = term.split()[0] if term.split() else term
+                self.cursor.execute(
+                    "SELECT COALESCE(SUM(doc), 0) FROM notes_fts_vocab WHERE term >= ? AND term < ?",
+                    (prefix, prefix + '\U0010ffff'))
+                count = self.cursor.fetchone()[0]
+        except sqlite3.Error:
+            return self.DEFAULT_FRACTION
+        return self._fraction(count or 0)
+
+def _estimate_and_order(ast, estimator):
+    """ASTの子を並べ替え、(並べ替えたAST, 一致割合, 1行あたりのコスト) を返します。"""
+    if isinstance(ast, str):
+        if is_tag_operand(ast):
+            return ast, estimator.tag_fraction(ast[len('@tags:'):]), TAG_COST
+        operand = fts_operand(ast)
+        if operand is None:
+            return ast, estimator.DEFAULT_FRACTION, LIKE_COST
+        return ast, estimator.term_fraction(operand[1]), FTS_COST
+
+    op = ast[0]
+    if op == 'TAGS':
+        fractions = [estimator.tag_fraction(name) for name in ast[2]]
+        if ast[1] == 'ALL':
+            return ast, math.prod(fractions), TAG_COST
+        return ast, min(1.0, sum(fractions)), TAG_COST
+    if op == 'NOT':
+        child, fraction, cost = _estimate_and_order(ast[1], estimator)
+        return ('NOT', child), 1.0 - fraction, cost
+
+    estimated = [_estimate_and_order(child, estimator) for child in ast[1:]]
+    if op == 'AND':
+        # 評価を打ち切れる確率 (1 - 一致割合) あたりのコストが小さいものを先に評価する
+        estimated.sort(key=lambda e: e[2] / (1.0 - e[1]) if e[1] < 1.0 else math.inf)
+        remaining = 1.0 # ここまでの条件をすべて満たす割合
+        total_cost = 0.0
+        for _, fraction, cost in estimated:
+            total_cost += remaining * cost
+            remaining *= fraction
+        return ('AND', *(e[0] for e in estimated)), remaining, total_cost
+    # OR: 一致する確率あたりのコストが小さいものを先に評価する
+    estimated.sort(key=lambda e: e[2] / e[1] if e[1] > 0.0 else math.inf)
+    unmatched = 1.0 # ここまでのどの条件にも一致しない割合
+    total_cost = 0.0
+    for _, fraction, cost in estimated:
+        total_cost += unmatched * cost
+        unmatched *= 1.0 - fraction
+    return ('OR', *(e[0] for e in estimated)), 1.0 - unmatched, total_cost
+
+def optimize_query(ast, estimator=None):
+    """build_sqlに渡す前に検索ASTを簡約し、条件の評価順を並べ替えます。"""
+    ast = collapse_tags(normalize_ast(ast))
+    optimized, _, _ = _estimate_and_order(ast, estimator or SelectivityEstimator())
+    return optimized
+
+# --- ASTからFTS5のMATCH式を生成 ---
+# trigramトークナイザは3文字未満の語を検索できないため、短い語はLIKE検索に回す
+FTS_MIN_TERM_LENGTH = 3 if database.FTS_TOKENIZER == 'trigram' else 1
+FTS_COLUMN_FILTERS = {'@title:': 'title', '@body:': 'content'}
+
+def fts_phrase(term):
+    """語をFTS5のフレーズ文字列に変換します。"""
+    phrase = '"' + term.replace('"', '""') + '"'
+    if database.FTS_TOKENIZER != 'trigram':
+        phrase += ' *' # 単語単位のトークナイザでは前方一致にする
+    return phrase
+
+def fts_operand(operand):
+    """オペランドを (列フィルタ, 語) に分解します。FTS5で検索できない場合はNoneを返します。"""
+    if operand.startswith('@tags:'):
+        return None
+    column_filter = '{title content}'
+    term = operand
+    for prefix, column in FTS_COLUMN_FILTERS.items():
+        if operand.startswith(prefix):
+            column_filter = column
+            term = operand[len(prefix):]
+            break
+    if len(term) < FTS_MIN_TERM_LENGTH:
+        return None
+    return column_filter, term
+
+def build_fts_match(ast):
+    """ASTをFTS5のMATCH式に変換します。変換できない部分木を含む場合はNoneを返します。"""
+    if isinstance(ast, str):
+        operand = fts_operand(ast)
+        if operand is None:
+            return None
+        column_filter, term = operand
+        return f"{column_filter} : {fts_phrase(term)}"
+
+    op = ast[0]
+    if op == 'OR':
+        matches = [build_fts_match(child) for child in ast[1:]]
+        if None in matches:
+            return None
+        return '(' + ' OR '.join(matches) + ')'
+    elif op == 'AND':
+        positives = []
+        negatives = []
+        for child in ast[1:]:
+            if isinstance(child, tuple) and child[0] == 'NOT':
+                negatives.append(build_fts_match(child[1]))
+            else:
+                positives.append(build_fts_match(child))
+        # FTS5のNOTは二項演算子 (A NOT B) なので、否定でない条件が1つは必要
+        if not positives or None in positives or None in negatives:
+            return None
+        match = '(' + ' AND '.join(positives) + ')'
+        for negative in negatives:
+            match = f"({match} NOT {negative})"
+        return match
+    # 単独のNOTとTAGSはFTS5で表現できない
+    return None
+
+def _is_fts_groupable(op, child):
+    if op == 'AND' and isinstance(child, tuple) and child[0] == 'NOT':
+        return build_fts_match(child[1]) is not None
+    return build_fts_match(child) is not None
+
 # --- ASTからSQL条件式とパラメータを生成 ---
 def build_sql(ast):
+    # 部分木全体をFTS5で評価できる場合は、1回のMATCHにまとめる
+    match = build_fts_match(ast)
+    if match is not None:
+        return "n.id IN (SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?)", [match]
+    # @tags:だけの部分木は、実行時にタグのインデックスで求めたメモIDの集合にする
+    if TAG_INDEX and is_tag_subtree(ast):
+        return TAG_FILTER_SQL, [TagFilter(ast)]
+
     if isinstance(ast, str):
+        # ここに来るのは@tags:か、FTS5で検索できない短い語
         if ast.startswith('@title:'):
             term = ast[len('@title:'):]
             return "n.title LIKE ?", [f"%{term}%"]
         elif ast.startswith('@body:'):
             term = ast[len('@body:'):]
-            return "n.content LIKE ?", [f"%{term}%"]
+            return f"{NOTE_TEXT_SQL} LIKE ?", [f"%{term}%"]
         elif ast.startswith('@tags:'):
             term = ast[len('@tags:'):]
             return f"EXISTS (SELECT 1 FROM note_tags nt JOIN tags t ON nt.tag_id = t.id WHERE nt.note_id = n.id AND t.name = ?)", [term]
         else:
-            return "(n.title LIKE ? OR n.content LIKE ?)", [f"%{ast}%", f"%{ast}%"]
+            return f"(n.title LIKE ? OR {NOTE_TEXT_SQL} LIKE ?)", [f"%{ast}%", f"%{ast}%"]
 
     op = ast[0]
-    if op == 'AND':
-        left_sql, left_params = build_sql(ast[1])
-        right_sql, right_params = build_sql(ast[2])
-        return f"({left_sql} AND {right_sql})", left_params + right_params
-    elif op == 'OR':
-        left_sql, left_params = build_sql(ast[1])
-        right_sql, right_params = build_sql(ast[2])
-        return f"({left_sql} OR {right_sql})", left_params + right_params
+    if op == 'TAGS':
+        # 複数タグの条件を1回のnote_tags検索で評価する (ALLは全タグを持つメモだけを残す)
+        _, mode, names = ast
+        placeholders = ', '.join('?' * len(names))
+        having = f" GROUP BY nt.note_id HAVING COUNT(*) = {len(names)}" if mode == 'ALL' else ""
+        return (f"n.id IN (SELECT nt.note_id FROM note_tags nt JOIN tags t ON nt.tag_id = t.id "
+                f"WHERE t.name IN ({placeholders}){having})"), list(names)
+    elif op in ('AND', 'OR'):
+        children = list(ast[1:])
+        # FTS5で評価できる子が複数あれば、最初の位置で1回のMATCHにまとめる
+        groupable = [i for i, child in enumerate(children) if _is_fts_groupable(op, child)]
+        # @tags:だけの子も、まとめて1回の集合演算で評価する
+        tag_children = [i for i, child in enumerate(children) if TAG_INDEX and is_tag_subtree(child)]
+        if len(tag_children) >= 2:
+            merged = (op, *(children[i] for i in tag_children))
+            children = [merged if i == tag_children[0] else child
+                        for i, child in enumerate(children) if i == tag_children[0] or i not in tag_children]
+            groupable = [i for i, child in enumerate(children) if _is_fts_groupable(op, child)]
+        if len(groupable) >= 2:
+            grouped = [children[i] for i in groupable]
+            if op == 'AND' and all(isinstance(child, tuple) and child[0] == 'NOT' for child in grouped):
+                # 否定だけのAND (NOT a AND NOT b) は NOT (a OR b) として1回のMATCHにする
+                merged = ('NOT', ('OR', *(child[1] for child in grouped)))
+            else:
+                merged = (op, *grouped)
+            children = [merged if i == groupable[0] else child
+                        for i, child in enumerate(children) if i == groupable[0] or i not in groupable]
+        if len(children) == 1:
+            return build_sql(children[0])
+        parts = [build_sql(child) for child in children]
+        condition_sql = '(' + f' {op} '.join(part_sql for part_sql, _ in parts) + ')'
+        return condition_sql, [param for _, part_params in parts for param in part_params]
     elif op == 'NOT':
         cond_sql, cond_params = build_sql(ast[1])
         return f"NOT ({cond_sql})", cond_params
     else:
         raise ValueError("Invalid AST node")
 
-
+# --- @tags:の条件をメモIDの集合で評価する ---
+# タグごとのメモIDの集合をゴミ箱の内外に分けてメモリに持ち、@tags:だけからなる部分木は集合演算で評価する。
+# メモごとにnote_tagsを引くEXISTSと違い、メモ数にもタグ条件の数にも比例しない。
+# インデックスは起動後の最初の検索で作り、以降はchangesテーブルの差分を取り込む。
+TAG_INDEX = True # Falseならタグ条件もSQL (EXISTS) で評価する
+# 一致するメモがこの割合 (1/n) より多ければ、IDからメモを引かずに更新日時の順に走査して所属を調べる
+TAG_INDEX_SCAN_RATIO = 50
+TAG_FILTER_SQL = "n.id IN (SELECT value FROM json_each(?))"
+TAG_FILTER_CACHE_SIZE = 256 # ページをめくるたびに集合演算をやり直さないよう、結果を世代ごとに覚えておく数
+
+def is_tag_subtree(ast):
+    """ASTが@tags:とTAGSノードだけからなるかを返します。"""
+    if isinstance(ast, str):
+        return is_tag_operand(ast)
+    if ast[0] == 'TAGS':
+        return True
+    return all(is_tag_subtree(child) for child in ast[1:])
+
+class TagFilter:
+    """build_sqlが@tags:の部分木の代わりにパラメータに置く値。実行時にメモIDのJSON配列に置き換える。"""
+    __slots__ = ('ast',)
+
+    def __init__(self, ast):
+        self.ast = ast
+
+    def __eq__(self, other):
+        return isinstance(other, TagFilter) and self.ast == other.ast
+
+    def __hash__(self):
+        return hash(self.ast)
+
+    def __repr__(self):
+        return f'TagFilter({self.ast!r})'
+
+class TagNoteIndex:
+    """タグID・ゴミ箱の内外ごとのメモIDの集合。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tag_ids = {} # タグ名 -> ID
+        self._tag_names = {} # ID -> タグ名
+        self._notes = collections.defaultdict(set) # (タグID, is_trashed) -> メモIDの集合
+        self._note_state = {} # メモID -> (is_trashed, タグIDの集合)
+        self._all = {0: set(), 1: set()} # is_trashed -> メモIDの集合 (NOTの補集合を取るため)
+        self._seq = None # 取り込み済みの変更のseq
+        self._generation = None
+        self._filters = {} # (AST, is_trashed, ordered) -> filter_sqlの結果
+        self.rebuilds = 0
+        self.updates = 0
+
+    def sync(self, cursor):
+        """データの世代が変わっていれば、changesテーブルから差分を取り込みます。"""
+        generation = current_generation()
+        if generation == self._generation:
+            return
+        with self._lock:
+            if generation == self._generation:
+                return
+            # 変更履歴と現在の状態を同じスナップショットから読む
+            cursor.execute("BEGIN")
+            try:
+                latest = latest_change_seq(cursor)
+                if self._seq is None or not self._apply_changes(cursor, latest):
+                    self._rebuild(cursor)
+                self._seq = latest
+                self._filters.clear()
+            finally:
+                cursor.connection.rollback()
+            self._generation = generation
+
+    def _rebuild(self, cursor):
+        self._tag_ids.clear()
+        self._tag_names.clear()
+        self._notes.clear()
+        self._note_state.clear()
+        self._all = {0: set(), 1: set()}
+        cursor.execute("SELECT id, name FROM tags")
+        for tag_id, name in cursor.fetchall():
+            self._tag_ids[name] = tag_id
+            self._tag_names[tag_id] = name
+        cursor.execute("SELECT id, is_trashed FROM notes")
+        for note_id, is_trashed in cursor.fetchall():
+            self._note_state[note_id] = (is_trashed, set())
+            self._all[is_trashed].add(note_id)
+        cursor.execute("SELECT note_id, tag_id FROM note_tags")
+        for note_id, tag_id in cursor.fetchall():
+            is_trashed, tag_ids = self._note_state[note_id]
+            tag_ids.add(tag_id)
+            self._notes[(tag_id, is_trashed)].add(note_id)
+        self.rebuilds += 1
+
+    def _apply_changes(self, cursor, latest):
+        """取り込み済みの位置からlatestまでの変更を反映します。差分で追えない場合はFalseを返します。"""
+        if latest == self._seq:
+            return True
+        cursor.execute("SELECT MIN(seq) FROM changes")
+        oldest = cursor.fetchone()[0]
+        if latest < self._seq or oldest is None or oldest > self._seq + 1:
+            return False # 履歴が削除されたかDBが入れ替わった
+        cursor.execute("SELECT kind, item_id FROM changes WHERE seq > ? AND seq <= ?", (self._seq, latest))
+        rows = cursor.fetchall()
+        if any(kind == 'reset' for kind, _ in rows):
+            return False
+        note_ids = list({item_id for kind, item_id in rows if kind == 'note'})
+        tag_ids = list({item_id for kind, item_id in rows if kind == 'tag'})
+
+        for tag_id in tag_ids:
+            self._tag_ids.pop(self._tag_names.pop(tag_id, None), None)
+        cursor.execute("SELECT id, name FROM tags WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(tag_ids),))
+        for tag_id, name in cursor.fetchall():
+            self._tag_ids[name] = tag_id
+            self._tag_names[tag_id] = name
+
+        for note_id in note_ids:
+            self._remove_note(note_id)
+        cursor.execute("SELECT id, is_trashed FROM notes WHERE id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(note_ids),))
+        for note_id, is_trashed in cursor.fetchall():
+            self._note_state[note_id] = (is_trashed, set())
+            self._all[is_trashed].add(note_id)
+        cursor.execute("SELECT note_id, tag_id FROM note_tags WHERE note_id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(note_ids),))
+        for note_id, tag_id in cursor.fetchall():
+            is_trashed, note_tag_ids = self._note_state[note_id]
+            note_tag_ids.add(tag_id)
+            self._notes[(tag_id, is_trashed)].add(note_id)
+        self.updates += 1
+        return True
+
+    def _remove_note(self, note_id):
+        state = self._note_state.pop(note_id, None)
+        if state is None:
+            return
+        is_trashed, tag_ids = state
+        self._all[is_trashed].discard(note_id)
+        for tag_id in tag_ids:
+            notes = self._notes.get((tag_id, is_trashed))
+            if notes is not None:
+                notes.discard(note_id)
+                if not notes:
+                    del self._notes[(tag_id, is_trashed)]
+
+    def _tag_notes(self, name, is_trashed):
+        return self._notes.get((self._tag_ids.get(name), is_trashed), set())
+
+    def _evaluate(self, ast, is_trashed):
+        if isinstance(ast, str):
+            return self._tag_notes(ast[len('@tags:'):], is_trashed)
+        op = ast[0]
+        if op == 'TAGS':
+            sets = [self._tag_notes(name, is_trashed) for name in ast[2]]
+            if ast[1] == 'ALL':
+                sets.sort(key=len) # 小さい集合から積を取る
+                return set.intersection(*sets)
+            return set().union(*sets)
+        if op == 'NOT':
+            return self._all.get(is_trashed, set()) - self._evaluate(ast[1], is_trashed)
+        sets = [self._evaluate(child, is_trashed) for child in ast[1:]]
+        if op == 'AND':
+            sets.sort(key=len)
+            return set.intersection(*sets)
+        return set().union(*sets)
+
+    def filter_sql(self, ast, is_trashed, ordered):
+        """@tags:だけからなる部分木を評価し、TAG_FILTER_SQLに代わる条件式とメモIDのJSON配列を返します。
+
+        orderedは更新日時の順にLIMITまで読む一覧かどうか。一致するメモが少なければIDからメモを引き、
+        多ければ+n.idでその引き方を止めてインデックスを順に走査させる。半分を超えるときは補集合を渡す。
+        """
+        key = (ast, is_trashed, ordered)
+        with self._lock:
+            result = self._filters.get(key)
+            if result is None:
+                if len(self._filters) >= TAG_FILTER_CACHE_SIZE:
+                    self._filters.clear()
+                result = self._filters[key] = self._filter_sql(ast, is_trashed, ordered)
+            return result
+
+    def _filter_sql(self, ast, is_trashed, ordered):
+        note_ids = self._evaluate(ast, is_trashed)
+        universe = self._all.get(is_trashed, set())
+        if len(note_ids) * 2 > len(universe):
+            return "+n.id NOT IN (SELECT value FROM json_each(?))", json.dumps(list(universe - note_ids))
+        if ordered and len(note_ids) * TAG_INDEX_SCAN_RATIO > len(universe):
+            return "+" + TAG_FILTER_SQL, json.dumps(list(note_ids))
+        return TAG_FILTER_SQL, json.dumps(list(note_ids))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': TAG_INDEX,
+                'tags': len(self._tag_ids),
+                'notes': len(self._note_state),
+                'links': sum(len(tag_ids) for _, tag_ids in self._note_state.values()),
+                'seq': self._seq,
+                'rebuilds': self.rebuilds,
+                'incremental_updates': self.updates,
+            }
+
+tag_note_index = TagNoteIndex()
+
+def bind_tag_filters(cursor, sql, params, is_trashed, ordered=True):
+    """SQLとパラメータ中のTagFilterを、一致するメモIDの条件に置き換えた (sql, params) を返します。
+
+    条件式の ? はすべてパラメータなので、n番目の ? の直前にn番目のパラメータの条件式がある。
+    """
+    if not any(isinstance(param, TagFilter) for param in params):
+        return sql, params
+    tag_note_index.sync(cursor)
+    parts = sql.split('?')
+    bound = []
+    for i, param in enumerate(params):
+        if isinstance(param, TagFilter):
+            condition_sql, param = tag_note_index.filter_sql(param.ast, is_trashed, ordered)
+            head = TAG_FILTER_SQL[:-len('?))')]
+            parts[i] = parts[i][:-len(head)] + condition_sql[:-len('?))')]
+        bound.append(param)
+    return '?'.join(parts), bound
+
+# --- 汎用のLRUキャッシュ ---
+class LRUCache:
+    """スレッド間で共有できる、件数上限 (と任意でバイト数上限) 付きのLRUキャッシュ。"""
+
+    def __init__(self, max_size, max_bytes=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data = collections.OrderedDict() # key -> (value, バイト数)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes=0):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (value, nbytes)
+            self.bytes += nbytes
+            while len(self._data) > self.max_size or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes and self._data):
+                _, (_, evicted_bytes) = self._data.popitem(last=False)
+                self.bytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {'hits': self.hits, 'misses': self.misses,
+                     'hit_ratio': self.hits / lookups if lookups else 0.0,
+                     'size': len(self._data), 'max_size': self.max_size}
+            if self.max_bytes is not None:
+                stats['bytes'] = self.bytes
+                stats['max_bytes'] = self.max_bytes
+            return stats
+
+# --- 検索クエリのコンパイル結果のキャッシュ ---
+# ページ送りや件数取得で同じクエリが繰り返されるため、(SQL条件式, パラメータ) をLRUで保持する
+# 条件の並び順はコンパイル時点の統計で決まるが、並び順は結果には影響しない
+QUERY_CACHE_SIZE = 256
+query_cache = LRUCache(QUERY_CACHE_SIZE)
+
+def compile_query(query, cursor=None):
+    """検索クエリを (SQL条件式, パラメータのタプル) に変換します。空のクエリならNoneを返します。
+
+    cursorを渡すと、DBの統計を使って条件の評価順を最適化します。
+    """
+    query = query.strip()
+    if len(query) > MAX_QUERY_LENGTH:
+        # 長すぎるクエリはキャッシュに載せずに拒否する
+        raise ValueError(f"Query is too long (max {MAX_QUERY_LENGTH} characters)")
+    compiled = query_cache.get(query)
+    if compiled is not None:
+        return compiled
+    ast = parse_query(query)
+    if ast is None:
+        return None
+    condition_sql, condition_params = build_sql(optimize_query(ast, SelectivityEstimator(cursor)))
+    compiled = (condition_sql, tuple(condition_params))
+    query_cache.put(query, compiled)
+    return compiled
+
+def query_cache_stats():
+    """コンパイル済みクエリキャッシュのヒット数・ミス数を返します。"""
+    return query_cache.stats()
+
+# --- GETレスポンスのキャッシュ ---
+# フロントエンドが操作のたびに取り直す一覧系のレスポンスを、シリアライズ済みのバイト列で保持する。
+# キャッシュのキーにはデータの世代番号を含め、書き込みがあれば世代番号を進めて古いエントリを無効にする。
+RESPONSE_CACHE_PATHS = {'/api/notes', '/api/search/notes', '/api/tags/all', '/api/tags/favorites', '/api/tags/others'}
+RESPONSE_CACHE_MAX_ENTRIES = 512
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+response_cache = LRUCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+
+# プリフォークしたワーカー間でも無効化が伝わるよう、世代番号は共有メモリに置く
+_data_generation = multiprocessing.Value('q', 0)
+
+def current_generation():
+    return _data_generation.value
+
+def bump_generation():
+    """データが変更されたことを記録し、キャッシュ済みのレスポンスを無効にします。"""
+    with _data_generation.get_lock():
+        _data_generation.value += 1
+    response_cache.clear()
+
+def response_etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+# --- 一覧の総件数 ---
+# 絞り込みのない一覧はcountersテーブル (トリガーで増減) から読む。
+# 検索の件数は (条件, 世代番号) ごとに1回だけ数え、ページをめくるたびには数えない。
+SEARCH_COUNT_CACHE_SIZE = 1024
+search_count_cache = LRUCache(SEARCH_COUNT_CACHE_SIZE)
+
+def count_notes(cursor, conditions, params, is_trashed, filtered):
+    """一覧の条件 (conditionsをANDでつないだもの) に合うメモの数を返します。"""
+    if not filtered and is_trashed in database.NOTE_COUNTERS:
+        cursor.execute("SELECT value FROM counters WHERE name = ?", (database.NOTE_COUNTERS[is_trashed],))
+        return cursor.fetchone()[0]
+    sql = "SELECT COUNT(*) FROM notes n WHERE " + " AND ".join(conditions)
+    # 世代番号は数える前に読む (数えている間に書き込みがあれば、このエントリは使われない)
+    key = (current_generation(), sql, tuple(params))
+    total = search_count_cache.get(key)
+    if total is None:
+        cursor.execute(*bind_tag_filters(cursor, sql, params, is_trashed, ordered=False))
+        total = cursor.fetchone()[0]
+        search_count_cache.put(key, total)
+    return total
+
+# --- メモへのタグ情報の付加 ---
+def fetch_tags_by_note(cursor, note_ids):
+    """複数メモのタグを1回のクエリで取得し、メモIDをキーにした辞書で返します。"""
+    tags_by_note = {note_id: [] for note_id in note_ids}
+    if not tags_by_note:
+        return tags_by_note
+    # IDの配列はJSONで渡し、パラメータ数の上限を気にせずに済むようにする
+    cursor.execute('''
+        SELECT nt.note_id, t.name FROM note_tags nt
+        JOIN tags t ON t.id = nt.tag_id
+        WHERE nt.note_id IN (SELECT value FROM json_each(?))
+        ORDER BY nt.note_id, nt.tag_id
+    ''', (json.dumps(list(tags_by_note)),))
+    for row in cursor.fetchall():
+        tags_by_note[row['note_id']].append({'name': row['name']})
+    return tags_by_note
+
+def get_note_tags(cursor, note_id):
+    """1件のメモのタグリストを返します。"""
+    return fetch_tags_by_note(cursor, [note_id])[note_id]
+
+# メモの本文 (長い本文はnote_bodiesに圧縮されている)
+NOTE_TEXT_SQL = database.note_text_sql('n')
+# APIで返すメモの列 (content_hashは内部用なので返さない)
+NOTE_COLUMNS = f"n.id, n.title, {NOTE_TEXT_SQL} AS content, n.created_at, n.updated_at, n.is_trashed, n.version"
+
+def get_note_with_tags(cursor, note_id):
+    """タグ情報付きのメモを返します。存在しない場合はNoneを返します。"""
+    cursor.execute(f"SELECT {NOTE_COLUMNS} FROM notes n WHERE n.id = ?", (note_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    note = dict(row)
+    note['tags'] = get_note_tags(cursor, note_id)
+    return note
+
+# --- メモ一覧のJSONの組み立て ---
+# 一覧のJSONは1件ずつSQLite側で作り、Pythonではつなげるだけにする。
+# fieldsパラメータで返すフィールドを選べる (サイドバーは id,title だけで足りる)。
+# snippetは圧縮した本文を展開せず、notes.previewに残した先頭から返す。
+NOTE_LIST_FIELDS = {
+    'id': 'n.id',
+    'title': 'n.title',
+    'content': NOTE_TEXT_SQL,
+    'snippet': f'COALESCE(n.preview, substr(n.content, 1, {database.NOTE_PREVIEW_LENGTH}))',
+    'created_at': 'n.created_at',
+    'updated_at': 'n.updated_at',
+    'is_trashed': 'n.is_trashed',
+    'version': 'n.version',
+    'tags': '''json((SELECT json_group_array(json_object('name', t.name)) FROM note_tags nt
+                     JOIN tags t ON t.id = nt.tag_id WHERE nt.note_id = n.id))''',
+}
+NOTE_LIST_DEFAULT_FIELDS = ['id', 'title', 'content', 'created_at', 'updated_at', 'tags']
+# limitがこの件数以上の一覧は、全体を組み立てずにチャンク転送で送る (キャッシュはしない)
+NOTE_LIST_STREAM_ROWS = 100
+STREAM_CHUNK_SIZE = 64 * 1024 # チャンク転送の1チャンクの目安
+
+def parse_note_fields(value):
+    """fieldsパラメータ (カンマ区切り) を検証し、フィールド名のリストを返します。"""
+    if not value:
+        return NOTE_LIST_DEFAULT_FIELDS
+    fields = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in NOTE_LIST_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"Unknown field: {', '.join(unknown)}" if unknown else "No fields specified")
+    return fields
+
+def note_json_sql(fields):
+    """メモ1件をJSONオブジェクトにするSQL式を返します。"""
+    return "json_object(" + ", ".join(f"'{name}', {NOTE_LIST_FIELDS[name]}" for name in fields) + ")"
+
+def note_page_json_sql(fields, page_sql):
+    """page_sql (id, updated_at を順に返す) の各メモについて、JSONとページング用の列を返すSQLを作ります。"""
+    return f'''
+        SELECT {note_json_sql(fields)}, page.updated_at, page.id
+        FROM ({page_sql}) AS page JOIN notes n ON n.id = page.id
+        ORDER BY page.updated_at DESC, page.id DESC
+    '''
+
+def take_page(rows, limit, on_more):
+    """limit+1行まで取得したrowsから、先頭limit行のJSONを返します。
+
+    limit+1行目があった場合は、最後に返した行を引数にon_moreを呼ぶ。
+    """
+    last = None
+    for i, row in enumerate(rows):
+        if i == limit:
+            on_more(last)
+            break
+        last = row
+        yield row[0]
+
+def iter_note_list_json(rows, trailer):
+    """メモのJSON文字列 (rows) から {"notes": [...], ...} を断片に分けて返します。
+
+    trailerは全行を返した後に呼ばれ、notesに続けるキーと値をdictで返す。
+    """
+    yield b'{"notes":['
+    separator = b''
+    for row in rows:
+        yield separator + row.encode('utf-8')
+        separator = b','
+    yield b']'
+    for key, value in trailer().items():
+        yield b',' + json.dumps(key).encode('utf-8') + b':' + json.dumps(value).encode('utf-8')
+    yield b'}'
+
+# --- タグ名の補完 (GET /api/tags/suggest) ---
+TAG_SUGGEST_DEFAULT_LIMIT = 10
+TAG_SUGGEST_MAX_LIMIT = 50
+
+def tag_grams(text):
+    """部分一致検索用に、文字列を1文字と2文字のn-gramに分解します。"""
+    return {text[i:i + n] for n in (1, 2) for i in range(len(text) - n + 1)}
+
+class TagSuggestIndex:
+    """タグ名のn-gramインデックス。部分一致するタグをmemo_countの多い順に返す。
+
+    タグの作成とmemo_countの変更はtagsの更新として変更履歴 (changes) に残るので、
+    データの世代が変わったときは履歴の増加分に出てきたタグだけを読み直す。
+    """
+
+    # 候補がこれより多い (短い入力など) ときは、順位順に走査して上位が揃ったら打ち切る
+    DENSE_CANDIDATES = 1000
+    # 1回の同期でこれより多くのタグが変わったら、1件ずつ入れ替えずにまとめて並べ直す
+    BULK_UPDATE = 64
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}   # tag_id -> タグ名
+        self._folded = {}  # tag_id -> 大文字小文字を畳んだタグ名
+        self._counts = {}  # tag_id -> memo_count
+        self._grams = collections.defaultdict(set)  # n-gram -> tag_idの集合
+        self._order = []   # (-memo_count, 名前, tag_id) の昇順 (memo_count降順・名前昇順)
+        self._seq = None   # 取り込み済みの変更のseq
+        self._generation = None
+
+    def _add(self, tag_id, name, count=0, ordered=True):
+        # ordered=Falseなら_orderは並べ直さない (呼び出し側が後でまとめて並べ直す)
+        if tag_id in self._names:
+            self._set_count(tag_id, count, ordered)
+            return
+        self._names[tag_id] = name
+        self._folded[tag_id] = folded = name.casefold()
+        self._counts[tag_id] = count
+        for gram in tag_grams(folded):
+            self._grams[gram].add(tag_id)
+        if ordered:
+            bisect.insort(self._order, (-count, name, tag_id))
+
+    def _set_count(self, tag_id, count, ordered=True):
+        old = self._counts[tag_id]
+        if old == count:
+            return
+        self._counts[tag_id] = count
+        if ordered:
+            name = self._names[tag_id]
+            del self._order[bisect.bisect_left(self._order, (-old, name, tag_id))]
+            bisect.insort(self._order, (-count, name, tag_id))
+
+    def _sort(self):
+        self._order = sorted((-self._counts[tag_id], name, tag_id) for tag_id, name in self._names.items())
+
+    def add(self, tag_id, name):
+        """新しく作られたタグを登録します。"""
+        with self._lock:
+            self._add(tag_id, name)
+
+    def sync(self, cursor):
+        """データの世代が変わっていれば、changesテーブルから増えたタグと変わったmemo_countを取り込みます。"""
+        generation = current_generation()
+        if generation == self._generation:
+            return
+        with self._lock:
+            if generation == self._generation:
+                return
+            # 変更履歴と現在の状態を同じスナップショットから読む
+            cursor.execute("BEGIN")
+            try:
+                latest = latest_change_seq(cursor)
+                if self._seq is None or not self._apply_changes(cursor, latest):
+                    self._rebuild(cursor)
+                self._seq = latest
+            finally:
+                cursor.connection.rollback()
+            self._generation = generation
+
+    def _rebuild(self, cursor):
+        # タグは削除・改名されないので、登録済みのタグはmemo_countだけを読み直す
+        cursor.execute("SELECT id, name, memo_count FROM tags")
+        for tag_id, name, count in cursor.fetchall():
+            self._add(tag_id, name, count, ordered=False)
+        self._sort()
+
+    def _apply_changes(self, cursor, latest):
+        """取り込み済みの位置からlatestまでの変更を反映します。差分で追えない場合はFalseを返します。"""
+        if latest == self._seq:
+            return True
+        cursor.execute("SELECT MIN(seq) FROM changes")
+        oldest = cursor.fetchone()[0]
+        if latest < self._seq or oldest is None or oldest > self._seq + 1:
+            return False # 履歴が削除されたかDBが入れ替わった
+        cursor.execute("SELECT DISTINCT kind, item_id FROM changes WHERE seq > ? AND seq <= ? AND kind != 'note'",
+                       (self._seq, latest))
+        rows = cursor.fetchall()
+        if any(kind == 'reset' for kind, _ in rows):
+            return False
+        tag_ids = [item_id for kind, item_id in rows if kind == 'tag']
+        if not tag_ids:
+            return True
+        ordered = len(tag_ids) <= self.BULK_UPDATE
+        cursor.execute("SELECT id, name, memo_count FROM tags WHERE id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(tag_ids),))
+        for tag_id, name, count in cursor.fetchall():
+            self._add(tag_id, name, count, ordered)
+        if not ordered:
+            self._sort()
+        return True
+
+    def _key(self, tag_id):
+        return (-self._counts[tag_id], self._names[tag_id])
+
+    def suggest(self, query, limit=TAG_SUGGEST_DEFAULT_LIMIT):
+        """queryを (大文字小文字を区別せず) 含むタグを、memo_countの多い順に返します。"""
+        needle = query.casefold()
+        with self._lock:
+            folded = self._folded
+            if not needle:
+                top = [key[2] for key in self._order[:limit]]
+            else:
+                grams = [g for g in tag_grams(needle) if len(g) == min(2, len(needle))]
+                postings = sorted((self._grams.get(g, set()) for g in grams), key=len)
+                if len(postings[0]) > self.DENSE_CANDIDATES:
+                    top = []
+                    for key in self._order:
+                        if needle in folded[key[2]]:
+                            top.append(key[2])
+                            if len(top) == limit:
+                                break
+                else:
+                    # n-gramが揃っていても並びが違う場合があるので、最後に部分文字列で確かめる
+                    candidates = [tag_id for tag_id in postings[0].intersection(*postings[1:])
+                                  if needle in folded[tag_id]]
+                    top = heapq.nsmallest(limit, candidates, key=self._key)
+            names, counts = self._names, self._counts
+            return [{'id': tag_id, 'name': names[tag_id], 'memo_count': counts[tag_id]} for tag_id in top]
+
+tag_suggest_index = TagSuggestIndex()
+
+# --- 条件付き・差分保存 ---
+def note_etag(version):
+    """メモのバージョンからETagを作ります。"""
+    return f'"v{version}"'
+
+def content_digest(content):
+    """本文が変わったかを判定するためのハッシュを返します。"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def apply_text_delta(text, delta):
+    """差分 [[開始, 終了, 挿入文字列], ...] を本文に適用した結果を返します。
+
+    位置はブラウザの文字列と同じUTF-16のコード単位で、元の本文に対する
+    昇順・非重複の範囲で指定します。不正な差分はValueErrorになります。
+    """
+    if not isinstance(delta, list):
+        raise ValueError("delta must be a list")
+    units = text.encode('utf-16-le')
+    size = len(units) // 2
+    pieces = []
+    pos = 0
+    for edit in delta:
+        if (not isinstance(edit, list) or len(edit) != 3
+                or not all(isinstance(v, int) and not isinstance(v, bool) for v in edit[:2])
+                or not isinstance(edit[2], str)):
+            raise ValueError("Each delta entry must be [start, end, text]")
+        start, end, inserted = edit
+        if not pos <= start <= end <= size:
+            raise ValueError("Delta ranges must be ascending and within the content")
+        pieces.append(units[pos * 2:start * 2])
+        pieces.append(inserted.encode('utf-16-le'))
+        pos = end
+    pieces.append(units[pos * 2:])
+    try:
+        # サロゲートペアの途中で切った差分はここで弾かれる
+        return b''.join(pieces).decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise ValueError("Delta splits a surrogate pair") from None
+
+class WriteRejected(Exception):
+    """書き込みを適用できない場合の例外。HTTPステータスとレスポンス本文を持ちます。"""
+
+    def __init__(self, status, payload):
+        super().__init__(payload.get('error'))
+        self.status = status
+        self.payload = payload
+
+class NoteUpdate:
+    """PUT /api/notes/{id} の1回分の更新内容。"""
+
+    def __init__(self, note_id, title=None, content=None, delta=None, if_match=None):
+        self.note_id = note_id
+        self.title = title
+        self.content = content
+        self.delta = delta
+        self.if_match = if_match
+
+    def validate(self):
+        """DBを読まずに判定できる誤りをWriteRejectedにします。"""
+        if self.title is None and self.content is None and self.delta is None:
+            raise WriteRejected(400, {'error': 'Title or content is required for update'})
+        for name in ('title', 'content'):
+            if not isinstance(getattr(self, name), (str, type(None))):
+                raise WriteRejected(400, {'error': f'{name} must be a string'})
+        if self.delta is not None:
+            # 差分は適用先の本文が確定していないと意味がないので、If-Matchを必須にする
+            if self.content is not None:
+                raise WriteRejected(400, {'error': 'Specify either content or delta, not both'})
+            if not self.if_match:
+                raise WriteRejected(428, {'error': 'If-Match is required for delta updates'})
+
+class NoteState:
+    """更新中のメモのタイトル・本文・バージョン。本文は大きくなりうるので、必要になるまで読まない。
+
+    apply()で更新をメモリ上に積み、write()でまとめて1回書き込む。
+    """
+
+    def __init__(self, cursor, note_id, row):
+        self.cursor = cursor
+        self.note_id = note_id
+        self.title = row['title']
+        self.version = self.written_version = row['version']
+        self.content_hash = row['content_hash']
+        self.updated_at = row['updated_at']
+        self._content = None
+        self.title_changed = False
+        self.content_changed = False
+
+    @classmethod
+    def load(cls, cursor, note_id):
+        """メモの状態を読み込みます。存在しない場合はNoneを返します。"""
+        cursor.execute("SELECT title, version, content_hash, updated_at FROM notes WHERE id = ?", (note_id,))
+        row = cursor.fetchone()
+        return None if row is None else cls(cursor, note_id, row)
+
+    def content(self):
+        if self._content is None:
+            self.cursor.execute(f"SELECT {NOTE_TEXT_SQL} FROM notes n WHERE n.id = ?", (self.note_id,))
+            self._content = self.cursor.fetchone()[0]
+        return self._content
+
+    def digest(self):
+        if self.content_hash is None:
+            self.content_hash = content_digest(self.content())
+        return self.content_hash
+
+    def apply(self, update, now):
+        """更新を適用し、クライアントに返す確認応答を返します。"""
+        if update.if_match and not etag_matches(update.if_match, note_etag(self.version)):
+            raise WriteRejected(412, {'error': 'Note has been modified', 'version': self.version})
+        content = update.content
+        if update.delta is not None:
+            try:
+                content = apply_text_delta(self.content(), update.delta)
+            except ValueError as e:
+                raise WriteRejected(400, {'error': str(e)})
+        title_changed = update.title is not None and update.title != self.title
+        content_changed = False
+        if content is not None:
+            new_hash = content_digest(content)
+            content_changed = new_hash != self.digest()
+
+        ack = {'id': self.note_id, 'title': update.title if update.title is not None else self.title}
+        if not title_changed and not content_changed:
+            # 何も変わっていなければ書き込まない (updated_atも据え置き)
+            ack.update(version=self.version, updated_at=self.updated_at, changed=False)
+            return ack
+        if title_changed:
+            self.title = update.title
+            self.title_changed = True
+        if content_changed:
+            self._content = content
+            self.content_hash = new_hash
+            self.content_changed = True
+        self.version += 1
+        self.updated_at = now
+        ack.update(version=self.version, updated_at=now, changed=True)
+        return ack
+
+    def write(self):
+        """積んだ更新を書き込みます。読んでから書くまでに他の保存が割り込んでいた場合はFalseを返します。"""
+        if self.version == self.written_version:
+            return True
+        updates = []
+        params = []
+        if self.title_changed:
+            updates.append("title = ?")
+            params.append(self.title)
+        if self.content_changed:
+            content, preview, body = database.split_body(self._content)
+            updates.append("content = ?, preview = ?, content_hash = ?")
+            params.extend([content, preview, self.content_hash])
+        updates.append("updated_at = ?")
+        params.extend([self.updated_at, self.note_id, self.written_version])
+        self.cursor.execute(f"UPDATE notes SET {', '.join(updates)} WHERE id = ? AND version = ?", tuple(params))
+        if self.cursor.rowcount == 0:
+            return False
+        if self.content_changed:
+            database.store_body(self.cursor, self.note_id, body)
+        # トリガーはバージョンを1つしか上げないので、まとめて書いた更新の数だけ進める
+        if self.version != self.written_version + 1:
+            self.cursor.execute("UPDATE notes SET version = ? WHERE id = ?", (self.version, self.note_id))
+        self.written_version = self.version
+        self.title_changed = self.content_changed = False
+        return True
+
+# --- タグの付け外し ---
+def add_note_tag(cursor, note_id, tag_name):
+    """メモにタグを付けます (なければ作成)。タグを新しく作った場合はそのidを返します。"""
+    cursor.execute("SELECT id FROM tags WHERE name = ?", (tag_name,))
+    tag_row = cursor.fetchone()
+    created_id = None
+    if tag_row:
+        tag_id = tag_row['id']
+    else:
+        cursor.execute("INSERT INTO tags (name) VALUES (?)", (tag_name,))
+        tag_id = created_id = cursor.lastrowid
+
+    # note_tagsに関連付け (重複エラーは無視)
+    try:
+        cursor.execute("INSERT INTO note_tags (note_id, tag_id) VALUES (?, ?)", (note_id, tag_id))
+    except sqlite3.IntegrityError: # 既に存在する場合
+        pass
+    return created_id
+
+def remove_note_tag(cursor, note_id, tag_name):
+    """メモからタグを外します。外せなかった場合はWriteRejectedになります。"""
+    cursor.execute("SELECT id FROM tags WHERE name = ?", (tag_name,))
+    tag_row = cursor.fetchone()
+    if not tag_row:
+        raise WriteRejected(404, {'error': 'Tag not found'})
+    cursor.execute("DELETE FROM note_tags WHERE note_id = ? AND tag_id = ?", (note_id, tag_row['id']))
+    if cursor.rowcount == 0:
+        raise WriteRejected(404, {'error': 'Tag association not found or already removed'})
+
+# --- 自動保存とタグ操作のグループコミット ---
+# WRITE_BEHINDを有効にすると、メモの更新とタグの付け外しはキューに入り、
+# 1つの書き込みスレッドがまとめて1トランザクションでコミットする。
+# 同じメモへの連続した更新はメモリ上で順に適用し、1回の書き込みにまとめる。
+WRITE_BEHIND = False
+# 'commit': コミット後に応答する (従来どおりの結果を返す)
+# 'enqueue': キューに入れた時点で202を返す (エラーは返せず、直後の読み取りには反映されていない場合がある)
+WRITE_BEHIND_DURABILITY = 'commit'
+WRITE_BEHIND_BATCH_SIZE = 256 # 1回のコミットにまとめる操作数の上限
+WRITE_BEHIND_BATCH_MS = 2 # 最初の操作からこの時間だけ後続の操作を待つ (0なら溜まっている分だけ)
+WRITE_BEHIND_MAX_QUEUE = 10000
+WRITE_BEHIND_PUT_TIMEOUT = 1.0 # キューが満杯のとき、503を返すまで待つ秒数
+
+class QueuedWrite:
+    """キューに入れた1つの書き込み操作と、その結果。"""
+
+    def __init__(self, kind, note_id, update=None, tag_name=None):
+        self.kind = kind # 'update', 'add_tag', 'remove_tag'
+        self.note_id = note_id
+        self.update = update
+        self.tag_name = tag_name
+        self.result = None # (ステータス, 本文, ヘッダ)
+        self._done = threading.Event()
+
+    def finish(self, status, payload, headers=None):
+        self.result = (status, payload, headers)
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        return self.result
+
+class WriteBehindQueue:
+    """書き込み操作を1つのスレッドでまとめてコミットするキュー。"""
+
+    def __init__(self, max_size=WRITE_BEHIND_MAX_QUEUE):
+        self._queue = queue.Queue(max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+        self.coalesced = 0
+        self.failed_batches = 0
+        self.failed_operations = 0 # バッチ内で個別に失敗させた操作の数
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    def submit(self, op):
+        """操作をキューに入れます。満杯のままならqueue.Fullになります。"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+        self._queue.put(op, timeout=WRITE_BEHIND_PUT_TIMEOUT)
+        metrics.registry.set('memo_write_queue_depth', (), self._queue.qsize())
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + WRITE_BEHIND_BATCH_MS / 1000
+        while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        # プールの接続は応答待ちのハンドラが使い切ることがあるので、専用の接続を持つ
+        conn = database.get_db_connection()
+        while True:
+            batch = self._next_batch()
+            try:
+                self._apply(conn, batch)
+            except Exception as e:
+                # 書き込みスレッドは止めず、このバッチの操作だけを失敗させる
+                if conn.in_transaction:
+                    conn.rollback()
+                print(f"write-behind batch failed: {e!r}", file=sys.stderr)
+                self.failed_batches += 1
+                for op in batch:
+                    op.finish(503, {'error': 'Write failed, please retry'})
+            metrics.registry.set('memo_write_queue_depth', (), self._queue.qsize())
+
+    def _op_failed(self, op, error, results):
+        print(f"write-behind {op.kind} on note {op.note_id} failed: {error!r}", file=sys.stderr)
+        self.failed_operations += 1
+        results.append((op, 503, {'error': 'Write failed, please retry'}, None))
+
+    def _apply(self, conn, batch):
+        now = datetime.now().isoformat()
+        states = {} # note_id -> NoteState (存在しないメモはNone)
+        created_tags = []
+        results = []
+        applied = 0 # 実際に内容を変えた更新の数
+        changes_before = conn.total_changes
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        for op in batch:
+            # 想定外のエラーはその操作だけを失敗させ、同じバッチの他のクライアントの書き込みは続ける
+            cursor.execute("SAVEPOINT write_op")
+            try:
+                if op.kind == 'update':
+                    if op.note_id not in states:
+                        states[op.note_id] = NoteState.load(cursor, op.note_id)
+                    state = states[op.note_id]
+                    if state is None:
+                        raise WriteRejected(404, {'error': 'Note not found or no changes made'})
+                    ack = state.apply(op.update, now)
+                    applied += ack['changed']
+                    results.append((op, 200, ack, {'ETag': note_etag(ack['version'])}))
+                elif op.kind == 'add_tag':
+                    created_id = add_note_tag(cursor, op.note_id, op.tag_name)
+                    if created_id is not None:
+                        created_tags.append((created_id, op.tag_name))
+                    results.append((op, 201, None, None))
+                else:
+                    remove_note_tag(cursor, op.note_id, op.tag_name)
+                    results.append((op, 200, None, None))
+            except WriteRejected as e:
+                results.append((op, e.status, e.payload, None))
+            except Exception as e:
+                # NoteState.apply()は失敗時にメモリ上の状態を変えないので、DBへの変更だけを戻せばよい
+                cursor.execute("ROLLBACK TO write_op")
+                self._op_failed(op, e, results)
+            cursor.execute("RELEASE write_op")
+        writes = 0
+        failed_notes = set()
+        for note_id, state in states.items():
+            if state is not None and state.version != state.written_version:
+                cursor.execute("SAVEPOINT write_op")
+                try:
+                    state.write() # 書き込みロックを持っているので割り込まれない
+                    writes += 1
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write_op")
+                    print(f"write-behind write of note {note_id} failed: {e!r}", file=sys.stderr)
+                    failed_notes.add(note_id)
+                cursor.execute("RELEASE write_op")
+        if failed_notes:
+            # 書き込めなかったメモへの更新は、まとめて失敗を返す
+            for i, (op, status, payload, headers) in enumerate(results):
+                if op.kind == 'update' and op.note_id in failed_notes and status == 200:
+                    results[i] = (op, 503, {'error': 'Write failed, please retry'}, None)
+                    self.failed_operations += 1
+        # タグ操作の応答には、バッチ適用後のタグ一覧を返す
+        tags_by_note = {}
+        for i, (op, status, payload, headers) in enumerate(results):
+            if op.kind != 'update' and payload is None:
+                if op.note_id not in tags_by_note:
+                    tags_by_note[op.note_id] = get_note_tags(cursor, op.note_id)
+                payload = {'tags': tags_by_note[op.note_id]}
+                if op.kind == 'remove_tag':
+                    payload['message'] = 'Tag removed successfully'
+                results[i] = (op, status, payload, headers)
+        changed = conn.total_changes != changes_before
+        conn.commit()
+        if changed:
+            bump_generation()
+        for tag_id, tag_name in created_tags:
+            tag_suggest_index.add(tag_id, tag_name)
+
+        self.batches += 1
+        self.operations += len(batch)
+        self.coalesced += applied - writes
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        metrics.registry.observe('memo_write_batch_size', (), len(batch))
+        metrics.registry.inc('memo_write_coalesced_total', (), applied - writes)
+        for op, status, payload, headers in results:
+            op.finish(status, payload, headers)
+
+    def stats(self):
+        return {
+            'enabled': WRITE_BEHIND,
+            'durability': WRITE_BEHIND_DURABILITY,
+            'queue_depth': self._queue.qsize(),
+            'batches': self.batches,
+            'operations': self.operations,
+            'coalesced_updates': self.coalesced,
+            'failed_batches': self.failed_batches,
+            'failed_operations': self.failed_operations,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': round(self.operations / self.batches, 2) if self.batches else 0,
+        }
+
+write_queue = WriteBehindQueue()
+
+def _reset_write_queue_after_fork():
+    # 書き込みスレッドはfork先に引き継がれないため、ワーカーごとに作り直す
+    global write_queue
+    write_queue = WriteBehindQueue()
+
+os.register_at_fork(after_in_child=_reset_write_queue_after_fork)
+
+# --- キーセットページング用のカーソル ---
+def encode_cursor(values):
+    """並び順のキー値を不透明なカーソル文字列に変換します。"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(page_cursor, types):
+    """カーソル文字列をキー値のリストに戻します。不正な場合はValueErrorを送出します。
+
+    typesはキー値ごとの型。値はSQLにそのまま渡すので、型が違うカーソルも不正として扱う。
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(page_cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Invalid cursor")
+    for value, value_type in zip(values, types):
+        if isinstance(value, bool) or not isinstance(value, value_type):
+            raise ValueError("Invalid cursor")
+    return values
+
+# --- 静的ファイルのキャッシュ ---
+STATIC_ROOT = 'static'
+STATIC_CONTENT_TYPES = {'.html': 'text/html', '.css': 'text/css', '.js': 'application/javascript'}
+# ファイル名にハッシュを含めていないため、毎回ETagで再検証させる (変更がなければ304)
+STATIC_CACHE_CONTROL = 'no-cache'
+
+class StaticFile:
+    """読み込み済みの静的ファイルと、そのgzip圧縮版。"""
+
+    def __init__(self, body, content_type, mtime_ns):
+        self.body = body
+        self.content_type = content_type
+        self.mtime_ns = mtime_ns
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etag = f'"{digest}"'
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        # 圧縮しても小さくならないファイルは元のまま返す
+        self.gzip_body = compressed if len(compressed) < len(body) else None
+        self.gzip_etag = f'"{digest}-gzip"'
+
+class StaticFileCache:
+    """静的ファイルをメモリに保持し、更新時刻が変わったときだけ読み直します。"""
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_path):
+        """StaticFileを返します。存在しないか公開対象外のパスならFileNotFoundErrorを送出します。"""
+        real_path = os.path.realpath(file_path)
+        if real_path != os.path.realpath('index.html') and \
+                not real_path.startswith(os.path.realpath(STATIC_ROOT) + os.sep):
+            raise FileNotFoundError(file_path) # static/ の外 (../ など) は公開しない
+        stat = os.stat(real_path)
+        static_file = self._files.get(real_path)
+        if static_file is None or static_file.mtime_ns != stat.st_mtime_ns:
+            with open(real_path, 'rb') as f:
+                body = f.read()
+            content_type = STATIC_CONTENT_TYPES.get(os.path.splitext(real_path)[1], 'application/octet-stream')
+            static_file = StaticFile(body, content_type, stat.st_mtime_ns)
+            with self._lock:
+                self._files[real_path] = static_file
+        return static_file
+
+    def preload(self):
+        """index.htmlとstatic/以下のファイルを読み込んでおきます。"""
+        paths = ['index.html']
+        for root, _, files in os.walk(STATIC_ROOT):
+            paths.extend(os.path.join(root, name) for name in files)
+        for path in paths:
+            try:
+                self.get(path)
+            except OSError:
+                pass
+
+static_files = StaticFileCache()
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match / If-Match ヘッダがetagに一致するかを (弱い比較で) 判定します。"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+def accepts_gzip(accept_encoding):
+    """Accept-Encodingヘッダがgzipを受け付けるかを判定します。"""
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+# --- 一括操作 (POST /api/batch) ---
+# {"operations": [{"op": "create_note", "title": ..., "content": ...},
+#                 {"op": "update_note", "note_id": 1, "title": ..., "content": ...},
+#                 {"op": "add_tag" | "remove_tag", "note_id": 1, "tag_name": ...},
+#                 {"op": "trash" | "restore" | "delete", "note_id": 1}, ...]}
+# note_idには "$n" (同じバッチのn番目のcreate_noteで作られたメモ) も指定できる。
+# 全操作を1トランザクションで実行し、1つでも失敗すれば何も反映しない。
+BATCH_MAX_OPERATIONS = 50000
+BATCH_OPERATIONS = {'create_note', 'update_note', 'add_tag', 'remove_tag', 'trash', 'restore', 'delete'}
+
+class BatchError(Exception):
+    """一括操作のうち、index番目の操作が失敗したことを表します。"""
+
+    def __init__(self, index, message):
+        super().__init__(message)
+        self.index = index
+
+def _batch_note_id(operation, index, results):
+    note_id = operation.get('note_id')
+    if isinstance(note_id, str) and note_id.startswith('$'):
+        try:
+            ref = int(note_id[1:])
+            if not 0 <= ref < index:
+                raise ValueError
+            return results[ref]['id']
+        except (ValueError, KeyError, TypeError):
+            raise BatchError(index, f'Invalid note reference: {note_id}')
+    if isinstance(note_id, bool) or not isinstance(note_id, int):
+        raise BatchError(index, 'note_id is required')
+    return note_id
+
+def _batch_text(operation, index, key, default=None):
+    # 省略した項目 (更新ではnullも) はdefaultにする。文字列以外は操作の誤りとして扱う
+    value = operation.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise BatchError(index, f'{key} must be a string')
+    return value
+
+def _batch_rows(rows, indexes, position):
+    """executemanyに渡す行を返しつつ、実行中の操作の位置をposition[0]に記録します。"""
+    for index, row in zip(indexes, rows):
+        position[0] = index
+        yield row
+
+def _batch_runs(operations):
+    """同じ種類の操作が連続する範囲を (種類, 開始位置, 終了位置) で返します。"""
+    start = 0
+    for i in range(1, len(operations) + 1):
+        if i == len(operations) or operations[i]['op'] != operations[start]['op']:
+            yield operations[start]['op'], start, i
+            start = i
+
+def execute_batch(conn, operations):
+    """一括操作を1トランザクションで実行し、操作ごとの結果のリストを返します。
+
+    連続する同じ種類の操作はexecutemanyでまとめて実行します。
+    失敗した操作があればロールバックしてBatchErrorを送出します。
+    """
+    if not isinstance(operations, list) or not operations:
+        raise BatchError(None, 'operations must be a non-empty array')
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        raise BatchError(None, f'Too many operations (max {BATCH_MAX_OPERATIONS})')
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+            raise BatchError(index, 'Unknown operation')
+
+    cursor = conn.cursor()
+    now = datetime.now().isoformat()
+    results = [None] * len(operations)
+    position = [None] # SQLの実行に失敗したときに返す操作の位置
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        for op, start, end in _batch_runs(operations):
+            indexes = range(start, end)
+            position[0] = start
+            if op == 'create_note':
+                # 作成したIDを返すため1件ずつ実行する (同じ文はsqlite3の文キャッシュで再利用される)
+                for i in indexes:
+                    operation = operations[i]
+                    title = _batch_text(operation, i, 'title', '無題のメモ')
+                    content, preview, body = database.split_body(_batch_text(operation, i, 'content', ''))
+                    position[0] = i
+                    cursor.execute("""
+                        INSERT INTO notes (title, content, preview, created_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                    """, (title, content, preview, now, now))
+                    results[i] = {'ok': True, 'id': cursor.lastrowid}
+                    if body is not None:
+                        database.store_body(cursor, cursor.lastrowid, body)
+                continue
+
+            note_ids = [_batch_note_id(operations[i], i, results) for i in indexes]
+            cursor.execute("SELECT id FROM notes WHERE id IN (SELECT value FROM json_each(?))",
+                           (json.dumps(note_ids),))
+            existing = {row['id'] for row in cursor.fetchall()}
+            for i, note_id in zip(indexes, note_ids):
+                if note_id not in existing:
+                    raise BatchError(i, f'Note not found: {note_id}')
+
+            if op == 'update_note':
+                rows = []
+                bodies = []
+                for i, note_id in zip(indexes, note_ids):
+                    title = _batch_text(operations[i], i, 'title')
+                    content = _batch_text(operations[i], i, 'content')
+                    if title is None and content is None:
+                        raise BatchError(i, 'Title or content is required for update')
+                    preview = None
+                    if content is not None:
+                        content, preview, body = database.split_body(content)
+                        bodies.append((i, (note_id, body)))
+                    rows.append({'title': title, 'content': content, 'preview': preview, 'now': now, 'id': note_id})
+                # 本文を変えた場合はハッシュを未計算に戻す (圧縮した本文同士ではnotes.contentが変わらないため)
+                cursor.executemany("""
+                    UPDATE notes SET
+                        title = COALESCE(:title, title),
+                        content = COALESCE(:content, content),
+                        preview = CASE WHEN :content IS NULL THEN preview ELSE :preview END,
+                        content_hash = CASE WHEN :content IS NULL THEN content_hash END,
+                        updated_at = :now
+                    WHERE id = :id
+                """, _batch_rows(rows, indexes, position))
+                for i, (note_id, body) in bodies:
+                    position[0] = i
+                    database.store_body(cursor, note_id, body)
+            elif op in ('add_tag', 'remove_tag'):
+                tag_names = [operations[i].get('tag_name') for i in indexes]
+                for i, tag_name in zip(indexes, tag_names):
+                    if not isinstance(tag_name, str) or not tag_name:
+                        raise BatchError(i, 'Tag name is required')
+                if op == 'add_tag':
+                    # 必要なタグをまとめて作成し、IDもまとめて引く
+                    cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)",
+                                       [(name,) for name in dict.fromkeys(tag_names)])
+                    cursor.execute("SELECT id, name FROM tags WHERE name IN (SELECT value FROM json_each(?))",
+                                   (json.dumps(list(set(tag_names))),))
+                    tag_ids = {row['name']: row['id'] for row in cursor.fetchall()}
+                    cursor.executemany("INSERT OR IGNORE INTO note_tags (note_id, tag_id) VALUES (?, ?)", _batch_rows(
+                        [(note_id, tag_ids[name]) for note_id, name in zip(note_ids, tag_names)], indexes, position))
+                else:
+                    cursor.executemany(
+                        "DELETE FROM note_tags WHERE note_id = ? AND tag_id = (SELECT id FROM tags WHERE name = ?)",
+                        _batch_rows(zip(note_ids, tag_names), indexes, position))
+            elif op in ('trash', 'restore'):
+                is_trashed = 1 if op == 'trash' else 0
+                cursor.executemany("UPDATE notes SET is_trashed = ? WHERE id = ?",
+                                   _batch_rows([(is_trashed, note_id) for note_id in note_ids], indexes, position))
+            elif op == 'delete':
+                cursor.executemany("DELETE FROM notes WHERE id = ?",
+                                   _batch_rows([(note_id,) for note_id in note_ids], indexes, position))
+            for i in indexes:
+                results[i] = {'ok': True}
+        position[0] = None
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise BatchError(position[0], f'Database error: {e}')
+    except Exception:
+        conn.rollback()
+        raise
+    return results
+
+# --- NDJSONでのエクスポート (GET /api/export) とインポート (POST /api/import) ---
+# 1行に1レコードのJSON。お気に入りのタグを {"type": "tag", "name": ..., "is_favorite": 1} で先に出力し、
+# 続けてメモを {"type": "note", "title": ..., "content": ..., "tags": [...], ...} で出力する。
+EXPORT_FETCH_SIZE = 500
+IMPORT_BATCH_SIZE = 5000 # この件数ごとにコミットする
+IMPORT_READ_SIZE = 64 * 1024
+IMPORT_MAX_LINE_LENGTH = 16 * 1024 * 1024
+
+class ImportFailed(Exception):
+    """インポートのline行目が不正だったことを表します。"""
+
+    def __init__(self, line, message):
+        super().__init__(message)
+        self.line = line
+        self.imported = None # 失敗までにコミットされた件数
+
+def iter_export_lines(cursor):
+    """エクスポートするNDJSONの各行を返します。行のJSONはSQLite側で組み立てます。"""
+    # タグとメモを同じスナップショットから読む
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute('''
+            SELECT json_object('type', 'tag', 'name', name, 'is_favorite', is_favorite)
+            FROM tags WHERE is_favorite = 1 ORDER BY name
+        ''')
+        for row in cursor.fetchall():
+            yield row[0].encode('utf-8') + b'\n'
+        cursor.execute(f'''
+            SELECT json_object(
+                'type', 'note', 'id', n.id, 'title', n.title, 'content', {NOTE_TEXT_SQL},
+                'created_at', n.created_at, 'updated_at', n.updated_at, 'is_trashed', n.is_trashed,
+                'tags', json((SELECT json_group_array(t.name) FROM note_tags nt
+                              JOIN tags t ON t.id = nt.tag_id WHERE nt.note_id = n.id)))
+            FROM notes n ORDER BY n.id
+        ''')
+        # 全件を取り出さず、カーソルから少しずつ読む
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0].encode('utf-8') + b'\n'
+    finally:
+        cursor.connection.rollback()
+
+def _import_batch(cursor, batch, now):
+    """インポートする1バッチ分のレコードを書き込み、(メモ件数, タグ件数) を返します。"""
+    tag_rows = []
+    notes = []
+    for line_number, record in batch:
+        record_type = record.get('type', 'note')
+        if record_type == 'tag':
+            name = record.get('name')
+            if not isinstance(name, str) or not name:
+                raise ImportFailed(line_number, 'Tag name is required')
+            tag_rows.append((name, 1 if record.get('is_favorite') else 0))
+        elif record_type == 'note':
+            title = record.get('title', '無題のメモ')
+            content = record.get('content', '')
+            tags = record.get('tags', [])
+            if not isinstance(title, str) or not isinstance(content, str):
+                raise ImportFailed(line_number, 'title and content must be strings')
+            if not isinstance(tags, list) or not all(isinstance(tag, str) and tag for tag in tags):
+                raise ImportFailed(line_number, 'tags must be an array of tag names')
+            created_at = record.get('created_at') or now
+            updated_at = record.get('updated_at') or now
+            if not isinstance(created_at, str) or not isinstance(updated_at, str):
+                raise ImportFailed(line_number, 'created_at and updated_at must be strings')
+            notes.append((line_number, title, content, created_at, updated_at,
+                          1 if record.get('is_trashed') else 0, tags))
+        else:
+            raise ImportFailed(line_number, f'Unknown record type: {record_type}')
+
+    cursor.executemany('''
+        INSERT INTO tags (name, is_favorite) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET is_favorite = excluded.is_favorite
+    ''', tag_rows)
+
+    # バッチ内のタグをまとめて作成し、IDもまとめて引く
+    tag_names = list(dict.fromkeys(tag for note in notes for tag in note[6]))
+    cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(name,) for name in tag_names])
+    cursor.execute("SELECT id, name FROM tags WHERE name IN (SELECT value FROM json_each(?))", (json.dumps(tag_names),))
+    tag_ids = {row['name']: row['id'] for row in cursor.fetchall()}
+
+    links = []
+    for line_number, title, content, created_at, updated_at, is_trashed, tags in notes:
+        content, preview, body = database.split_body(content)
+        try:
+            cursor.execute('''
+                INSERT INTO notes (title, content, preview, created_at, updated_at, is_trashed) VALUES (?, ?, ?, ?, ?, ?)
+            ''', (title, content, preview, created_at, updated_at, is_trashed))
+            note_id = cursor.lastrowid
+            if body is not None:
+                database.store_body(cursor, note_id, body)
+        except sqlite3.Error as e:
+            raise ImportFailed(line_number, f'Database error: {e}')
+        links.extend((note_id, tag_ids[name]) for name in dict.fromkeys(tags))
+    cursor.executemany("INSERT OR IGNORE INTO note_tags (note_id, tag_id) VALUES (?, ?)", links)
+    return len(notes), len(tag_rows)
+
+def import_notes(conn, lines, defer_triggers=False):
+    """NDJSONの行を取り込み、取り込んだ件数を {'notes': ..., 'tags': ...} で返します。
+
+    通常はIMPORT_BATCH_SIZE件ごとにコミットします。defer_triggersの場合は全体を1トランザクションで
+    取り込み、全文検索インデックスとタグのメモ数を行ごとのトリガーではなく最後にまとめて再構築します。
+    """
+    cursor = conn.cursor()
+    now = datetime.now().isoformat()
+    committed = {'notes': 0, 'tags': 0}
+    batch = []
+
+    def flush():
+        if not batch:
+            return
+        if not defer_triggers:
+            cursor.execute("BEGIN IMMEDIATE")
+        note_count, tag_count = _import_batch(cursor, batch, now)
+        if not defer_triggers:
+            conn.commit()
+        committed['notes'] += note_count
+        committed['tags'] += tag_count
+        batch.clear()
+
+    try:
+        if defer_triggers:
+            cursor.execute("BEGIN IMMEDIATE")
+            database.suspend_index_triggers(cursor)
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ImportFailed(line_number, 'Invalid JSON')
+            if not isinstance(record, dict):
+                raise ImportFailed(line_number, 'Each line must be a JSON object')
+            batch.append((line_number, record))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+        flush()
+        if defer_triggers:
+            database.resume_index_triggers(cursor)
+            conn.commit()
+    except ImportFailed as e:
+        conn.rollback()
+        e.imported = {'notes': 0, 'tags': 0} if defer_triggers else committed
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    return committed
+
+
+# --- 変更の差分 (GET /api/changes) と通知 (GET /api/events) ---
+# クライアントは最後に受け取ったseqを覚えておき、/api/eventsで新しいseqを知ったら
+# /api/changes?since=<seq> で差分だけを取得する。
+CHANGES_MAX_ROWS = 1000 # 1回の応答で読む変更履歴の上限 (超えた分はmore: trueで続きを取らせる)
+CHANGE_NOTE_FIELDS = ['id', 'title', 'updated_at', 'is_trashed', 'version', 'tags']
+EVENTS_POLL_INTERVAL = 0.25 # 世代番号を確認する間隔 (秒)
+EVENTS_HEARTBEAT = 15.0 # 変更がなくてもこの間隔でコメント行を送り、切断を検出する (秒)
+EVENTS_RETRY_MS = 3000 # 切断時にブラウザが再接続するまでの時間
+
+def latest_change_seq(cursor):
+    """これまでに記録された変更の最大のseqを返します。"""
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def read_changes(cursor, since, fields=CHANGE_NOTE_FIELDS):
+    """sinceより後の変更を、メモ・タグごとの現在の状態にまとめて返します。
+
+    履歴が削除済みなどで差分を返せない場合は {'seq': ..., 'reset': True} を返す。
+    """
+    # 変更履歴と現在の状態を同じスナップショットから読む
+    cursor.execute("BEGIN")
+    try:
+        latest = latest_change_seq(cursor)
+        cursor.execute("SELECT MIN(seq) FROM changes")
+        oldest = cursor.fetchone()[0]
+        if since > latest or since < (oldest if oldest is not None else latest + 1) - 1:
+            return {'seq': latest, 'reset': True}
+        cursor.execute("SELECT seq, kind, item_id FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                       (since, CHANGES_MAX_ROWS + 1))
+        rows = cursor.fetchall()
+        more = len(rows) > CHANGES_MAX_ROWS
+        rows = rows[:CHANGES_MAX_ROWS]
+        if any(row['kind'] == 'reset' for row in rows):
+            return {'seq': latest, 'reset': True}
+
+        note_ids = list(dict.fromkeys(row['item_id'] for row in rows if row['kind'] == 'note'))
+        tag_ids = list(dict.fromkeys(row['item_id'] for row in rows if row['kind'] == 'tag'))
+        cursor.execute(f'''
+            SELECT json_group_array(json({note_json_sql(fields)})) FROM notes n
+            WHERE n.id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(note_ids),))
+        notes = json.loads(cursor.fetchone()[0])
+        cursor.execute('''
+            SELECT id, name, is_favorite, memo_count FROM tags
+            WHERE id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(tag_ids),))
+        tags = [dict(row) for row in cursor.fetchall()]
+        cursor.execute("SELECT value FROM json_each(?) WHERE value NOT IN (SELECT id FROM notes)",
+                       (json.dumps(note_ids),))
+        deleted_notes = [row[0] for row in cursor.fetchall()]
+        found_tags = {tag['id'] for tag in tags}
+        return {
+            'seq': rows[-1]['seq'] if rows else since,
+            'more': more,
+            'notes': notes,
+            'deleted_notes': deleted_notes,
+            'tags': tags,
+            'deleted_tags': [tag_id for tag_id in tag_ids if tag_id not in found_tags],
+        }
+    finally:
+        cursor.connection.rollback()
+
+# --- ゴミ箱のメモの完全削除 (DELETE /api/notes/empty_trash, GET /api/trash/purge) ---
+# 「ゴミ箱を空にする」は受け付けだけして202を返し、削除は専用のスレッドが小さなトランザクションに分けて行う。
+# 1回のDELETEで大量に消すと書き込みロックを長く持ち、その間の自動保存がすべて待たされるため。
+# ゴミ箱に入れてからTRASH_RETENTION_DAYS日たったメモも同じスレッドが削除する。
+TRASH_RETENTION_DAYS = 30 # Noneなら期限切れでは削除しない
+PURGE_BATCH_SIZE = 100 # 1トランザクションで削除する件数の初期値 (PURGE_BATCH_MSに収まるよう増減させる)
+PURGE_BATCH_MIN = 10
+PURGE_BATCH_MAX = 2000
+PURGE_BATCH_MS = 20 # 1トランザクションで書き込みロックを持つ時間の目安
+PURGE_PAUSE = 0.02 # トランザクションの間に休む時間 (秒)。この間に他の書き込みがロックを取れる
+PURGE_SCAN_INTERVAL = 600 # 期限切れのメモを探す間隔 (秒)
+PURGE_RETRY_DELAY = 5.0 # 失敗したときにやり直すまでの時間 (秒)
+VACUUM_STEP_PAGES = 256 # 1トランザクションのincremental_vacuumでファイルから返すページ数
+
+def trash_expiry_cutoff():
+    """これ以前にゴミ箱に入れたメモは期限切れ、という日時を返します (期限がなければNone)。"""
+    if TRASH_RETENTION_DAYS is None:
+        return None
+    return (datetime.now() - timedelta(days=TRASH_RETENTION_DAYS)).isoformat()
+
+def request_trash_purge(cursor):
+    """現在ゴミ箱にあるメモの削除を依頼として記録します。コミットは呼び出し側で行う。"""
+    cursor.execute('''
+        UPDATE trash_purge SET
+            requested_at = ?,
+            requested_total = (SELECT value FROM counters WHERE name = 'notes_trashed')
+        WHERE id = 1
+    ''', (datetime.now().isoformat(),))
+
+def read_trash_purge(cursor):
+    """削除の依頼の進捗と、ファイルの空きページの状況を返します。"""
+    cursor.execute("SELECT * FROM trash_purge WHERE id = 1")
+    row = cursor.fetchone()
+    remaining = 0
+    if row['requested_at'] is not None:
+        cursor.execute("SELECT COUNT(*) FROM notes WHERE is_trashed = 1 AND trashed_at <= ?", (row['requested_at'],))
+        remaining = cursor.fetchone()[0]
+    return {
+        'state': 'idle' if row['requested_at'] is None else 'purging',
+        'requested_at': row['requested_at'],
+        'requested_total': row['requested_total'],
+        'purged': max(0, row['requested_total'] - remaining) if row['requested_at'] is not None else row['requested_total'],
+        'remaining': remaining,
+        'retention_days': TRASH_RETENTION_DAYS,
+        'purged_total': row['purged_total'],
+        'last_purge_at': row['last_purge_at'],
+        'vacuum': {
+            'auto_vacuum': database.AUTO_VACUUM,
+            **{name: cursor.execute(f"PRAGMA {name}").fetchone()[0]
+               for name in ('page_size', 'page_count', 'freelist_count')},
+            'vacuumed_pages': row['vacuumed_pages'],
+        },
+    }
+
+class TrashPurger:
+    """ゴミ箱のメモを少しずつ削除し、空いたページをファイルから返すバックグラウンドスレッド。
+
+    プリフォーク時は親プロセスで1つだけ動かす。
+    """
+
+    def __init__(self):
+        # fork前に作っておき、どのワーカーが依頼を受けても親プロセスのスレッドを起こせるようにする
+        self._wake = multiprocessing.Event()
+        self._thread = None
+        self.batch_size = PURGE_BATCH_SIZE
+        self.batches = 0
+        self.purged = 0
+        self.vacuum_steps = 0
+        self.failures = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='trash-purger', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """削除の依頼があったことを知らせます。"""
+        self._wake.set()
+
+    def _run(self):
+        # リクエストの処理とは別の専用の接続を使う。開けなかった場合も次の試行で開き直す
+        conn = None
+        while True:
+            self._wake.clear()
+            delay = PURGE_SCAN_INTERVAL
+            try:
+                if conn is None:
+                    conn = database.get_db_connection()
+                self._purge(conn)
+                self._vacuum(conn)
+            except Exception as e:
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+                print(f"trash purge failed: {e!r}", file=sys.stderr)
+                self.failures += 1
+                delay = PURGE_RETRY_DELAY
+            self._wake.wait(delay)
+
+    def _purge(self, conn):
+        while not self._purge_batch(conn):
+            time.sleep(PURGE_PAUSE)
+
+    def _purge_batch(self, conn):
+        """削除対象のメモを1トランザクション分だけ削除します。対象が残っていなければTrueを返す。"""
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT requested_at FROM trash_purge WHERE id = 1")
+        requested_at = cursor.fetchone()[0]
+        # 依頼の日時と期限切れの日時の遅いほうまでに捨てられたメモが対象
+        cutoff = max(filter(None, [requested_at, trash_expiry_cutoff()]), default=None)
+        if cutoff is None:
+            conn.rollback()
+            return True
+        cursor.execute('''
+            DELETE FROM notes WHERE id IN (
+                SELECT id FROM notes WHERE is_trashed = 1 AND trashed_at <= ? ORDER BY trashed_at LIMIT ?
+            )
+        ''', (cutoff, self.batch_size))
+        deleted = cursor.rowcount
+        done = deleted < self.batch_size
+        if deleted:
+            cursor.execute("UPDATE trash_purge SET purged_total = purged_total + ?, last_purge_at = ? WHERE id = 1",
+                           (deleted, datetime.now().isoformat()))
+        if done and requested_at is not None:
+            cursor.execute("UPDATE trash_purge SET requested_at = NULL WHERE id = 1")
+        conn.commit()
+        if deleted:
+            bump_generation()
+            self.batches += 1
+            self.purged += deleted
+            # 書き込みロックを持つ時間がPURGE_BATCH_MS前後になるよう件数を調整する (1回で最大2倍まで)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            scale = min(2.0, PURGE_BATCH_MS / max(elapsed_ms, 0.1))
+            self.batch_size = max(PURGE_BATCH_MIN, min(PURGE_BATCH_MAX, int(self.batch_size * scale)))
+        return done
+
+    def _vacuum(self, conn):
+        """削除で空いたページを、VACUUM_STEP_PAGESずつのトランザクションでファイルから返します。"""
+        if database.AUTO_VACUUM != 'incremental':
+            return
+        cursor = conn.cursor()
+        while True:
+            before = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            if before == 0:
+                break
+            # execute()では1ステップ (1ページ) しか実行されないので、executescript()で最後まで実行する
+            conn.executescript(f"BEGIN IMMEDIATE; PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+            freed = max(0, before - cursor.execute("PRAGMA freelist_count").fetchone()[0])
+            cursor.execute("UPDATE trash_purge SET vacuumed_pages = vacuumed_pages + ? WHERE id = 1", (freed,))
+            conn.commit()
+            self.vacuum_steps += 1
+            if freed == 0:
+                break
+            time.sleep(PURGE_PAUSE)
+        # WALの内容をDBファイルへ書き戻したときに、ファイルの末尾が切り詰められる
+        cursor.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+    def stats(self):
+        return {
+            'running': self._thread is not None,
+            'batch_size': self.batch_size,
+            'batches': self.batches,
+            'purged': self.purged,
+            'vacuum_steps': self.vacuum_steps,
+            'failures': self.failures,
+        }
+
+trash_purger = TrashPurger()
+
+# --- 計測 (GET /api/metrics) ---
+# メトリクスのラベルに使うルート名。idやタグ名を置き換えて、ラベルの種類が増えすぎないようにする
+ROUTES = {
+    '/api/notes', '/api/search/notes', '/api/notes/empty_trash', '/api/tags/favorites', '/api/tags/others',
+    '/api/tags/all', '/api/tags/suggest', '/api/export', '/api/import', '/api/batch', '/api/stats', '/api/metrics',
+    '/api/changes', '/api/events', '/api/trash/purge',
+}
+ROUTE_PATTERNS = [
+    (re.compile(r'/api/notes/\d+'), '/api/notes/{id}'),
+    (re.compile(r'/api/notes/\d+/tags'), '/api/notes/{id}/tags'),
+    (re.compile(r'/api/notes/\d+/tags/[^/]+'), '/api/notes/{id}/tags/{name}'),
+    (re.compile(r'/api/notes/\d+/trash'), '/api/notes/{id}/trash'),
+    (re.compile(r'/api/notes/\d+/restore'), '/api/notes/{id}/restore'),
+    (re.compile(r'/api/tags/\d+/toggle_favorite'), '/api/tags/{id}/toggle_favorite'),
+]
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def route_label(path):
+    """リクエストのパスを、メトリクスのルート名に変換します。"""
+    if path in ROUTES:
+        return path
+    if path == '/' or path.startswith('/static/'):
+        return 'static'
+    for pattern, label in ROUTE_PATTERNS:
+        if pattern.fullmatch(path):
+            return label
+    return 'other'
 
 class MemoHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1の持続的接続で、1回のページ読み込みを同じTCP接続で済ませる
+    protocol_version = 'HTTP/1.1'
+    timeout = 30 # 使われていない持続的接続はこの秒数で閉じる
+    # ヘッダと本文を別々に書き込むため、Nagleアルゴリズムが有効だと持続的接続で応答が遅延ACK分 (約40ms) 待たされる
+    disable_nagle_algorithm = True
+
+    # リクエストごとの状態 (持続的接続ではハンドラが使い回されるため、各do_*の先頭で初期化する)
+    _body = None
+    _cache_key = None
+    _write_conn = None
+    _status = None
+    _timer = None
+
     def _send_cors_headers(self):
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, DELETE, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, If-Match")
+        self.send_header("Access-Control-Expose-Headers", "ETag")
+
+    def send_response(self, code, message=None):
+        self._status = code # メトリクス用に記録する
+        super().send_response(code, message)
+
+    @contextlib.contextmanager
+    def _measure(self):
+        """do_*の処理全体を計測し、ルートごとの集計に加えます。"""
+        self._status = None
+        self._timer = metrics.start_request()
+        try:
+            yield
+        finally:
+            route = route_label(urllib.parse.urlparse(self.path).path)
+            metrics.finish_request(self._timer, self.command, route, self._status)
+            self._timer = None
+
+    def _lap(self, phase):
+        if self._timer is not None:
+            self._timer.lap(phase)
+
+    def _phase(self, name):
+        return self._timer.phase(name) if self._timer is not None else contextlib.nullcontext()
 
     def do_OPTIONS(self):
-        self.send_response(204) # No Content
-        self._send_cors_headers()
-        self.end_headers()
+        with self._measure():
+            self._body = None
+            self.send_response(204) # No Content
+            self._send_cors_headers()
+            self.end_headers()
+            self._read_body()
+
+    def _send_response(self, status_code, data=None, content_type='application/json', headers=None):
+        if not data:
+            body = b''
+        elif isinstance(data, bytes): # シリアライズ済み
+            body = data
+        else:
+            with self._phase('serialize'):
+                body = json.dumps(data).encode('utf-8')
+        # 書き込みの結果を受け取ったクライアントが古いキャッシュを読まないよう、応答の前に無効化する
+        self._invalidate_if_changed()
+        if status_code == 200 and self._cache_key is not None:
+            # キャッシュ対象のGETは、ETagを付けて保存し、クライアントの再検証に応える
+            etag = response_etag(body)
+            response_cache.put(self._cache_key, (body, etag), len(body))
+            self._send_cached_response(body, etag)
+            return
+        with self._phase('send'):
+            self.send_response(status_code)
+            self._send_cors_headers()
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+    def _send_cached_response(self, body, etag):
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304) # Not Modified
+            self._send_cors_headers()
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self._cache_key = None
+        self._send_response(200, body, 'application/json', headers)
+
+    def _read_body(self):
+        """リクエストボディを読み込みます。持続的接続のため、読まれなかったボディもここで読み捨てる。"""
+        if self._body is None:
+            content_length = int(self.headers.get('Content-Length') or 0)
+            self._body = self.rfile.read(content_length) if content_length > 0 else b''
+        return self._body
+
+    def _iter_body_lines(self):
+        """リクエストボディを少しずつ読み、1行ずつ返します。ボディ全体をメモリに載せません。"""
+        remaining = int(self.headers.get('Content-Length') or 0)
+        self._body = b'' # ここで読むので_read_bodyでは読み捨てない
+        pending = b''
+        line_number = 0
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, IMPORT_READ_SIZE))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            *lines, pending = (pending + chunk).split(b'\n')
+            for line in lines:
+                line_number += 1
+                yield self._decode_line(line, line_number)
+            if len(pending) > IMPORT_MAX_LINE_LENGTH:
+                raise ImportFailed(line_number + 1, 'Line is too long')
+        if pending:
+            yield self._decode_line(pending, line_number + 1)
+
+    @staticmethod
+    def _decode_line(line, line_number):
+        try:
+            return line.decode('utf-8')
+        except UnicodeDecodeError:
+            raise ImportFailed(line_number, 'Invalid UTF-8')
 
-    def _send_response(self, status_code, data=None, content_type='application/json'):
-        self.send_response(status_code)
+    def _write_chunk(self, data):
+        """チャンク転送エンコーディングで1チャンクを書き込みます。"""
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def _send_chunked(self, fragments, content_type='application/json', headers=None):
+        """断片 (bytes) を、全体をメモリに載せずにチャンク転送で送ります。"""
+        self.send_response(200)
         self._send_cors_headers()
         self.send_header('Content-type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        if data:
-            if content_type == 'application/json':
-                self.wfile.write(json.dumps(data).encode('utf-8'))
-            else:
-                self.wfile.write(data)
+        buffer = []
+        buffered = 0
+        for fragment in fragments:
+            buffer.append(fragment)
+            buffered += len(fragment)
+            if buffered >= STREAM_CHUNK_SIZE:
+                with self._phase('send'):
+                    self._write_chunk(b''.join(buffer))
+                buffer = []
+                buffered = 0
+        with self._phase('send'):
+            if buffer:
+                self._write_chunk(b''.join(buffer))
+            self.wfile.write(b'0\r\n\r\n') # 終端チャンク
+
+    def _serve_events(self):
+        """変更があるたびに最新のseqを送るServer-Sent Eventsのストリーム。"""
+        try:
+            last_sent = int(self.headers.get('Last-Event-ID') or -1)
+        except ValueError:
+            last_sent = -1
+        self.close_connection = True # 長さの決まらない応答なので、終わったら接続を閉じる
+        self.send_response(200)
+        self._send_cors_headers()
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(f'retry: {EVENTS_RETRY_MS}\n\n'.encode('utf-8'))
+        generation = None
+        last_write = time.monotonic()
+        try:
+            while True:
+                # 書き込みがあれば世代番号が進む。他のプロセスからの書き込みもハートビートの間隔で拾う
+                heartbeat = time.monotonic() - last_write >= EVENTS_HEARTBEAT
+                if current_generation() != generation or heartbeat:
+                    generation = current_generation()
+                    with database.connection() as conn:
+                        seq = latest_change_seq(conn.cursor())
+                    if seq != last_sent:
+                        self.wfile.write(f'id: {seq}\nevent: change\ndata: {{"seq": {seq}}}\n\n'.encode('utf-8'))
+                        last_sent = seq
+                        last_write = time.monotonic()
+                    elif heartbeat:
+                        self.wfile.write(b': ping\n\n')
+                        last_write = time.monotonic()
+                time.sleep(EVENTS_POLL_INTERVAL)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # クライアントが切断した
+
+    def _send_json_fragments(self, fragments, stream):
+        """断片に分かれたJSONを送ります。streamでなければ連結して通常どおり (キャッシュ対象なら保存して) 送ります。"""
+        if stream:
+            self._cache_key = None
+            self._send_chunked(fragments)
+        else:
+            self._send_response(200, b''.join(fragments))
+
+    def _serve_static(self, path):
+        file_path = 'index.html' if path == '/' else path[1:] # 先頭の '/' を除去
+        try:
+            static_file = static_files.get(file_path)
+        except OSError:
+            self._send_response(404, {'error': f'{file_path} not found'})
+            return
+
+        use_gzip = static_file.gzip_body is not None and accepts_gzip(self.headers.get('Accept-Encoding'))
+        etag = static_file.gzip_etag if use_gzip else static_file.etag
+        headers = {'ETag': etag, 'Cache-Control': STATIC_CACHE_CONTROL, 'Vary': 'Accept-Encoding'}
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304) # Not Modified
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+        body = static_file.gzip_body if use_gzip else static_file.body
+        self._send_response(200, body, static_file.content_type, headers)
 
+    # 各do_*はプールから接続を借り、処理の終了時に(例外時も)返却する
+    # routeフェーズは、ハンドラに入るまで (プールからの接続の取得を含む) の時間
     def do_GET(self):
+        with self._measure():
+            self._body = None
+            self._cache_key = None
+            path = urllib.parse.urlparse(self.path).path
+            if path == '/' or path.startswith('/static/'):
+                self._serve_static(path) # 静的ファイルはDB接続不要
+            elif path == '/api/metrics':
+                self._send_response(200, metrics.render().encode('utf-8'), METRICS_CONTENT_TYPE)
+            elif path == '/api/events':
+                self._serve_events() # 接続中ずっとDB接続を持たないよう、必要なときだけ借りる
+            elif path in RESPONSE_CACHE_PATHS:
+                # 世代番号はクエリの前に読む (実行中に書き込みがあれば、このエントリは使われない)
+                self._cache_key = (current_generation(), self.path)
+                cached = response_cache.get(self._cache_key)
+                if cached is not None:
+                    self._lap('route')
+                    self._send_cached_response(*cached)
+                else:
+                    with database.connection() as conn:
+                        self._lap('route')
+                        self._handle_GET(conn)
+            else:
+                with database.connection() as conn:
+                    self._lap('route')
+                    self._handle_GET(conn)
+            self._read_body()
+
+    def _handle_write(self, handler):
+        with self._measure():
+            self._body = None
+            self._cache_key = None
+            op = self._queued_write() if WRITE_BEHIND else None
+            if op is not None:
+                # キューで書き込む操作はプールの接続を使わない
+                self._lap('route')
+                self._submit_write(op)
+                self._read_body()
+                return
+            with database.connection() as conn:
+                self._lap('route')
+                self._write_conn = conn
+                self._write_changes = conn.total_changes
+                try:
+                    handler(conn)
+                finally:
+                    self._invalidate_if_changed()
+                    self._write_conn = None
+            self._read_body()
+
+    def _invalidate_if_changed(self):
+        # 実際にDBを変更したリクエストだけがキャッシュを無効にする
+        if self._write_conn is not None and self._write_conn.total_changes != self._write_changes:
+            self._write_changes = self._write_conn.total_changes
+            bump_generation()
+
+    def _queued_write(self):
+        """書き込みキューで扱う操作 (メモの更新とタグの付け外し) ならQueuedWriteを返します。
+
+        それ以外や、形式が正しくないリクエストはNoneを返し、通常の経路でエラーを返させる。
+        """
+        parts = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        if len(parts) < 3 or parts[:2] != ['api', 'notes']:
+            return None
+        try:
+            note_id = int(parts[2])
+        except ValueError:
+            return None
+        if self.command == 'DELETE':
+            if len(parts) == 5 and parts[3] == 'tags':
+                return QueuedWrite('remove_tag', note_id, tag_name=urllib.parse.unquote(parts[4]))
+            return None
+        if len(parts) != (4 if self.command == 'POST' else 3) or (self.command == 'POST' and parts[3] != 'tags'):
+            return None
+        try:
+            data = json.loads(self._read_body().decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return None
+        if not isinstance(data, dict):
+            return None
+        if self.command == 'POST':
+            tag_name = data.get('tag_name')
+            return QueuedWrite('add_tag', note_id, tag_name=tag_name) if isinstance(tag_name, str) and tag_name else None
+        update = NoteUpdate(note_id, data.get('title'), data.get('content'), data.get('delta'),
+                            self.headers.get('If-Match'))
+        try:
+            update.validate()
+        except WriteRejected:
+            return None
+        return QueuedWrite('update', note_id, update=update)
+
+    def _submit_write(self, op):
+        try:
+            write_queue.submit(op)
+        except queue.Full:
+            self._send_response(503, {'error': 'Too many pending writes'}, headers={'Retry-After': '1'})
+            return
+        if WRITE_BEHIND_DURABILITY == 'enqueue':
+            # コミットを待たずに受け付けたことだけを返す
+            ack = {'id': op.note_id, 'queued': True}
+            if op.update is not None and op.update.title is not None:
+                ack['title'] = op.update.title
+            self._send_response(202, ack)
+            return
+        with self._phase('write_queue'):
+            status, payload, headers = op.wait()
+        self._send_response(status, payload, headers=headers)
+
+    def do_POST(self):
+        self._handle_write(self._handle_POST)
+
+    def do_PUT(self):
+        self._handle_write(self._handle_PUT)
+
+    def do_DELETE(self):
+        self._handle_write(self._handle_DELETE)
+
+    def _handle_GET(self, conn):
         parsed_path = urllib.parse.urlparse(self.path)
         path = parsed_path.path
         query_components = urllib.parse.parse_qs(parsed_path.query)
-
-        conn = database.get_db_connection()
+        # cursorパラメータがあればキーセットページング (空文字はその1ページ目)
+        page_cursor = urllib.parse.parse_qs(parsed_path.query, keep_blank_values=True).get('cursor', [None])[0]
         cursor = conn.cursor()
 
-        if path == '/':
-            try:
-                with open('index.html', 'rb') as f:
-                    self._send_response(200, f.read(), 'text/html')
-            except FileNotFoundError:
-                self._send_response(404, {'error': 'index.html not found'})
-            return
-        elif path.startswith('/static/'):
-            try:
-                file_path = path[1:] # '/static/' を除去
-                content_type = 'text/css' if file_path.endswith('.css') else 'application/javascript'
-                with open(file_path, 'rb') as f:
-                    self._send_response(200, f.read(), content_type)
-            except FileNotFoundError:
-                self._send_response(404, {'error': f'{file_path} not found'})
-            return
-
-        elif path == '/api/notes' or path == '/api/search/notes':
+        if path == '/api/notes' or path == '/api/search/notes':
             page = int(query_components.get('page', [1])[0])
             limit = int(query_components.get('limit', [20])[0])
             offset = (page - 1) * limit
             search_query = query_components.get('query', [''])[0]
 
-            sql = "SELECT DISTINCT n.id, n.title, n.content, n.created_at, n.updated_at FROM notes n "
-            count_sql = "SELECT COUNT(DISTINCT n.id) FROM notes n "
+            try:
+                fields = parse_note_fields(query_components.get('fields', [''])[0])
+            except ValueError as e:
+                self._send_response(400, {'error': str(e)})
+                return
+            # ページに入るメモを先に絞り込み、JSONはその分だけSQLiteで作る
+            sql = "SELECT n.id, n.updated_at FROM notes n "
             conditions = []
             params = []
             is_trashed = int(query_components.get('trashed', [0])[0])
@@ -178,9 +2448,9 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
 
             if search_query:
                 try:
-                    ast = parse_query(search_query)
-                    if ast:
-                        condition_sql, condition_params = build_sql(ast)
+                    compiled = compile_query(search_query, cursor)
+                    if compiled:
+                        condition_sql, condition_params = compiled
                         conditions.append(condition_sql)
                         params.extend(condition_params)
                 except Exception as e:
@@ -188,50 +2458,58 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
                     return
 
 
-            if conditions:
+            if page_cursor is not None:
+                # (updated_at, id) の位置からインデックスをシークし、件数は数えない
+                if page_cursor:
+                    try:
+                        last_updated_at, last_id = decode_cursor(page_cursor, (str, int))
+                    except ValueError as e:
+                        self._send_response(400, {'error': str(e)})
+                        return
+                    conditions.append("(n.updated_at, n.id) < (?, ?)")
+                    params.extend([last_updated_at, last_id])
                 sql += " WHERE " + " AND ".join(conditions)
-                count_sql += " WHERE " + " AND ".join(conditions)
-
-            sql += " ORDER BY n.updated_at DESC LIMIT ? OFFSET ?"
-            params_with_pagination = params + [limit, offset]
-
-            cursor.execute(sql, params_with_pagination)
-            notes_rows = cursor.fetchall()
-            notes = [dict(row) for row in notes_rows]
-
-            # 各メモにタグ情報を追加
-            for note in notes:
-                cursor.execute('''
-                    SELECT t.name FROM tags t
-                    JOIN note_tags nt ON t.id = nt.tag_id
-                    WHERE nt.note_id = ?
-                ''', (note['id'],))
-                note_tags = cursor.fetchall()
-                note['tags'] = [{'name': tag['name']} for tag in note_tags]
+                sql += " ORDER BY n.updated_at DESC, n.id DESC LIMIT ?"
+                # 1件多く取得して次のページがあるかを判定する
+                sql, params = bind_tag_filters(cursor, sql, params + [limit + 1], is_trashed)
+                cursor.execute(note_page_json_sql(fields, sql), params)
+                page_end = {'next_cursor': None}
+                rows = take_page(cursor, limit, lambda last: page_end.update(
+                    next_cursor=encode_cursor([last[1], last[2]])))
+                self._send_json_fragments(iter_note_list_json(rows, lambda: page_end),
+                                          limit >= NOTE_LIST_STREAM_ROWS)
+                return
 
+            filtered = len(conditions) > 1
+            sql += " WHERE " + " AND ".join(conditions)
+            sql += " ORDER BY n.updated_at DESC, n.id DESC LIMIT ? OFFSET ?"
+
+            if query_components.get('has_more', ['0'])[0] in ('1', 'true'):
+                # 総件数の代わりに、1件多く取得して次のページがあるかだけを返す
+                page_sql, page_params = bind_tag_filters(cursor, sql, params + [limit + 1, offset], is_trashed)
+                cursor.execute(note_page_json_sql(fields, page_sql), page_params)
+                page_end = {'has_more': False, 'current_page': page}
+                rows = take_page(cursor, limit, lambda last: page_end.update(has_more=True))
+                self._send_json_fragments(iter_note_list_json(rows, lambda: page_end),
+                                          limit >= NOTE_LIST_STREAM_ROWS)
+                return
 
-            cursor.execute(count_sql, params)
-            total_items = cursor.fetchone()[0]
-            total_pages = math.ceil(total_items / limit)
+            def page_info():
+                # 件数はメモを送り終えてから数える
+                total_items = count_notes(cursor, conditions, params, is_trashed, filtered)
+                return {'total_pages': math.ceil(total_items / limit), 'current_page': page}
 
-            self._send_response(200, {'notes': notes, 'total_pages': total_pages, 'current_page': page})
+            page_sql, page_params = bind_tag_filters(cursor, sql, params + [limit, offset], is_trashed)
+            cursor.execute(note_page_json_sql(fields, page_sql), page_params)
+            self._send_json_fragments(iter_note_list_json((row[0] for row in cursor), page_info),
+                                      limit >= NOTE_LIST_STREAM_ROWS)
 
         elif path.startswith('/api/notes/'):
             try:
                 note_id = int(path.split('/')[-1]) # /api/notes/{id}
-                cursor.execute("SELECT * FROM notes WHERE id = ?", (note_id,))
-                note = cursor.fetchone()
-                if note:
-                    # タグ情報を取得
-                    cursor.execute('''
-                        SELECT t.name FROM tags t
-                        JOIN note_tags nt ON t.id = nt.tag_id
-                        WHERE nt.note_id = ?
-                    ''', (note_id,))
-                    tags = cursor.fetchall()
-                    note_data = dict(note)
-                    note_data['tags'] = [{'name': tag['name']} for tag in tags]
-                    self._send_response(200, note_data)
+                note_data = get_note_with_tags(cursor, note_id)
+                if note_data:
+                    self._send_response(200, note_data, headers={'ETag': note_etag(note_data['version'])})
                 else:
                     self._send_response(404, {'error': 'Note not found'})
             except ValueError: # IDが数値でない場合
@@ -242,8 +2520,7 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
 
         elif path == '/api/tags/favorites': # お気に入りタグリスト取得
             cursor.execute('''
-                SELECT t.id, t.name, 
-                       (SELECT COUNT(nt.note_id) FROM note_tags nt WHERE nt.tag_id = t.id) as memo_count
+                SELECT t.id, t.name, t.memo_count
                 FROM tags t
                 WHERE t.is_favorite = 1
                 ORDER BY t.name ASC
@@ -257,12 +2534,38 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
             limit = int(query_components.get('limit', [20])[0])
             offset = (page - 1) * limit
 
+            if page_cursor is not None:
+                # (memo_count, name) の位置から続きを取得する
+                seek_sql = ""
+                seek_params = []
+                if page_cursor:
+                    try:
+                        last_memo_count, last_name = decode_cursor(page_cursor, (int, str))
+                    except ValueError as e:
+                        self._send_response(400, {'error': str(e)})
+                        return
+                    seek_sql = "AND (t.memo_count < ? OR (t.memo_count = ? AND t.name > ?))"
+                    seek_params = [last_memo_count, last_memo_count, last_name]
+                cursor.execute(f'''
+                    SELECT t.id, t.name, t.is_favorite, t.memo_count
+                    FROM tags t
+                    WHERE t.is_favorite = 0 {seek_sql}
+                    ORDER BY t.memo_count DESC, t.name ASC
+                    LIMIT ?
+                ''', seek_params + [limit + 1])
+                tags = [dict(row) for row in cursor.fetchall()]
+                next_cursor = None
+                if len(tags) > limit:
+                    tags = tags[:limit]
+                    next_cursor = encode_cursor([tags[-1]['memo_count'], tags[-1]['name']])
+                self._send_response(200, {'tags': tags, 'next_cursor': next_cursor})
+                return
+
             cursor.execute('''
-                SELECT t.id, t.name, t.is_favorite,
-                       (SELECT COUNT(nt.note_id) FROM note_tags nt WHERE nt.tag_id = t.id) as memo_count
+                SELECT t.id, t.name, t.is_favorite, t.memo_count
                 FROM tags t
                 WHERE t.is_favorite = 0
-                ORDER BY memo_count DESC, t.name ASC
+                ORDER BY t.memo_count DESC, t.name ASC
                 LIMIT ? OFFSET ?
             ''', (limit, offset))
             tags_rows = cursor.fetchall()
@@ -274,6 +2577,55 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
 
             self._send_response(200, {'tags': tags, 'total_pages': total_pages, 'current_page': page})
         
+        elif path == '/api/export': # 全メモをNDJSONで出力
+            # 送信の途中で切断されても、接続をプールに戻す前に読み取りのトランザクションを終える
+            with contextlib.closing(iter_export_lines(cursor)) as lines:
+                self._send_chunked(lines, 'application/x-ndjson',
+                                   {'Content-Disposition': 'attachment; filename="memo-export.ndjson"'})
+
+        elif path == '/api/changes': # since以降の変更の差分
+            since = query_components.get('since', [None])[0]
+            if since is None:
+                # 同期の起点として現在のseqだけを返す
+                self._send_response(200, {'seq': latest_change_seq(cursor)})
+                return
+            try:
+                since = int(since)
+            except ValueError:
+                self._send_response(400, {'error': 'Invalid since'})
+                return
+            fields = query_components.get('fields', [''])[0]
+            try:
+                fields = parse_note_fields(fields) if fields else CHANGE_NOTE_FIELDS
+            except ValueError as e:
+                self._send_response(400, {'error': str(e)})
+                return
+            self._send_response(200, read_changes(cursor, since, fields))
+
+        elif path == '/api/stats': # キャッシュなどの内部統計
+            self._send_response(200, {
+                'query_cache': query_cache_stats(),
+                'search_count_cache': search_count_cache.stats(),
+                'response_cache': response_cache.stats(),
+                'write_behind': write_queue.stats(),
+                'tag_index': tag_note_index.stats(),
+                'trash_purger': trash_purger.stats(),
+            })
+
+        elif path == '/api/trash/purge': # ゴミ箱を空にする処理の進捗
+            self._send_response(200, read_trash_purge(cursor))
+
+        elif path == '/api/tags/suggest': # タグ名の補完 (インデックスから返す)
+            q = query_components.get('q', [''])[0]
+            try:
+                limit = int(query_components.get('limit', [TAG_SUGGEST_DEFAULT_LIMIT])[0])
+            except ValueError:
+                self._send_response(400, {'error': 'Invalid limit'})
+                return
+            limit = max(1, min(limit, TAG_SUGGEST_MAX_LIMIT))
+            tag_suggest_index.sync(cursor)
+            self._send_response(200, {'tags': tag_suggest_index.suggest(q, limit)})
+
         elif path == '/api/tags/all': # タグサジェスト用 (変更なし、is_favoriteは含めなくても良い)
             cursor.execute("SELECT id, name FROM tags ORDER BY name ASC")
             tags_rows = cursor.fetchall()
@@ -281,31 +2633,53 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
             self._send_response(200, {'tags': tags})
         else:
             self._send_response(404, {'error': 'API endpoint not found'})
-        conn.close()
 
 
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
+    def _handle_POST(self, conn):
+        parsed_path = urllib.parse.urlparse(self.path)
+        if parsed_path.path == '/api/import':
+            # ボディは一括で読まず、行ごとに取り込む
+            query_components = urllib.parse.parse_qs(parsed_path.query)
+            defer_triggers = query_components.get('defer_triggers', ['0'])[0] in ('1', 'true')
+            try:
+                imported = import_notes(conn, self._iter_body_lines(), defer_triggers)
+            except ImportFailed as e:
+                self.close_connection = True # 読み残したボディがあるため接続を閉じる
+                self._send_response(400, {'error': str(e), 'line': e.line, 'imported': e.imported})
+                return
+            self._send_response(200, {'imported': imported})
+            return
+
+        post_data = self._read_body()
         try:
             data = json.loads(post_data.decode('utf-8'))
         except json.JSONDecodeError:
             self._send_response(400, {'error': 'Invalid JSON'})
             return
 
-        conn = database.get_db_connection()
         cursor = conn.cursor()
         now = datetime.now().isoformat()
 
-        if self.path == '/api/notes':
+        if self.path == '/api/batch':
+            operations = data.get('operations') if isinstance(data, dict) else None
+            try:
+                results = execute_batch(conn, operations)
+            except BatchError as e:
+                self._send_response(400, {'error': str(e), 'index': e.index})
+                return
+            self._send_response(200, {'results': results})
+
+        elif self.path == '/api/notes':
             title = data.get('title', '無題のメモ')
-            content = data.get('content', '')
-            cursor.execute("INSERT INTO notes (title, content, created_at, updated_at) VALUES (?, ?, ?, ?)",
-                           (title, content, now, now))
-            conn.commit()
+            content, preview, body = database.split_body(data.get('content', ''))
+            cursor.execute("INSERT INTO notes (title, content, preview, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                           (title, content, preview, now, now))
             new_note_id = cursor.lastrowid
+            if body is not None:
+                database.store_body(cursor, new_note_id, body)
+            conn.commit()
             # 作成されたメモの情報を返す
-            cursor.execute("SELECT * FROM notes WHERE id = ?", (new_note_id,))
+            cursor.execute(f"SELECT {NOTE_COLUMNS} FROM notes n WHERE n.id = ?", (new_note_id,))
             new_note = dict(cursor.fetchone())
             new_note['tags'] = [] # 新規作成時はタグなし
             self._send_response(201, new_note)
@@ -316,35 +2690,17 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
                 parts = self.path.split('/')
                 note_id = int(parts[3])
                 tag_name = data.get('tag_name')
-                if not tag_name:
+                if not isinstance(tag_name, str) or not tag_name:
                     self._send_response(400, {'error': 'Tag name is required'})
                     return
 
-                # タグが存在するか確認、なければ作成
-                cursor.execute("SELECT id FROM tags WHERE name = ?", (tag_name,))
-                tag_row = cursor.fetchone()
-                if tag_row:
-                    tag_id = tag_row['id']
-                else:
-                    cursor.execute("INSERT INTO tags (name) VALUES (?)", (tag_name,))
-                    conn.commit()
-                    tag_id = cursor.lastrowid
-
-                # note_tagsに関連付け (重複エラーは無視)
-                try:
-                    cursor.execute("INSERT INTO note_tags (note_id, tag_id) VALUES (?, ?)", (note_id, tag_id))
-                    conn.commit()
-                except sqlite3.IntegrityError: # 既に存在する場合
-                    pass
+                created_id = add_note_tag(cursor, note_id, tag_name)
+                conn.commit() # タグの作成と関連付けを1回でコミットする
+                if created_id is not None:
+                    tag_suggest_index.add(created_id, tag_name)
 
                 # 更新後のタグリストを返す
-                cursor.execute('''
-                    SELECT t.name FROM tags t
-                    JOIN note_tags nt ON t.id = nt.tag_id
-                    WHERE nt.note_id = ?
-                ''', (note_id,))
-                tags = [{'name': r['name']} for r in cursor.fetchall()]
-                self._send_response(201, {'tags': tags})
+                self._send_response(201, {'tags': get_note_tags(cursor, note_id)})
 
             except (ValueError, IndexError):
                 self._send_response(400, {'error': 'Invalid note ID for adding tag'})
@@ -352,13 +2708,10 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
 
         else:
             self._send_response(404, {'error': 'API endpoint not found for POST'})
-        conn.close()
 
-    def do_PUT(self):
-        
+    def _handle_PUT(self, conn):
         parsed_path = urllib.parse.urlparse(self.path)
         path = parsed_path.path
-        conn = database.get_db_connection() # PUTの最初でconnを取得
         cursor = conn.cursor()
         now = datetime.now().isoformat()
 
@@ -371,7 +2724,6 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
                 tag_row = cursor.fetchone()
                 if not tag_row:
                     self._send_response(404, {'error': 'Tag not found'})
-                    conn.close()
                     return
                 
                 current_is_favorite = tag_row['is_favorite']
@@ -381,18 +2733,12 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
                 conn.commit()
                 
                 # 更新されたタグ情報を返す (memo_countも取得)
-                cursor.execute('''
-                    SELECT t.id, t.name, t.is_favorite,
-                           (SELECT COUNT(nt.note_id) FROM note_tags nt WHERE nt.tag_id = t.id) as memo_count
-                    FROM tags t WHERE t.id = ?
-                ''', (tag_id,))
+                cursor.execute("SELECT id, name, is_favorite, memo_count FROM tags WHERE id = ?", (tag_id,))
                 updated_tag_data = dict(cursor.fetchone())
                 self._send_response(200, updated_tag_data)
 
             except (ValueError, IndexError):
                 self._send_response(400, {'error': 'Invalid tag ID for toggling favorite'})
-            finally: # tryブロックがあってもなくてもconn.close()を実行
-                conn.close()
             return # この処理が終わったら他のPUT処理に進まないようにする
 
 
@@ -414,71 +2760,49 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
             except:
                 self._send_response(400, {'error': 'Invalid ID'})
         elif path.startswith('/api/notes/'):
-            content_length = int(self.headers['Content-Length'])
-            put_data = self.rfile.read(content_length)
+            put_data = self._read_body()
             try:
                 data = json.loads(put_data.decode('utf-8'))
             except json.JSONDecodeError:
                 self._send_response(400, {'error': 'Invalid JSON'})
-                conn.close() # JSONエラーでもconnを閉じる
                 return
             try:
                 note_id = int(path.split('/')[-1])
-                title = data.get('title')
-                content = data.get('content')
-
-                if title is None and content is None:
-                     self._send_response(400, {'error': 'Title or content is required for update'})
-                     conn.close()
-                     return
-
-                updates = []
-                params = []
-                if title is not None:
-                    updates.append("title = ?")
-                    params.append(title)
-                if content is not None:
-                    updates.append("content = ?")
-                    params.append(content)
-                updates.append("updated_at = ?")
-                params.append(now)
-
-                params.append(note_id)
-
-                cursor.execute(f"UPDATE notes SET {', '.join(updates)} WHERE id = ?", tuple(params))
-                conn.commit()
-
-                if cursor.rowcount == 0:
-                    self._send_response(404, {'error': 'Note not found or no changes made'})
-                else:
-                    cursor.execute("SELECT * FROM notes WHERE id = ?", (note_id,))
-                    updated_note = dict(cursor.fetchone())
-                    # タグ情報も付加
-                    cursor.execute('''
-                        SELECT t.name FROM tags t
-                        JOIN note_tags nt ON t.id = nt.tag_id
-                        WHERE nt.note_id = ?
-                    ''', (note_id,))
-                    tags_data = cursor.fetchall()
-                    updated_note['tags'] = [{'name': tag['name']} for tag in tags_data]
-                    self._send_response(200, updated_note)
-
             except (ValueError, IndexError):
                 self._send_response(400, {'error': 'Invalid note ID for update'})
+                return
+            if not isinstance(data, dict):
+                self._send_response(400, {'error': 'Title or content is required for update'})
+                return
+            update = NoteUpdate(note_id, data.get('title'), data.get('content'), data.get('delta'),
+                                self.headers.get('If-Match'))
+            try:
+                update.validate()
+                state = NoteState.load(cursor, note_id)
+                if state is None:
+                    raise WriteRejected(404, {'error': 'Note not found or no changes made'})
+                ack = state.apply(update, now)
+            except WriteRejected as e:
+                self._send_response(e.status, e.payload)
+                return
+            # 読んでから書くまでの間に他の保存が割り込んだ場合は更新しない
+            if not state.write():
+                conn.rollback()
+                self._send_response(412, {'error': 'Note has been modified'})
+                return
+            conn.commit()
+            self._send_response(200, ack, headers={'ETag': note_etag(ack['version'])})
+
         
         else:
             self._send_response(404, {'error': 'API endpoint not found for PUT'})
 
-        if conn: # connがまだ開いていれば閉じる
-            conn.close()
-
-    def do_DELETE(self):
+    def _handle_DELETE(self, conn):
         parsed_path = urllib.parse.urlparse(self.path)
         path = parsed_path.path
-        conn = database.get_db_connection()
         cursor = conn.cursor()
 
-        if path.startswith('/api/notes/') and path.endswith('/tags/'): # /api/notes/{id}/tags/{tagName}
+        if path.startswith('/api/notes/') and '/tags/' in path: # /api/notes/{id}/tags/{tagName}
             # この形式はGETでは使わず、DELETE専用として実装
             # 正しくは /api/notes/{id}/tags/{tagName}
             try:
@@ -488,28 +2812,15 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
                     tag_name_encoded = parts[4]
                     tag_name = urllib.parse.unquote(tag_name_encoded) # URLデコード
 
-                    cursor.execute("SELECT id FROM tags WHERE name = ?", (tag_name,))
-                    tag_row = cursor.fetchone()
-                    if not tag_row:
-                        self._send_response(404, {'error': 'Tag not found'})
-                        conn.close()
+                    try:
+                        remove_note_tag(cursor, note_id, tag_name)
+                    except WriteRejected as e:
+                        self._send_response(e.status, e.payload)
                         return
-                    tag_id = tag_row['id']
-
-                    cursor.execute("DELETE FROM note_tags WHERE note_id = ? AND tag_id = ?", (note_id, tag_id))
                     conn.commit()
-
-                    if cursor.rowcount > 0:
-                         # 更新後のタグリストを返す
-                        cursor.execute('''
-                            SELECT t.name FROM tags t
-                            JOIN note_tags nt ON t.id = nt.tag_id
-                            WHERE nt.note_id = ?
-                        ''', (note_id,))
-                        tags = [{'name': r['name']} for r in cursor.fetchall()]
-                        self._send_response(200, {'message': 'Tag removed successfully', 'tags': tags})
-                    else:
-                        self._send_response(404, {'error': 'Tag association not found or already removed'})
+                    # 更新後のタグリストを返す
+                    tags = get_note_tags(cursor, note_id)
+                    self._send_response(200, {'message': 'Tag removed successfully', 'tags': tags})
                 else:
                     self._send_response(400, {'error': 'Invalid URL format for deleting tag'})
 
@@ -518,12 +2829,12 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
                 self._send_response(400, {'error': 'Invalid note ID or tag name for deleting tag'})
 
         elif path == '/api/notes/empty_trash':
-            print("z")
-            cursor.execute("DELETE FROM notes WHERE is_trashed = 1")
+            # 削除はバックグラウンドで少しずつ行う。進捗は GET /api/trash/purge で確認する
+            request_trash_purge(cursor)
             conn.commit()
-            self._send_response(200, {'success': True})
+            trash_purger.wake()
+            self._send_response(202, read_trash_purge(cursor))
         elif path.startswith('/api/notes/'): # /api/notes/{id} (メモ自体の削除)
-            print("zz4")
             try:
                 note_id = int(path.split('/')[-1])
                 # 関連するnote_tagsもCASCADE DELETEで削除されるはず
@@ -537,17 +2848,75 @@ class MemoHandler(http.server.BaseHTTPRequestHandler):
                 self._send_response(400, {'error': 'Invalid note ID for deletion'})
         else:
             self._send_response(404, {'error': 'API endpoint not found for DELETE'})
-        if conn:
-            conn.close()
 
 
-def run(server_class=http.server.HTTPServer, handler_class=MemoHandler, port=PORT):
-    # 最初にデータベースを初期化
+# 1なら単一プロセス、2以上ならその数のワーカープロセスが同じポートで待ち受ける
+WORKERS = 1
+
+class MemoServer(http.server.ThreadingHTTPServer):
+    """リクエストごとにスレッドを割り当てるHTTPサーバ。"""
+    daemon_threads = True
+    request_queue_size = 128
+
+def prepare_server():
+    """起動時の準備 (データベースの初期化と、メモリ上のインデックスの構築) をします。"""
     database.init_db()
+    static_files.preload()
+    with database.connection() as conn:
+        tag_suggest_index.sync(conn.cursor())
+        if TAG_INDEX:
+            tag_note_index.sync(conn.cursor())
+
+def serve_workers(serve, port, workers):
+    """serveをworkers個の子プロセスで実行し、すべて終わるまで待ちます。
+
+    待ち受けソケットはfork前に作っておき、各ワーカーが同じソケットでacceptする。
+    メトリクスは各ワーカーが共有ディレクトリに書き出したものを合算して返す。
+    """
+    metrics_dir = tempfile.mkdtemp(prefix='memo-metrics-')
+    metrics.share_across_processes(metrics_dir)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    # スレッドを持ったままforkしないよう、ワーカーを起動してから親プロセスで動かす
+    trash_purger.start()
+    print(f"Serving HTTP on port {port} with {workers} workers...")
+    # 親プロセスがSIGTERMを受けたらワーカーも止める
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+def run(server_class=MemoServer, handler_class=MemoHandler, port=PORT, workers=WORKERS):
+    # 最初にデータベースを初期化
+    prepare_server()
     server_address = ('', port)
     httpd = server_class(server_address, handler_class)
-    print(f"Serving HTTP on port {port}...")
-    httpd.serve_forever()
+    if workers <= 1:
+        trash_purger.start()
+        print(f"Serving HTTP on port {port}...")
+        httpd.serve_forever()
+        return
+
+    # プリフォーク
+    try:
+        serve_workers(httpd.serve_forever, port, workers)
+    finally:
+        httpd.server_close()
 
 if __name__ == '__main__':
     run()
\ No newline at end of file
@@ -0,0 +1,269 @@
+# metrics.py
+"""リクエストとSQL文の計測値を集計し、Prometheusのテキスト形式で出力します。"""
+import bisect
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+
+# レイテンシのヒストグラムの境界 (秒)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# レイテンシ以外を測るヒストグラムの境界
+METRIC_BUCKETS = {
+    'memo_write_batch_size': (1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+}
+
+# プリフォーク時に各ワーカーが集計値をファイルに書き出す間隔 (秒)
+SHARE_INTERVAL = 1.0
+
+# 出力するメトリクスの種類と説明
+METRICS = {
+    'memo_http_requests_total': ('counter', 'HTTP requests by method, route and status.'),
+    'memo_http_request_duration_seconds': ('histogram', 'HTTP request latency by method and route.'),
+    'memo_http_request_phase_seconds_total': ('counter', 'Time spent in each request phase.'),
+    'memo_sql_statements_total': ('counter', 'SQL statements executed, by leading keyword.'),
+    'memo_sql_rows_total': ('counter', 'Rows returned or changed by SQL statements.'),
+    'memo_sql_vm_steps_total': ('counter', 'Approximate SQLite VM instructions executed.'),
+    'memo_sql_duration_seconds': ('histogram', 'SQL statement latency, including fetching its rows.'),
+    'memo_sql_slow_statements_total': ('counter', 'SQL statements slower than the slow query threshold.'),
+    'memo_write_queue_depth': ('gauge', 'Write operations waiting in the write-behind queue.'),
+    'memo_write_batch_size': ('histogram', 'Write operations committed per write-behind batch.'),
+    'memo_write_coalesced_total': ('counter', 'Note updates merged into another update of the same note.'),
+    'memo_http_open_connections': ('gauge', 'Client connections held open by the asyncio server.'),
+    'memo_http_rejected_total': ('counter', 'Requests the asyncio server refused or timed out, by reason.'),
+    'memo_db_executor_pending': ('gauge', 'Requests queued or running on the database executor.'),
+    'memo_db_executor_wait_seconds': ('histogram', 'Time a request waited for a database executor thread.'),
+    'memo_db_executor_run_seconds': ('histogram', 'Time a request ran on a database executor thread.'),
+}
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # 最後は+Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    """ラベル付きのカウンタ・ゲージ・ヒストグラムを保持します。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(float) # (名前, ラベル) -> 値
+        self._gauges = {} # (名前, ラベル) -> 値
+        self._histograms = {} # (名前, ラベル) -> Histogram
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            self._counters[(name, labels)] += amount
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram(METRIC_BUCKETS.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    def snapshot(self):
+        """JSONにできる形で現在の値を返します。"""
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self._gauges.items()],
+                'histograms': [[name, list(labels), h.counts, h.sum, h.count]
+                               for (name, labels), h in self._histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        """snapshot()の結果を足し込みます。ゲージもワーカーの合計にします。"""
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                self._counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, value in snapshot.get('gauges', ()):
+                key = (name, tuple(map(tuple, labels)))
+                self._gauges[key] = self._gauges.get(key, 0) + value
+            for name, labels, counts, total, count in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(METRIC_BUCKETS.get(name, LATENCY_BUCKETS))
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+    def render(self):
+        """Prometheusのテキスト形式で出力します。"""
+        series = collections.defaultdict(list)
+        with self._lock:
+            for (name, labels), value in itertools.chain(self._counters.items(), self._gauges.items()):
+                series[name].append(format_sample(name, labels, value))
+            for (name, labels), h in self._histograms.items():
+                cumulative = 0
+                for bound, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else repr(float(bound))
+                    series[name].append(format_sample(name + '_bucket', labels + (('le', le),), cumulative))
+                series[name].append(format_sample(name + '_sum', labels, h.sum))
+                series[name].append(format_sample(name + '_count', labels, h.count))
+        lines = []
+        for name in sorted(series):
+            kind, help_text = METRICS.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(series[name])
+        return '\n'.join(lines) + '\n'
+
+def format_sample(name, labels, value):
+    if labels:
+        escaped = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                           for k, v in labels)
+        name = f'{name}{{{escaped}}}'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return f'{name} {value}'
+
+registry = Registry()
+
+# --- リクエストごとの計測 ---
+class RequestTimer:
+    """1リクエストの処理時間をフェーズごとに積み上げます。"""
+
+    def __init__(self):
+        self.start = self._last = time.perf_counter()
+        self.phases = collections.defaultdict(float)
+
+    def lap(self, phase):
+        """前回のlap (またはリクエスト開始) からの経過時間をphaseに加えます。"""
+        now = time.perf_counter()
+        self.phases[phase] += now - self._last
+        self._last = now
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.phases[self.name] += time.perf_counter() - self.start
+
+_local = threading.local()
+
+def current_request():
+    """このスレッドで処理中のリクエストのRequestTimerを返します (なければNone)。"""
+    return getattr(_local, 'timer', None)
+
+def start_request():
+    timer = _local.timer = RequestTimer()
+    return timer
+
+def finish_request(timer, method, route, status):
+    """リクエストの計測を終え、ルートごとの集計に加えます。"""
+    _local.timer = None
+    elapsed = time.perf_counter() - timer.start
+    labels = (('method', method), ('route', route))
+    registry.inc('memo_http_requests_total', labels + (('status', str(status)),))
+    registry.observe('memo_http_request_duration_seconds', labels, elapsed)
+    # 個別に測らなかった残りの時間はハンドラ内の処理 (app) とする
+    timer.phases['app'] += max(0.0, elapsed - sum(timer.phases.values()))
+    for phase, seconds in timer.phases.items():
+        registry.inc('memo_http_request_phase_seconds_total', labels + (('phase', phase),), seconds)
+    _maybe_share()
+
+# --- SQL文ごとの計測 ---
+READ_VERBS = {'SELECT', 'WITH', 'PRAGMA', 'EXPLAIN', 'VALUES'}
+
+def statement_verb(sql):
+    """SQL文の先頭のキーワードを返します。"""
+    words = sql.lstrip(' \t\r\n(').split(None, 1)
+    return words[0].upper() if words else ''
+
+def record_sql(verb, seconds, rows, vm_steps, slow=False):
+    """SQL文1つの計測値を記録し、実行中のリクエストのdbフェーズに加えます。"""
+    labels = (('verb', verb),)
+    registry.inc('memo_sql_statements_total', labels)
+    registry.inc('memo_sql_rows_total', labels, rows)
+    registry.inc('memo_sql_vm_steps_total', labels, vm_steps)
+    registry.observe('memo_sql_duration_seconds', labels, seconds)
+    if slow:
+        registry.inc('memo_sql_slow_statements_total', labels)
+    timer = current_request()
+    if timer is not None:
+        timer.phases['db_read' if verb in READ_VERBS else 'db_write'] += seconds
+
+def record_commit(seconds):
+    timer = current_request()
+    if timer is not None:
+        timer.phases['commit'] += seconds
+
+# --- プリフォークしたワーカー間での集計 ---
+# 各ワーカーは自分の集計値を SHARE_INTERVAL ごとに共有ディレクトリへ書き出し、
+# /api/metrics に応答するワーカーがそれらを合算する。
+_share_dir = None
+_last_share = 0.0
+_share_lock = threading.Lock() # 書き出す時刻の判定と一時ファイルへの書き込みをスレッド間で直列にする
+
+def share_across_processes(directory):
+    """directoryを使ってワーカー間で集計値を共有します。fork前に呼びます。"""
+    global _share_dir
+    _share_dir = directory
+
+def _snapshot_path(pid):
+    return os.path.join(_share_dir, f'{pid}.json')
+
+def _maybe_share(force=False):
+    global _last_share
+    if _share_dir is None:
+        return
+    with _share_lock:
+        now = time.monotonic()
+        if not force and now - _last_share < SHARE_INTERVAL:
+            return
+        _last_share = now
+        path = _snapshot_path(os.getpid())
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(tmp_path, path) # 読み手が書きかけのファイルを見ないように置き換える
+
+def render():
+    """全ワーカーの集計値をPrometheusのテキスト形式で返します。"""
+    if _share_dir is None:
+        return registry.render()
+    merged = Registry()
+    merged.merge(registry.snapshot())
+    own = f'{os.getpid()}.json'
+    for name in os.listdir(_share_dir):
+        if name == own or not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(_share_dir, name)) as f:
+                merged.merge(json.load(f))
+        except (OSError, ValueError):
+            continue # 終了したワーカーのファイルが消えた場合など
+    return merged.render()
+
+def _reset_after_fork():
+    # 親プロセスで起動時に集計した分を、各ワーカーで重複して数えないようにする
+    global registry, _last_share, _share_lock
+    registry = Registry()
+    _last_share = 0.0
+    _share_lock = threading.Lock() # fork時に他のスレッドが保持していた場合に備えて作り直す
+    _local.timer = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
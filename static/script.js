@@ -38,16 +38,25 @@ document.addEventListener('DOMContentLoaded', () => {
     const emptyTrashButton = document.getElementById('emptyTrashButton');
     // --- 状態管理 ---
     let currentMemoId = null;
+    let currentMemoVersion = null; // 条件付き保存 (If-Match) 用
+    let lastChangeSeq = null; // 反映済みの変更のseq
+    let changeSyncRunning = false;
+    let changeSyncPending = false;
+    let lastSavedTitle = '';
+    let lastSavedContent = ''; // 差分保存の基準になる、サーバー上の本文
     let isEditingMarkdown = false; // false:編集, true:プレビュー
     let autoSaveTimer = null;
     const AUTO_SAVE_DELAY = 3000; // 3秒操作がなければ自動保存
 
     let currentMemoListPage = 1;
     const ITEMS_PER_PAGE = 20;
+    const MEMO_LIST_FIELDS = 'id,title'; // 一覧に表示するのはタイトルだけなので本文は受け取らない
     let currentOtherTagListPage = 1;
     let currentSearchResultPage = 1;
 
-    let allTags = []; // タグ補完用
+    let tagSuggestRequestId = 0; // 古いタグ補完の応答で上書きしないための連番
+    const TAG_SUGGEST_LIMIT = 5;
+    const TRASH_PURGE_POLL_MS = 500; // ゴミ箱を空にしている間、進捗を確認する間隔
 
     // 左ペインの開閉状態を管理するフラグ
     let isLeftPaneClosed = false;
@@ -59,7 +68,7 @@ document.addEventListener('DOMContentLoaded', () => {
     loadMemos();
     loadFavoriteTags();
     loadOtherTags();
-    loadAllTagsForSuggestions();
+    initChangeSync();
 
     // --- ペインリサイズ機能 ---
     function initPanes() {
@@ -141,7 +150,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- メモ関連処理 ---
     async function loadMemos(page = 1, query = '', tags = '') {
         currentMemoListPage = page;
-        let url = `/api/notes?page=${page}&limit=${ITEMS_PER_PAGE}`;
+        let url = `/api/notes?page=${page}&limit=${ITEMS_PER_PAGE}&fields=${MEMO_LIST_FIELDS}`;
         if (query) url += `&query=${encodeURIComponent(query)}`;
         if (tags) url += `&tags=${encodeURIComponent(tags)}`;
 
@@ -218,6 +227,7 @@ document.addEventListener('DOMContentLoaded', () => {
             currentMemoId = memo.id;
             memoTitleInput.value = memo.title;
             memoContentInput.value = memo.content;
+            setSavedState(memo);
             createdAtEl.textContent = new Date(memo.created_at).toLocaleString();
             updatedAtEl.textContent = new Date(memo.updated_at).toLocaleString();
             renderMemoTags(memo.tags || []); // メモのタグを表示
@@ -249,6 +259,7 @@ document.addEventListener('DOMContentLoaded', () => {
             currentMemoId = newMemo.id;
             memoTitleInput.value = newMemo.title;
             memoContentInput.value = newMemo.content;
+            setSavedState(newMemo);
             createdAtEl.textContent = new Date(newMemo.created_at).toLocaleString();
             updatedAtEl.textContent = new Date(newMemo.updated_at).toLocaleString();
             renderMemoTags(newMemo.tags || []);
@@ -306,37 +317,105 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     });
 
+    function setSavedState(memo) {
+        currentMemoVersion = memo.version ?? null;
+        lastSavedTitle = memo.title;
+        lastSavedContent = memo.content;
+    }
+
+    // 保存済みの本文との差分を、共通の先頭・末尾を除いた1つの置換 [開始, 終了, 挿入文字列] で表す
+    function computeTextDelta(oldText, newText) {
+        let start = 0;
+        const maxStart = Math.min(oldText.length, newText.length);
+        while (start < maxStart && oldText[start] === newText[start]) start++;
+        let oldEnd = oldText.length;
+        let newEnd = newText.length;
+        while (oldEnd > start && newEnd > start && oldText[oldEnd - 1] === newText[newEnd - 1]) {
+            oldEnd--;
+            newEnd--;
+        }
+        return [[start, oldEnd, newText.slice(start, newEnd)]];
+    }
+
+    async function putMemo(id, memoData, version) {
+        const headers = { 'Content-Type': 'application/json' };
+        if (version !== null) headers['If-Match'] = `"v${version}"`;
+        return fetch(`/api/notes/${id}`, {
+            method: 'PUT',
+            headers,
+            body: JSON.stringify(memoData)
+        });
+    }
+
     async function saveCurrentMemo() {
         if (!currentMemoId) return;
-        saveStatusEl.textContent = '保存中...';
-        saveStatusEl.style.color = 'blue';
-
+        const memoId = currentMemoId;
         const title = memoTitleInput.value;
         const content = memoContentInput.value;
         // タグの保存は別途行うか、ここでまとめて行う
         // ここでは簡単のためタイトルと本文のみ
-        const memoData = { title, content };
+        if (title === lastSavedTitle && content === lastSavedContent) {
+            // 変更がなければリクエストを送らない
+            saveStatusEl.textContent = '保存済み';
+            saveStatusEl.style.color = 'green';
+            autoSaveTimer = null;
+            return;
+        }
+        saveStatusEl.textContent = '保存中...';
+        saveStatusEl.style.color = 'blue';
 
-        const updatedMemo = await fetchData(`/api/notes/${currentMemoId}`, {
-            method: 'PUT',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(memoData)
-        });
+        // 本文は変更箇所だけを送る (サーバー上の版が一致する場合のみ適用される)
+        const memoData = {};
+        if (title !== lastSavedTitle) memoData.title = title;
+        if (content !== lastSavedContent) {
+            if (currentMemoVersion !== null) {
+                memoData.delta = computeTextDelta(lastSavedContent, content);
+            } else {
+                memoData.content = content;
+            }
+        }
 
+        let updatedMemo = null;
+        try {
+            const response = await putMemo(memoId, memoData, currentMemoVersion);
+            if (response.status === 412) {
+                // 他の画面で更新されていた場合は黙って上書きせず、どちらを残すかを選んでもらう
+                autoSaveTimer = null;
+                await resolveSaveConflict(memoId);
+                return;
+            }
+            if (!response.ok) {
+                const errorData = await response.json().catch(() => ({ message: response.statusText }));
+                throw new Error(`HTTP error! status: ${response.status}, message: ${errorData.error || errorData.message}`);
+            }
+            updatedMemo = await response.json();
+        } catch (error) {
+            console.error('Fetch error:', error);
+        }
+        if (memoId !== currentMemoId) {
+            autoSaveTimer = null;
+            return; // 保存中に別のメモが選択された
+        }
         if (updatedMemo) {
-            updatedAtEl.textContent = new Date(updatedMemo.updated_at).toLocaleString();
+            // キューに入っただけの応答 (202) には版がないので、次回は全文を送る
+            currentMemoVersion = updatedMemo.version ?? null;
+            lastSavedTitle = title;
+            lastSavedContent = content;
+            if (updatedMemo.updated_at) {
+                updatedAtEl.textContent = new Date(updatedMemo.updated_at).toLocaleString();
+            }
             saveStatusEl.textContent = '保存済み';
             saveStatusEl.style.color = 'green';
             // メモ一覧のタイトルも更新（もし表示されていれば）
             const memoInList = memoListEl.querySelector(`div[data-id="${currentMemoId}"]`);
             if (memoInList) {
                 const titleSpan = memoInList.querySelector('.memo-title');
-                if (titleSpan) titleSpan.textContent = updatedMemo.title || '無題のメモ';
+                if (titleSpan) titleSpan.textContent = (updatedMemo.title ?? title) || '無題のメモ';
             }
             const memoInSearch = searchResultsEl.querySelector(`div[data-id="${currentMemoId}"]`);
             if (memoInSearch) {
                 const titleSpanSearch = memoInSearch.querySelector('.memo-title');
-                if (titleSpanSearch) titleSpanSearch.textContent = updatedMemo.title || '無題のメモ';
+                if (titleSpanSearch) titleSpanSearch.textContent = (updatedMemo.title ?? title) || '無題のメモ';
             }
         } else {
             saveStatusEl.textContent = '保存失敗';
@@ -345,6 +424,30 @@ document.addEventListener('DOMContentLoaded', () => {
         autoSaveTimer = null;
     }
 
+    // 保存が競合した (412) メモについて、サーバー上の最新の内容を取得し、
+    // こちらの編集で上書きするか、最新の内容を読み込むかを選んでもらう
+    async function resolveSaveConflict(memoId) {
+        const serverMemo = await fetchData(`/api/notes/${memoId}`);
+        if (!serverMemo || memoId !== currentMemoId) {
+            saveStatusEl.textContent = '保存失敗';
+            saveStatusEl.style.color = 'red';
+            return;
+        }
+        if (confirm('このメモは他の画面で更新されています。こちらの内容で上書きしますか？\n（キャンセルすると最新の内容を読み込みます）')) {
+            // 最新の版を基準にした条件付きの保存にする (その間にまた更新されていれば再び確認する)
+            setSavedState(serverMemo);
+            await saveCurrentMemo();
+            return;
+        }
+        memoTitleInput.value = serverMemo.title;
+        memoContentInput.value = serverMemo.content;
+        setSavedState(serverMemo);
+        updatedAtEl.textContent = new Date(serverMemo.updated_at).toLocaleString();
+        renderMemoTags(serverMemo.tags || []);
+        saveStatusEl.textContent = '最新の内容を読み込みました';
+        saveStatusEl.style.color = 'orange';
+    }
+
     // --- Markdownプレビュー ---
     toggleMarkdownPreviewButton.addEventListener('click', () => {
         if (!currentMemoId) return;
@@ -383,34 +486,32 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
     // --- タグ関連処理 ---
-    async function loadAllTagsForSuggestions() {
-        const data = await fetchData('/api/tags/all'); // 全タグを取得するAPI (ページングなし)
-        if (data && data.tags) {
-            allTags = data.tags.map(tag => tag.name);
-        }
-    }
-
-    memoTagInput.addEventListener('input', () => {
+    // 入力のたびにサーバーの補完インデックスへ問い合わせる (全タグは取得しない)
+    memoTagInput.addEventListener('input', async () => {
         if (!currentMemoId) return;
-        const inputText = memoTagInput.value.toLowerCase();
+        const inputText = memoTagInput.value.trim();
+        const requestId = ++tagSuggestRequestId;
+        if (inputText.length === 0) {
+            tagSuggestionsEl.innerHTML = '';
+            tagSuggestionsEl.classList.add('hidden');
+            return;
+        }
+        const data = await fetchData(`/api/tags/suggest?q=${encodeURIComponent(inputText)}&limit=${TAG_SUGGEST_LIMIT}`);
+        if (requestId !== tagSuggestRequestId) return; // より新しい入力の結果を優先する
         tagSuggestionsEl.innerHTML = '';
-        if (inputText.length > 0) {
-            const suggestions = allTags.filter(tag => tag.toLowerCase().includes(inputText));
-            if (suggestions.length > 0) {
-                suggestions.slice(0, 5).forEach(suggestion => { // 最大5件表示
-                    const div = document.createElement('div');
-                    div.textContent = suggestion;
-                    div.addEventListener('click', () => {
-                        addTagToCurrentMemo(suggestion);
-                        memoTagInput.value = '';
-                        tagSuggestionsEl.classList.add('hidden');
-                    });
-                    tagSuggestionsEl.appendChild(div);
+        const suggestions = data && data.tags ? data.tags.map(tag => tag.name) : [];
+        if (suggestions.length > 0) {
+            suggestions.forEach(suggestion => {
+                const div = document.createElement('div');
+                div.textContent = suggestion;
+                div.addEventListener('click', () => {
+                    addTagToCurrentMemo(suggestion);
+                    memoTagInput.value = '';
+                    tagSuggestionsEl.classList.add('hidden');
                 });
-                tagSuggestionsEl.classList.remove('hidden');
-            } else {
-                tagSuggestionsEl.classList.add('hidden');
-            }
+                tagSuggestionsEl.appendChild(div);
+            });
+            tagSuggestionsEl.classList.remove('hidden');
         } else {
             tagSuggestionsEl.classList.add('hidden');
         }
@@ -429,6 +530,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const tagName = memoTagInput.value.trim();
             addTagToCurrentMemo(tagName);
             memoTagInput.value = '';
+            tagSuggestRequestId++; // 応答待ちの補完は表示しない
             tagSuggestionsEl.classList.add('hidden');
         }
     });
@@ -440,11 +542,16 @@ document.addEventListener('DOMContentLoaded', () => {
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ tag_name: tagName })
         });
+        if (result && result.queued) {
+            // キューに入っただけの応答にはタグ一覧がないので、表示中のタグに加える
+            const names = currentTagNames();
+            if (!names.includes(tagName)) names.push(tagName);
+            result.tags = names.map(name => ({ name }));
+        }
         if (result && result.tags) {
             renderMemoTags(result.tags);
             loadFavoriteTags();
             loadOtherTags(currentOtherTagListPage); 
-            loadAllTagsForSuggestions(); 
             if (autoSaveTimer) clearTimeout(autoSaveTimer); 
             autoSaveTimer = setTimeout(saveCurrentMemo, AUTO_SAVE_DELAY); 
         }
@@ -455,6 +562,9 @@ document.addEventListener('DOMContentLoaded', () => {
         const result = await fetchData(`/api/notes/${currentMemoId}/tags/${encodeURIComponent(tagName)}`, {
             method: 'DELETE'
         });
+        if (result && result.queued) {
+            result.tags = currentTagNames().filter(name => name !== tagName).map(name => ({ name }));
+        }
         if (result && result.tags) {
             renderMemoTags(result.tags);
             loadFavoriteTags();
@@ -464,6 +574,10 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function currentTagNames() {
+        return Array.from(memoCurrentTagsEl.querySelectorAll('.tag-chip'), chip => chip.firstChild.textContent);
+    }
+
     function renderMemoTags(tags) {
         memoCurrentTagsEl.innerHTML = '';
         tags.forEach(tag => {
@@ -552,7 +666,6 @@ document.addEventListener('DOMContentLoaded', () => {
             // 両方のリストを再読み込みして表示を更新
             await loadFavoriteTags();
             await loadOtherTags(currentOtherTagListPage); // 現在のページを維持して再読み込み
-            // TODO: もしタグサジェストが is_favorite に依存するなら loadAllTagsForSuggestions() も呼ぶ
         } else {
             saveStatusEl.textContent = 'お気に入り状態の更新に失敗しました。';
             saveStatusEl.style.color = 'red';
@@ -577,7 +690,7 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
 
-        let url = `/api/search/notes?page=${page}&limit=${ITEMS_PER_PAGE}`;
+        let url = `/api/search/notes?page=${page}&limit=${ITEMS_PER_PAGE}&fields=${MEMO_LIST_FIELDS}`;
         url += `&query=${encodeURIComponent(query)}`;
 
         const data = await fetchData(url);
@@ -596,7 +709,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     
     async function loadTrashedMemos() {
-        const data = await fetchData('/api/notes?trashed=1');
+        const data = await fetchData(`/api/notes?trashed=1&fields=${MEMO_LIST_FIELDS}`);
         if (data && data.notes) {
             trashMemoListEl.innerHTML = '';
             data.notes.forEach(note => {
@@ -615,13 +728,100 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // 削除はサーバーが少しずつ行うので、終わるまで進捗を表示して待つ
     emptyTrashButton.addEventListener('click', async () => {
         if (confirm('本当にゴミ箱を空にしますか？')) {
-            await fetchData('/api/notes/empty_trash', { method: 'DELETE' });
+            const label = emptyTrashButton.textContent;
+            emptyTrashButton.disabled = true;
+            let progress = await fetchData('/api/notes/empty_trash', { method: 'DELETE' });
+            while (progress && progress.state === 'purging') {
+                emptyTrashButton.textContent = `削除中... (${progress.purged}/${progress.requested_total})`;
+                await new Promise(resolve => setTimeout(resolve, TRASH_PURGE_POLL_MS));
+                progress = await fetchData('/api/trash/purge');
+            }
+            emptyTrashButton.textContent = label;
+            emptyTrashButton.disabled = false;
             loadTrashedMemos();
         }
     });
 
+    // --- 変更の同期 (他のタブや端末での編集を反映) ---
+    // /api/events で新しい変更の通知を受けたら、/api/changes から前回以降の差分だけを取得して画面に反映する
+    async function initChangeSync() {
+        if (!window.EventSource) return;
+        const start = await fetchData('/api/changes');
+        if (!start) return;
+        lastChangeSeq = start.seq;
+        const events = new EventSource('/api/events');
+        events.addEventListener('change', (e) => {
+            if (JSON.parse(e.data).seq > lastChangeSeq) syncChanges();
+        });
+    }
+
+    async function syncChanges() {
+        if (changeSyncRunning) {
+            changeSyncPending = true; // 取得中に届いた通知は、終わってからまとめて取得する
+            return;
+        }
+        changeSyncRunning = true;
+        try {
+            let more = true;
+            while (more) {
+                const delta = await fetchData(`/api/changes?since=${lastChangeSeq}`);
+                if (!delta) break;
+                lastChangeSeq = delta.seq;
+                more = Boolean(delta.more);
+                applyChanges(delta);
+            }
+        } finally {
+            changeSyncRunning = false;
+            if (changeSyncPending) {
+                changeSyncPending = false;
+                syncChanges();
+            }
+        }
+    }
+
+    function applyChanges(delta) {
+        const trashTabActive = document.querySelector('.tab-button[data-tab="trash-tab"]').classList.contains('active');
+        if (delta.reset) {
+            // 差分を追えないので全部取り直す
+            loadMemos(currentMemoListPage);
+            loadFavoriteTags();
+            loadOtherTags(currentOtherTagListPage);
+            if (trashTabActive) loadTrashedMemos();
+            return;
+        }
+        let reloadList = delta.deleted_notes.length > 0;
+        let reloadTrash = delta.deleted_notes.length > 0;
+        delta.notes.forEach(note => {
+            document.querySelectorAll(`.memo-item[data-id="${note.id}"] .memo-title`).forEach(titleSpan => {
+                titleSpan.textContent = note.title || '無題のメモ';
+            });
+            const item = memoListEl.querySelector(`.memo-item[data-id="${note.id}"]`);
+            // 一覧は更新日時順なので、先頭以外のメモが更新されたら並びが変わる
+            if (note.is_trashed || !item || item !== memoListEl.firstElementChild) reloadList = true;
+            if (note.is_trashed || !item) reloadTrash = true;
+            if (note.id === currentMemoId) {
+                renderMemoTags(note.tags || []);
+                // 他で編集された場合は、こちらに未保存の編集がなければ読み込み直す
+                if (currentMemoVersion !== null && note.version > currentMemoVersion && !autoSaveTimer) {
+                    selectMemo(note.id);
+                }
+            }
+        });
+        if (delta.deleted_notes.includes(currentMemoId)) {
+            disableEditor();
+            currentMemoId = null;
+        }
+        if (reloadList) loadMemos(currentMemoListPage);
+        if (reloadTrash && trashTabActive) loadTrashedMemos();
+        if (delta.tags.length > 0 || delta.deleted_tags.length > 0) {
+            loadFavoriteTags();
+            loadOtherTags(currentOtherTagListPage);
+        }
+    }
+
     // --- ページネーション描画 ---
     function renderPagination(totalPages, currentPage, PagerElement, callback, ...args) {
         PagerElement.innerHTML = '';